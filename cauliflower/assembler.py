@@ -2,8 +2,11 @@
 An assembler for Notch's CPU.
 """
 
+from array import array
 from collections import namedtuple
-from struct import pack
+from itertools import count
+from struct import pack, unpack
+import sys
 
 (SET, ADD, SUB, MUL, DIV, MOD, SHL, SHR, AND, BOR, XOR, IFE, IFN, IFG, IFB
 ) = range(1, 16)
@@ -12,8 +15,15 @@ JSR = object()
 
 binops = range(1, 16)
 
+commutative = ADD, MUL, AND, BOR, XOR
+
 Absolute = namedtuple("Absolute", "value")
 Offset = namedtuple("Offset", "register, offset")
+# The address of a label or word, looked up when the code is linked.
+Symbol = namedtuple("Symbol", "name")
+# The number of words from one label to another, looked up when the code is
+# linked.
+Distance = namedtuple("Distance", "start, end")
 
 class Register(object):
     def __add__(self, value):
@@ -28,6 +38,86 @@ drdict = dict((k, v)
     for k, v in zip([POP, PEEK, PUSH, SP, PC, O], range(24, 30)))
 drdict.update(rdict)
 direct_registers = registers + list(drdict.keys())
+# Inverse of drdict, for disassembly.
+rdrdict = dict((v, k) for k, v in drdict.items())
+
+
+class Instruction(object):
+    """
+    A single instruction, held symbolically until it is encoded.
+
+    Instructions can be unpacked like (op, a, b) tuples.
+    """
+
+    __slots__ = "op", "a", "b"
+
+    def __init__(self, op, a, b=None):
+        self.op = op
+        self.a = a
+        self.b = b
+
+    def __iter__(self):
+        yield self.op
+        yield self.a
+        yield self.b
+
+    def __eq__(self, other):
+        return (isinstance(other, Instruction) and
+                tuple(self) == tuple(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Instruction(%r, %r, %r)" % (self.op, self.a, self.b)
+
+
+class Label(object):
+    """
+    A named position in a sequence of instructions. Labels take up no space;
+    they can be referred to with a Symbol of the same name.
+    """
+
+    __slots__ = "name",
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Label(%r)" % (self.name,)
+
+
+# Numbers for local labels, which only need to be unique.
+serials = count()
+
+
+def local():
+    """
+    Make up a new name for a local label.
+    """
+
+    return ".L%d" % next(serials)
+
+
+class Data(object):
+    """
+    A raw word in a sequence of instructions.
+    """
+
+    __slots__ = "value",
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return "Data(%r)" % (self.value,)
+
+
+# Binary values which can be looked up directly: registers, indirect
+# registers, and inline literals.
+values = dict((k, (v,)) for k, v in drdict.items())
+values.update((i, (i + 0x20,)) for i in range(0x20))
+indirects = dict((k, (v + 0x8,)) for k, v in rdict.items())
 
 
 def value(v):
@@ -40,6 +130,12 @@ def value(v):
     extended-size instruction with a trailing literal.
     """
 
+    if isinstance(v, list):
+        if v[0] in indirects:
+            return indirects[v[0]]
+    elif v in values and type(v) is not bool:
+        return values[v]
+
     if v in direct_registers:
         # Register
         return drdict[v],
@@ -58,6 +154,9 @@ def value(v):
             # Extended indirection
             return 0x1e, iv
     elif isinstance(v, int):
+        # Literals wrap around to sixteen bits, so negative numbers come out
+        # in two's complement.
+        v &= 0xffff
         if v < 0x20:
             # Inline literal
             return v + 0x20,
@@ -68,32 +167,390 @@ def value(v):
     raise Exception("Couldn't deal with value %r" % (v,))
 
 
-def assemble(op, a, b=None):
+def symbolic(v):
     """
-    Assemble an opcode and return a str of one to three words.
+    Whether a value object is only known at link time, and can be encoded
+    either inline or with a trailing word depending on what it turns out to
+    be.
+    """
+
+    return isinstance(v, (Symbol, Distance))
+
+
+def width(v):
+    """
+    Return the number of trailing words required by a value object.
+
+    Symbolic values are assumed to need a trailing word, since their values
+    aren't known yet; the linker might find that they don't.
+    """
+
+    if symbolic(v):
+        return 1
+    elif isinstance(v, list) and isinstance(v[0], Symbol):
+        return 1
+    return len(value(v)) - 1
+
+
+def footprint(item):
+    """
+    Return the most words that a single instruction, label, or data word
+    could take up.
+    """
+
+    if isinstance(item, Instruction):
+        rv = 1 + width(item.a)
+        if item.op is not JSR:
+            rv += width(item.b)
+        return rv
+    elif isinstance(item, Data):
+        return 1
+    return 0
+
+
+def size(code):
+    """
+    Return the size, in words, of a sequence of instructions.
+
+    Distances between labels are worked out, since they don't depend on
+    where the instructions end up, but symbols are assumed to need a trailing
+    word; this is an upper bound until the instructions are linked.
+    """
+
+    short = candidates(code, Distance)
+    if short:
+        labels, short = relax(code, 0x0, {}, short)
+    return sum(footprint(item) for item in code) - len(short)
+
+
+def resolve(v, symbols):
+    """
+    Replace any symbol in a value object with its address.
+    """
+
+    if isinstance(v, Symbol):
+        return symbols[v.name]
+    elif isinstance(v, Distance):
+        return (symbols[v.end] - symbols[v.start]) & 0xffff
+    elif isinstance(v, list) and isinstance(v[0], Symbol):
+        return [symbols[v[0].name]]
+    return v
+
+
+def instruction_words(op, a, b=None):
+    """
+    Encode a single instruction, with no symbols, into a tuple of one to
+    three words.
     """
 
     if op in binops:
         valuea = value(a)
         valueb = value(b)
         n = (valueb[0] << 10) | (valuea[0] << 4) | op
-        rv = pack(">H", n)
-        if len(valuea) == 2:
-            rv += pack(">H", valuea[1])
-        if len(valueb) == 2:
-            rv += pack(">H", valueb[1])
-        return rv
+        return (n,) + valuea[1:] + valueb[1:]
     elif op is JSR:
         valuea = value(a)
         n = (valuea[0] << 10) | (0x1 << 4)
-        rv = pack(">H", n)
-        if len(valuea) == 2:
-            rv += pack(">H", valuea[1])
-        return rv
+        return (n,) + valuea[1:]
 
     raise Exception("Couldn't deal with op %r" % (op,))
 
 
+def encode_instruction(op, a, b=None):
+    """
+    Encode a single instruction, with no symbols, into a str of one to three
+    words.
+    """
+
+    words = instruction_words(op, a, b)
+    return pack(">%dH" % len(words), *words)
+
+
+# Encoded instructions, by (op, a, b). Indirections are lists, which can't be
+# hashed, so they are keyed by their contents in a tuple instead.
+encodings = {}
+
+
+def lookup(op, a, b):
+    """
+    Encode a single instruction, with no symbols, into a tuple of words,
+    remembering the encoding for the next time the same instruction comes
+    along.
+    """
+
+    key = (op, ("[]", a[0]) if type(a) is list else a,
+           ("[]", b[0]) if type(b) is list else b)
+    try:
+        return encodings[key]
+    except KeyError:
+        rv = encodings[key] = instruction_words(op, a, b)
+        return rv
+
+
+# Kinds of value objects which might have to be resolved before encoding.
+deferred = Symbol, Distance, list
+
+
+def settle(v, long, symbols):
+    """
+    Resolve a value object, keeping it long if it's symbolic and asked to.
+    """
+
+    try:
+        rv = resolve(v, symbols)
+    except KeyError as e:
+        raise Exception("Couldn't resolve symbol %s" % e)
+    if long and type(v) is not list:
+        rv = Absolute(rv)
+    return rv
+
+
+def encoded(code, symbols, short):
+    """
+    Yield the words of each instruction and data word in a sequence, as
+    tuples.
+    """
+
+    for i, item in enumerate(code):
+        kind = type(item)
+        if kind is Instruction:
+            op, a, b = item.op, item.a, item.b
+            if type(a) in deferred:
+                a = settle(a, (i, "a") not in short, symbols)
+            if type(b) in deferred:
+                b = settle(b, (i, "b") not in short, symbols)
+            yield lookup(op, a, b)
+        elif kind is Data:
+            yield item.value,
+
+
+def encode_into(buf, offset, code, symbols={}, short=()):
+    """
+    Encode a sequence of instructions and data into a preallocated array of
+    words, starting at the given offset, and return the offset just past the
+    end.
+
+    Symbols are looked up in the given dict of names to addresses. Symbolic
+    values take a trailing word, unless their (index, slot) is in short.
+    """
+
+    pc = offset
+    for words in encoded(code, symbols, short):
+        end = pc + len(words)
+        buf[pc:end] = array("H", words)
+        pc = end
+    return pc
+
+
+def encode(code, symbols={}, short=()):
+    """
+    Encode a sequence of instructions and data into a str.
+
+    Symbols are looked up in the given dict of names to addresses. Symbolic
+    values take a trailing word, unless their (index, slot) is in short.
+    """
+
+    buf = array("H")
+    for words in encoded(code, symbols, short):
+        buf.extend(words)
+    # Everything is swapped to big-endian at once, at the end.
+    if sys.byteorder == "little":
+        buf.byteswap()
+    return buf.tostring()
+
+
+def operands(item):
+    """
+    Return the value objects of an instruction, each with its slot.
+    """
+
+    if item.op is JSR:
+        return ("a", item.a),
+    return ("a", item.a), ("b", item.b)
+
+
+def candidates(code, kinds=(Symbol, Distance)):
+    """
+    Find the (index, slot) of every value of the given kinds in a sequence of
+    instructions.
+    """
+
+    rv = set()
+    for i, item in enumerate(code):
+        if isinstance(item, Instruction):
+            for slot, v in operands(item):
+                if isinstance(v, kinds):
+                    rv.add((i, slot))
+    return rv
+
+
+def relax(code, origin, symbols, short):
+    """
+    Find the address of every label in a sequence of instructions which will
+    be placed at the given origin, trying to fit the symbolic values at the
+    given (index, slot)s inline.
+
+    Every such value starts out inline, and values which don't fit are given
+    trailing words until nothing changes. Values only grow as the code grows,
+    so this always finishes, and nothing is made longer than it needs to be.
+
+    Returns the labels and the (index, slot)s which stayed inline.
+    """
+
+    table = dict(symbols)
+    short = set(short)
+    sizes = [footprint(item) for item in code]
+
+    while True:
+        # How many words each instruction is saving by being short.
+        savings = {}
+        for i, slot in short:
+            savings[i] = savings.get(i, 0) + 1
+
+        labels = {}
+        pc = origin
+        for i, item in enumerate(code):
+            if type(item) is Label:
+                labels[item.name] = pc
+            else:
+                pc += sizes[i] - savings.get(i, 0)
+        table.update(labels)
+
+        grown = set()
+        for i, slot in short:
+            try:
+                v = resolve(getattr(code[i], slot), table)
+            except KeyError:
+                # Whatever it is, it's not here yet, so it can't be assumed
+                # to be small.
+                v = 0x20
+            if v >= 0x20:
+                grown.add((i, slot))
+
+        if not grown:
+            return labels, short
+        short -= grown
+
+
+def layout(code, origin=0x0, symbols={}):
+    """
+    Find the address of every label in a sequence of instructions which will
+    be placed at the given origin, choosing the shortest encoding for every
+    symbolic value.
+
+    Returns the labels and the (index, slot) of every inline symbolic value.
+    """
+
+    return relax(code, origin, symbols, candidates(code))
+
+
+def locate(code, origin=0x0, symbols={}):
+    """
+    Find the address of every label in a sequence of instructions which will
+    be placed at the given origin.
+    """
+
+    return layout(code, origin, symbols)[0]
+
+
+def link(code, origin=0x0, symbols={}):
+    """
+    Resolve the labels in a sequence of instructions placed at the given
+    origin, along with any other symbols given, and encode it with the
+    shortest encoding for every symbolic value.
+    """
+
+    labels, short = layout(code, origin, symbols)
+    table = dict(symbols)
+    table.update(labels)
+    return encode(code, table, short)
+
+
+def relabel(code, fresh=local):
+    """
+    Return a copy of a sequence of instructions with new names for all of its
+    labels, so that it can be placed more than once.
+
+    The new names come from fresh, in the order that the labels appear.
+    """
+
+    names = dict((item.name, fresh()) for item in code
+                 if isinstance(item, Label))
+
+    def rename(v):
+        if isinstance(v, Symbol) and v.name in names:
+            return Symbol(names[v.name])
+        elif isinstance(v, Distance):
+            return Distance(names.get(v.start, v.start),
+                            names.get(v.end, v.end))
+        return v
+
+    rv = []
+    for item in code:
+        if isinstance(item, Label):
+            rv.append(Label(names[item.name]))
+        elif isinstance(item, Instruction):
+            rv.append(Instruction(item.op, rename(item.a), rename(item.b)))
+        else:
+            rv.append(item)
+    return rv
+
+
+def assemble(op, a, b=None):
+    """
+    Assemble an opcode and return a str of one to three words.
+    """
+
+    return encode([Instruction(op, a, b)])
+
+
+def unvalue(v, words):
+    """
+    Return the value object corresponding to the given binary value, pulling
+    a trailing word from an iterator of words if needed.
+
+    This is the inverse of value().
+    """
+
+    if v in rdrdict:
+        return rdrdict[v]
+    elif v < 0x10:
+        return [rdrdict[v - 0x8]]
+    elif v < 0x18:
+        return [rdrdict[v - 0x10] + next(words)]
+    elif v == 0x1e:
+        return [next(words)]
+    elif v == 0x1f:
+        literal = next(words)
+        # Small literals have to be kept extended to keep the same size.
+        return Absolute(literal) if literal < 0x20 else literal
+    else:
+        return v - 0x20
+
+
+def disassemble(ucode):
+    """
+    Turn a str of assembled words back into a list of instructions.
+
+    This is the inverse of encode(); reencoding the instructions gives back
+    exactly the same words.
+    """
+
+    words = iter(unpack(">%dH" % (len(ucode) // 2), ucode))
+    rv = []
+    for n in words:
+        op = n & 0xf
+        if op:
+            a = unvalue((n >> 4) & 0x3f, words)
+            b = unvalue(n >> 10, words)
+            rv.append(Instruction(op, a, b))
+        elif (n >> 4) & 0x3f == 0x1:
+            rv.append(Instruction(JSR, unvalue(n >> 10, words)))
+        else:
+            raise Exception("Couldn't disassemble word 0x%04x" % n)
+    return rv
+
+
 def until(ucode, condition):
     """
     While a condition fails, repeat a block of instructions. When the
@@ -106,12 +563,13 @@ def until(ucode, condition):
     op, a, b = condition
     if op not in (IFB, IFE, IFG, IFN):
         raise Exception("Op %r isn't conditional" % (op,))
-    ucode += assemble(op, a, b)
-    distance = len(ucode) // 2 + 1
-    # Compensate for the extra word required to long-jump.
-    if distance >= 0x20:
-        distance += 1
-    ucode += assemble(SUB, PC, distance)
+
+    top = local()
+    bottom = local()
+    ucode = [Label(top)] + ucode + [Instruction(op, a, b)]
+    # PC has already moved past the jump when it is read.
+    ucode.append(Instruction(SUB, PC, Distance(top, bottom)))
+    ucode.append(Label(bottom))
 
     return ucode
 
@@ -121,9 +579,4 @@ def call(address):
     Perform a nothing-saved, no-rules call.
     """
 
-    jump = assemble(JSR, address)
-    distance = len(jump) // 2
-    ucode = assemble(SET, PUSH, PC)
-    ucode += assemble(ADD, PEEK, distance + 0x1)
-    ucode += jump
-    return ucode
+    return [Instruction(JSR, address)]
@@ -1,53 +1,83 @@
-from cauliflower.assembler import (A, ADD, AND, B, BOR, C, DIV, MOD, MUL,
-                                   PEEK, POP, PUSH, SET, SP, SUB, X, XOR,
-                                   assemble)
+"""
+Builtin words.
+
+There are two sets of templates. The plain ones keep the entire data stack in
+memory on SP. The TOS ones cache the top of the stack in Z, and keep the rest
+of the stack on SP; they save memory traffic on nearly every word.
+"""
+
+from collections import namedtuple
+
+from cauliflower import generated
+from cauliflower.assembler import (A, ADD, AND, B, BOR, C, DIV, I, MOD, MUL,
+                                   PEEK, POP, PUSH, SET, SHL, SHR, SP, SUB, X,
+                                   XOR, Z, Instruction, commutative)
+
+# An operation whose right-hand side is a literal, rather than the stack.
+Immediate = namedtuple("Immediate", "op, literal")
 
 def drop():
-    return assemble(ADD, SP, 0x1)
+    return [Instruction(ADD, SP, 0x1)]
 
 
 def dup():
-    ucode = assemble(SET, A, PEEK)
-    ucode += assemble(SET, PUSH, A)
-    return ucode
+    return [
+        Instruction(SET, A, PEEK),
+        Instruction(SET, PUSH, A),
+    ]
 
 
 def over():
-    ucode = assemble(SET, A, SP)
-    ucode += assemble(SET, PUSH, [A + 0x1])
-    return ucode
+    return [
+        Instruction(SET, A, SP),
+        Instruction(SET, PUSH, [A + 0x1]),
+    ]
 
 
 def rot():
-    ucode = assemble(SET, A, POP)
-    ucode += assemble(SET, B, POP)
-    ucode += assemble(SET, C, POP)
-    ucode += assemble(SET, PUSH, B)
-    ucode += assemble(SET, PUSH, A)
-    ucode += assemble(SET, PUSH, C)
-    return ucode
+    return [
+        Instruction(SET, A, POP),
+        Instruction(SET, B, POP),
+        Instruction(SET, C, POP),
+        Instruction(SET, PUSH, B),
+        Instruction(SET, PUSH, A),
+        Instruction(SET, PUSH, C),
+    ]
 
 
 def swap():
-    ucode = assemble(SET, A, POP)
-    ucode += assemble(SET, B, POP)
-    ucode += assemble(SET, PUSH, A)
-    ucode += assemble(SET, PUSH, B)
-    return ucode
+    return [
+        Instruction(SET, A, POP),
+        Instruction(SET, B, POP),
+        Instruction(SET, PUSH, A),
+        Instruction(SET, PUSH, B),
+    ]
 
 
 def to_r():
-    ucode = assemble(SUB, X, 0x1)
-    ucode += assemble(SET, [X], POP)
-    return ucode
+    return [
+        Instruction(SUB, X, 0x1),
+        Instruction(SET, [X], POP),
+    ]
 
 
 def r_at():
-    return assemble(SET, PUSH, [X])
+    return [Instruction(SET, PUSH, [X])]
 
 
 def rdrop():
-    return assemble(ADD, X, 0x1)
+    return [Instruction(ADD, X, 0x1)]
+
+
+# The index of the innermost do loop is in I, and the index of the loop around
+# it was spilled to the top of the >r stack.
+
+def loop_i():
+    return [Instruction(SET, PUSH, I)]
+
+
+def loop_j():
+    return [Instruction(SET, PUSH, [X])]
 
 
 prims = {
@@ -59,6 +89,84 @@ prims = {
     ">r": to_r,
     "r@": r_at,
     "rdrop": rdrop,
+    "i": loop_i,
+    "j": loop_j,
+}
+
+def tos_drop():
+    return [Instruction(SET, Z, POP)]
+
+
+def tos_dup():
+    return [Instruction(SET, PUSH, Z)]
+
+
+def tos_over():
+    return [
+        Instruction(SET, A, PEEK),
+        Instruction(SET, PUSH, Z),
+        Instruction(SET, Z, A),
+    ]
+
+
+def tos_rot():
+    return [
+        Instruction(SET, A, POP),
+        Instruction(SET, B, PEEK),
+        Instruction(SET, PEEK, A),
+        Instruction(SET, PUSH, Z),
+        Instruction(SET, Z, B),
+    ]
+
+
+def tos_swap():
+    return [
+        Instruction(SET, A, Z),
+        Instruction(SET, Z, PEEK),
+        Instruction(SET, PEEK, A),
+    ]
+
+
+def tos_to_r():
+    return [
+        Instruction(SUB, X, 0x1),
+        Instruction(SET, [X], Z),
+        Instruction(SET, Z, POP),
+    ]
+
+
+def tos_r_at():
+    return [
+        Instruction(SET, PUSH, Z),
+        Instruction(SET, Z, [X]),
+    ]
+
+
+def tos_loop_i():
+    return [
+        Instruction(SET, PUSH, Z),
+        Instruction(SET, Z, I),
+    ]
+
+
+def tos_loop_j():
+    return [
+        Instruction(SET, PUSH, Z),
+        Instruction(SET, Z, [X]),
+    ]
+
+
+tos_prims = {
+    "drop": tos_drop,
+    "dup": tos_dup,
+    "over": tos_over,
+    "rot": tos_rot,
+    "swap": tos_swap,
+    ">r": tos_to_r,
+    "r@": tos_r_at,
+    "rdrop": rdrop,
+    "i": tos_loop_i,
+    "j": tos_loop_j,
 }
 
 binops = {
@@ -72,34 +180,83 @@ binops = {
     "or": BOR,
 }
 
-def binop(op):
+# Operations which leave the stack alone when given a zero.
+identities = ADD, SUB, BOR, XOR, SHL, SHR
+
+
+def reduce(opcode, literal):
+    """
+    Find a cheaper operation which has the same effect as the given one, on
+    the given literal. Multiplying, dividing and taking the remainder by
+    powers of two are all done with shifts and masks instead.
+    """
+
+    if literal and not literal & (literal - 1):
+        if opcode == MUL:
+            return SHL, literal.bit_length() - 1
+        elif opcode == DIV:
+            return SHR, literal.bit_length() - 1
+        elif opcode == MOD:
+            return AND, literal - 1
+
+    return opcode, literal
+
+
+def binop(op, tos=False, literal=None):
     """
-    Compile a binary operation.
+    Compile a binary operation. If a literal is given, it is used as the
+    right-hand side instead of the top of the stack.
     """
 
     opcode = binops[op]
 
-    ucode = assemble(SET, A, POP)
-    ucode += assemble(opcode, PEEK, A)
-    return ucode
+    if literal is not None:
+        opcode, literal = reduce(opcode, literal)
+        if opcode in identities and not literal:
+            return []
+        return [Instruction(opcode, Z if tos else PEEK, literal)]
+
+    if tos:
+        if opcode in commutative:
+            return [Instruction(opcode, Z, POP)]
+        return [
+            Instruction(opcode, PEEK, Z),
+            Instruction(SET, Z, POP),
+        ]
 
+    return [
+        Instruction(SET, A, POP),
+        Instruction(opcode, PEEK, A),
+    ]
 
-def builtin(word):
+
+def builtin(word, tos=False):
     """
-    Compile a builtin word.
+    Compile a builtin word, optionally caching the top of the stack in Z.
     """
 
+    if isinstance(word, Immediate):
+        return binop(word.op, tos, word.literal)
+
     try:
         i = int(word)
-        ucode = assemble(SET, PUSH, i)
-        return ucode
+        if tos:
+            return [
+                Instruction(SET, PUSH, Z),
+                Instruction(SET, Z, i),
+            ]
+        return [Instruction(SET, PUSH, i)]
     except ValueError:
         pass
 
-    if word in prims:
-        return prims[word]()
+    # Templates which superoptimize.py found to be cheaper than the
+    # hand-written ones are used in their place.
+    for table in ((generated.tos_prims, tos_prims) if tos else
+                  (generated.prims, prims)):
+        if word in table:
+            return table[word]()
 
     if word in binops:
-        return binop(word)
+        return binop(word, tos)
 
     raise Exception("Don't know builtin %r" % word)
@@ -0,0 +1,216 @@
+"""
+A persistent cache of compiled words.
+
+Entries are stored on disk, one file per entry, named by a hash of everything
+that went into them. Words are kept in their symbolic, position-independent
+form, so they can be linked into any image; their local labels are renamed
+when they are loaded, so that they never clash with labels made in this run.
+
+When the cache grows past its limit, the least recently used entries are
+thrown out. Entries which can't be read back are thrown out too, and so are
+entries which a compiler started writing out and never finished.
+"""
+
+from cPickle import Pickler, Unpickler
+from hashlib import sha1
+import os
+from time import time
+
+from cauliflower.assembler import (A, B, C, I, J, JSR, O, PC, PEEK, POP, PUSH,
+                                   SP, X, Y, Z)
+
+# Objects which are compared by identity, and so have to come back out of the
+# cache as the very same objects.
+singletons = {
+    "A": A, "B": B, "C": C, "X": X, "Y": Y, "Z": Z, "I": I, "J": J,
+    "POP": POP, "PEEK": PEEK, "PUSH": PUSH, "SP": SP, "PC": PC, "O": O,
+    "JSR": JSR,
+}
+names = dict((id(v), k) for k, v in singletons.items())
+
+# How many seconds an entry can take to be written out before it's taken to
+# have been abandoned.
+ABANDONED = 60 * 60
+
+
+def dump(entry, f):
+    """
+    Pickle some compiled code, or anything holding it, to an open file.
+    """
+
+    pickler = Pickler(f, 2)
+    pickler.persistent_id = lambda obj: names.get(id(obj))
+    pickler.dump(entry)
+
+
+def load(f):
+    """
+    Unpickle something which dump() wrote, from an open file.
+    """
+
+    unpickler = Unpickler(f)
+    unpickler.persistent_load = singletons.__getitem__
+    return unpickler.load()
+
+
+def fingerprint(paths):
+    """
+    Hash the contents of some files, so that entries made by a different
+    version of the compiler aren't used.
+    """
+
+    h = sha1()
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class Cache(object):
+    """
+    A directory of compiled words, capped at a number of bytes.
+    """
+
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # The limit might have been lowered since the last run.
+        self.evict()
+
+
+    def key(self, *parts):
+        """
+        Make a key out of some hashable, printable parts.
+        """
+
+        return sha1(repr(parts)).hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+
+    def get(self, key):
+        """
+        Return the entry for a key, or None if there isn't one.
+        """
+
+        path = self.path(key)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            with f:
+                entry = load(f)
+        except Exception:
+            # A damaged entry can fail to unpickle in any number of ways. It's
+            # no good to anybody, so it's thrown out.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used, unless another compiler has
+        # thrown it out since.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+
+    def put(self, key, entry):
+        """
+        Store an entry under a key, making room for it if needed.
+
+        Entries are written out under a hidden name, and then renamed, so
+        that other compilers sharing the cache never see half of one.
+        """
+
+        partial = self.path(".%s.%d" % (key, os.getpid()))
+        with open(partial, "wb") as f:
+            dump(entry, f)
+        os.rename(partial, self.path(key))
+
+        self.stores += 1
+        self.evict(keep=self.path(key))
+
+
+    def usage(self):
+        """
+        Return the path, last use and size of every entry.
+        """
+
+        for name in os.listdir(self.directory):
+            if name.startswith("."):
+                continue
+            try:
+                stat = os.stat(self.path(name))
+            except OSError:
+                continue
+            yield self.path(name), stat.st_mtime, stat.st_size
+
+
+    def sweep(self):
+        """
+        Throw out entries which were started long enough ago that whoever was
+        writing them out must have given up.
+        """
+
+        for name in os.listdir(self.directory):
+            if not name.startswith("."):
+                continue
+            path = self.path(name)
+            try:
+                if time() - os.stat(path).st_mtime > ABANDONED:
+                    os.remove(path)
+            except OSError:
+                # Finished, or thrown out by another compiler.
+                continue
+
+
+    def evict(self, keep=None):
+        """
+        Throw out the least recently used entries until the cache fits in its
+        limit, never throwing out the entry at keep.
+        """
+
+        self.sweep()
+        entries = sorted(self.usage(), key=lambda entry: entry[1])
+        total = sum(entry[2] for entry in entries)
+        for path, mtime, size in entries:
+            if total <= self.limit:
+                break
+            if path == keep:
+                continue
+            total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                # Another compiler got to it first.
+                continue
+            self.evictions += 1
+
+
+    def report(self):
+        """
+        Describe how well the cache did.
+        """
+
+        total = sum(entry[2] for entry in self.usage())
+        yield "Cache: %d hits, %d misses, %d stored, %d evicted" % (
+            self.hits, self.misses, self.stores, self.evictions)
+        yield "Cache holds %d bytes, with a limit of %d" % (total, self.limit)
@@ -1,43 +1,114 @@
 """
 Flow control and ABI helpers.
+
+Normally, the call stack lives in Z. When the top of the data stack is being
+cached in a register, that register is Z, and the call stack lives in Y
+instead.
+
+Alternatively, calls can be made with JSR, and returns with SET PC, POP, so
+that the call stack lives in SP. Then the data stack moves into the register
+that the call stack would otherwise have used. Code is always written as if
+the data stack were in SP, and move_stack() rewrites it afterwards.
+
+The index and limit of the innermost do loop live in I and J. When loops are
+nested, the outer loop's index and limit are spilled to the >r stack in X.
 """
 
-from cauliflower.assembler import (A, ADD, IFE, PC, POP, SET, SUB, Z,
-                                   Absolute, assemble)
+from cauliflower.assembler import (A, ADD, I, IFB, IFE, IFG, IFN, J, JSR,
+                                   PC, PEEK, POP, PUSH, SET, SP, SUB, X, Y, Z,
+                                   Distance, Instruction, Label, local, until)
+
+tests = IFB, IFE, IFG, IFN
+
+
+def call_stack(tos, jsr=False):
+    """
+    Return the register which holds the call stack.
+    """
+
+    if jsr:
+        return SP
+    return Y if tos else Z
+
+
+def data_stack(tos, jsr=False):
+    """
+    Return the register which holds the data stack.
+    """
+
+    if jsr:
+        return Y if tos else Z
+    return SP
+
+
+def test(tos=False):
+    """
+    Pop the top of the stack and test it, skipping the next instruction if it
+    is false.
+    """
+
+    if tos:
+        return [
+            Instruction(SET, A, Z),
+            Instruction(SET, Z, POP),
+            Instruction(IFE, 0x0, A),
+        ]
+    else:
+        return [Instruction(IFE, 0x0, POP)]
 
 
-def call(target):
+def call(target, tos=False, jsr=False):
     """
     Call a subroutine.
 
     This call is built to be position-independent. The return value pushed
     onto the stack is calculated at runtime, and the return/call stack is
     managed by this function, so no effort is required beyond ensuring that
-    the target is already fixed in location.
+    the target is already fixed in location. The target may also be a Symbol,
+    to be fixed in location at link time.
 
     Safety not guaranteed; you might not ever come back.
     """
 
+    if jsr:
+        # The CPU does all of the above by itself.
+        return [Instruction(JSR, target)]
+
+    rsp = call_stack(tos)
+    here = local()
+    back = local()
+
     # Make space on the call stack.
-    ucode = assemble(SUB, Z, 0x1)
-    # Hax. Calculate where we currently are based on PC, and then expect that
-    # we will take a certain number of words to make our actual jump.
+    ucode = [Instruction(SUB, rsp, 0x1)]
+    # Hax. Calculate where we currently are based on PC, and then add however
+    # far it is to the end of the call, which the linker works out for us.
     # Grab PC into a GPR. Note that PC increments before it's grabbed here, so
     # this instruction doesn't count towards our total.
-    ucode += assemble(SET, A, PC)
-    # 0x0+1: Add our offset to PC in A.
-    ucode += assemble(ADD, A, 0x4)
-    # 0x1+1: Push our offset into the ret/call stack on Z.
-    ucode += assemble(SET, [Z], A)
-    # 0x2+2: Make our call, rigged so that it will always be two words.
-    ucode += assemble(SET, PC, Absolute(target))
-    # 0x4 is business as usual. Whereever we were from, we *probably* wanna
+    ucode.append(Instruction(SET, A, PC))
+    ucode.append(Label(here))
+    # Add our offset to PC in A.
+    ucode.append(Instruction(ADD, A, Distance(here, back)))
+    # Push our offset into the ret/call stack.
+    ucode.append(Instruction(SET, [rsp], A))
+    # Make our call.
+    ucode.append(Instruction(SET, PC, target))
+    ucode.append(Label(back))
+    # Business as usual. Whereever we were from, we *probably* wanna
     # decrement Z again.
-    ucode += assemble(ADD, Z, 0x1)
+    ucode.append(Instruction(ADD, rsp, 0x1))
     return ucode
 
 
-def ret():
+def jump(target):
+    """
+    Jump to a subroutine without making a call, so that it will return
+    straight to our caller. This is how tail calls are made.
+    """
+
+    return [Instruction(SET, PC, target)]
+
+
+def ret(tos=False, jsr=False):
     """
     Return to the caller.
 
@@ -46,59 +117,419 @@ def ret():
     location onto the return/call stack.
     """
 
-    return assemble(SET, PC, [Z])
+    if jsr:
+        return [Instruction(SET, PC, POP)]
+    return [Instruction(SET, PC, [call_stack(tos)])]
 
 
-def if_alone(target):
+def if_alone(target, tos=False, tail=False, jsr=False):
     """
     Consider the current value on the stack. If it's true, then execute a
     given code block. Otherwise, jump to the next code block.
+
+    If this is the tail of a subroutine, the block is jumped to instead of
+    called, and the subroutine returns if the value is false.
     """
 
-    print "Making if", hex(target)
+    print "Making if", target
 
-    # We don't know the size of the block we wish to jump over quite yet;
-    # let's figure that out first.
-    block = call(target)
+    if tail:
+        # If the value is false, return; otherwise, skip the return and go
+        # to the block for good.
+        return test(tos) + ret(tos, jsr) + jump(target)
+
+    start = local()
+    end = local()
 
     # Our strategy is to put together a small jump over the block if the value
     # is false. If it's true, then the IFE will jump over the jump. Double
     # negatives fail to lose again!
-    ucode = assemble(IFE, 0x0, POP)
+    ucode = test(tos)
     # Now we jump over the block...
-    ucode += assemble(ADD, PC, len(block) // 2)
+    ucode.append(Instruction(ADD, PC, Distance(start, end)))
+    ucode.append(Label(start))
     # And insert the call to the block.
-    ucode += block
+    ucode += call(target, tos, jsr)
+    ucode.append(Label(end))
     # All done!
     return ucode
 
 
-def if_else(target, otherwise):
+def if_else(target, otherwise, tos=False, tail=False, jsr=False):
     """
     Add a call to a block directly after an if statement. The block will only
     be executed if the if block was not executed.
+
+    If this is the tail of a subroutine, both blocks are jumped to instead of
+    called.
     """
 
-    print "Making if/else", hex(target), hex(otherwise)
+    print "Making if/else", target, otherwise
 
-    # We don't know the size of the block we wish to jump over quite yet;
-    # let's figure that out first.
-    ifblock = call(target)
+    if tail:
+        return test(tos) + jump(otherwise) + jump(target)
 
-    # Let's also make the else block.
-    elseblock = call(otherwise)
+    start = local()
+    middle = local()
+    end = local()
 
     # Same as before, but with a twist: At the end of the ifblock, we're going
     # to jump over the else block in the same style.
-    ifblock += assemble(ADD, PC, len(elseblock) // 2)
+    ifblock = call(target, tos, jsr)
+    ifblock.append(Instruction(ADD, PC, Distance(middle, end)))
 
     # Now assemble as before. First, the test.
-    ucode = assemble(IFE, 0x0, POP)
+    ucode = test(tos)
     # Now we jump over the block...
-    ucode += assemble(ADD, PC, len(ifblock) // 2)
+    ucode.append(Instruction(ADD, PC, Distance(start, middle)))
+    ucode.append(Label(start))
     # And insert the call to the block.
     ucode += ifblock
+    ucode.append(Label(middle))
     # Now the else block.
-    ucode += elseblock
+    ucode += call(otherwise, tos, jsr)
+    ucode.append(Label(end))
     # All done!
     return ucode
+
+
+def if_then(block, otherwise=None, tos=False):
+    """
+    Consider the current value on the stack. If it's true, then run a block
+    in line; otherwise, run the other block, if there is one.
+
+    Nothing is called; the blocks are skipped over with forward jumps, so
+    they can be any code at all, including calls.
+    """
+
+    start = local()
+    middle = local()
+    end = local()
+
+    ucode = test(tos)
+    # Jump over the block if the value is false.
+    ucode.append(Instruction(ADD, PC, Distance(start, middle)))
+    ucode.append(Label(start))
+    ucode += block
+    if otherwise is not None:
+        # And at the end of the block, jump over the other one.
+        ucode.append(Instruction(ADD, PC, Distance(middle, end)))
+    ucode.append(Label(middle))
+    if otherwise is not None:
+        ucode += otherwise
+        ucode.append(Label(end))
+    return ucode
+
+
+def begin_until(body, tos=False):
+    """
+    Repeat a block until the value it leaves on the stack is true.
+    """
+
+    top = local()
+    bottom = local()
+
+    # The test skips the jump back to the top if the value is true.
+    ucode = [Label(top)] + body + test(tos)
+    ucode.append(Instruction(SUB, PC, Distance(top, bottom)))
+    ucode.append(Label(bottom))
+    return ucode
+
+
+def begin_while(condition, body, tos=False):
+    """
+    Run a condition, and then a block if the value it leaves on the stack is
+    true, over and over until the value is false.
+    """
+
+    top = local()
+    start = local()
+    bottom = local()
+
+    ucode = [Label(top)] + condition + test(tos)
+    # Jump out of the loop if the value was false.
+    ucode.append(Instruction(ADD, PC, Distance(start, bottom)))
+    ucode.append(Label(start))
+    ucode += body
+    ucode.append(Instruction(SUB, PC, Distance(top, bottom)))
+    ucode.append(Label(bottom))
+    return ucode
+
+
+def save_loop():
+    """
+    Spill the index and limit of a do loop to the >r stack, with the index on
+    top.
+    """
+
+    return [
+        Instruction(SUB, X, 0x2),
+        Instruction(SET, [X], I),
+        Instruction(SET, [X + 0x1], J),
+    ]
+
+
+def restore_loop():
+    """
+    Reload the index and limit of a do loop from the >r stack.
+    """
+
+    return [
+        Instruction(SET, I, [X]),
+        Instruction(SET, J, [X + 0x1]),
+        Instruction(ADD, X, 0x2),
+    ]
+
+
+def do_loop(body, tos=False, nested=False):
+    """
+    Take a limit and a starting index off of the stack, and run a block once
+    for every index from the start up to, but not including, the limit. The
+    block always runs at least once.
+
+    If the loop is nested inside of another, the other loop's index and limit
+    are saved first, and restored afterwards.
+    """
+
+    ucode = save_loop() if nested else []
+    if tos:
+        ucode += [
+            Instruction(SET, I, Z),
+            Instruction(SET, J, POP),
+            Instruction(SET, Z, POP),
+        ]
+    else:
+        ucode += [
+            Instruction(SET, I, POP),
+            Instruction(SET, J, POP),
+        ]
+    # Count, and skip the jump back once the index reaches the limit.
+    ucode += until(body + [Instruction(ADD, I, 0x1)], (IFN, I, J))
+    if nested:
+        ucode += restore_loop()
+    return ucode
+
+
+# What moving the data stack register costs, and what reaching the stack by
+# an offset from it costs, in cycles and words.
+ADJUST = 2, 1
+OFFSET = 1, 1
+
+
+def touches_pc(instruction):
+    op, a, b = instruction
+    return op is JSR or op in tests or a is PC or b is PC
+
+
+def is_return(instruction):
+    op, a, b = instruction
+    return a is PC and b is POP
+
+
+def places(instruction):
+    """
+    Find where an instruction reaches the stack, relative to the top of the
+    stack before it runs, and how far it moves the stack.
+
+    Returns a place for each of the instruction's values, which is None for
+    values that don't touch the stack, and the distance.
+    """
+
+    op, a, b = instruction
+    if is_return(instruction):
+        return [None, None], 0
+
+    depth = 0
+    rv = []
+    for v in a, b:
+        if v is PUSH:
+            depth -= 1
+            rv.append(depth)
+        elif v is POP:
+            rv.append(depth)
+            depth += 1
+        elif v is PEEK:
+            rv.append(depth)
+        else:
+            rv.append(None)
+    return rv, depth
+
+
+def shift(instruction):
+    """
+    How far an instruction moves SP by itself, if it's a plain ADD or SUB.
+    """
+
+    op, a, b = instruction
+    if a is SP and op in (ADD, SUB) and isinstance(b, int):
+        return b if op == ADD else -b
+    return 0
+
+
+def access(instruction, register, behind):
+    """
+    Rewrite an instruction to reach the stack through a register, which is
+    behind the real top of the stack by some number of words.
+    """
+
+    if is_return(instruction):
+        return instruction
+
+    op, a, b = instruction
+    values = []
+    for v, place in zip((a, b), places(instruction)[0]):
+        if v is SP:
+            values.append(register)
+        elif place is None:
+            values.append(v)
+        elif place + behind:
+            values.append([register + ((place + behind) & 0xffff)])
+        else:
+            values.append([register])
+    return Instruction(op, *values)
+
+
+def catch_up(register, behind):
+    """
+    Move a register by however far it is behind the stack.
+    """
+
+    if behind > 0:
+        return [Instruction(ADD, register, behind)]
+    elif behind < 0:
+        return [Instruction(SUB, register, -behind)]
+    return []
+
+
+def plan(run):
+    """
+    Decide how far behind the stack the register should be going into each
+    instruction of a straight run, so that the run is as fast as it can be,
+    and then as small. The register starts and ends the run caught up.
+
+    Each instruction is given with whether it's conditional, and so can't
+    have the register moved in front of it or by it, and whether the
+    register has to be caught up once it's done, or before it if it's
+    conditional.
+    """
+
+    # For each place the register could be, the cheapest way to get there,
+    # as a cost and the places chosen so far.
+    best = {0: ((0, 0), [])}
+    # Anywhere that makes an offset unnecessary is worth considering.
+    candidates = set([0])
+    for instruction, conditional, settle in run:
+        where, depth = places(instruction)
+        candidates.update(-place for place in where if place is not None)
+        if settle:
+            candidates.add(-depth - shift(instruction))
+
+    for instruction, conditional, settle in run:
+        where, depth = places(instruction)
+        depth += shift(instruction)
+        moved = {}
+        for behind, (cost, chosen) in best.items():
+            options = [behind] if conditional else candidates | set([behind])
+            for start in options:
+                total = cost
+                if start != behind:
+                    total = tuple(x + y for x, y in zip(total, ADJUST))
+                for place in where:
+                    if place is not None and place + start:
+                        total = tuple(x + y for x, y in zip(total, OFFSET))
+                after = start if conditional else start + depth
+                if settle and (start if conditional else after):
+                    continue
+                if after not in moved or total < moved[after][0]:
+                    moved[after] = total, chosen + [start]
+        best = moved
+
+    finished = []
+    for behind, (cost, chosen) in best.items():
+        if behind:
+            cost = tuple(x + y for x, y in zip(cost, ADJUST))
+        finished.append((cost, behind, chosen))
+    return min(finished)[2]
+
+
+def move_stack(code, register):
+    """
+    Move the data stack of some code out of SP and into a register, for
+    calling with JSR.
+
+    Every PUSH, POP and PEEK, and every mention of SP, goes through the
+    register instead, except for returns, which pop the call stack. Rather
+    than moving the register every time the stack moves, the register is let
+    fall behind, and the stack is reached by offsets from it; plan() decides
+    where the register is moved in each straight run of code. The register is
+    caught up before anything which jumps, or could be jumped to.
+    """
+
+    rv = []
+    run = []
+
+    def flush():
+        behind = 0
+        for (instruction, conditional, settle), start in zip(run,
+                                                             plan(run)):
+            if conditional:
+                depth = places(instruction)[1]
+                ucode = [access(instruction, register, behind)]
+                ucode += catch_up(register, depth)
+                if len(ucode) > 1:
+                    # The stack only moves if the test passed, so the register
+                    # has to move along with it. Test passed: hop over the
+                    # jump, and run the instructions. Test failed: take the
+                    # jump over the instructions.
+                    hop = local()
+                    begin = local()
+                    end = local()
+                    ucode = ([Instruction(ADD, PC, Distance(hop, begin)),
+                              Label(hop),
+                              Instruction(ADD, PC, Distance(begin, end)),
+                              Label(begin)] + ucode + [Label(end)])
+                rv.extend(ucode)
+                continue
+            rv.extend(catch_up(register, behind - start))
+            behind = start + places(instruction)[1] + shift(instruction)
+            if shift(instruction):
+                # Just a move of the stack, which only the plan needs to
+                # know about.
+                continue
+            rv.append(access(instruction, register, start))
+        rv.extend(catch_up(register, behind))
+        del run[:]
+
+    for i, item in enumerate(code):
+        previous = code[i - 1] if i else None
+        conditional = (isinstance(previous, Instruction) and
+                       previous.op in tests)
+        following = code[i + 1] if i + 1 < len(code) else None
+
+        if not isinstance(item, Instruction):
+            flush()
+            rv.append(item)
+            continue
+
+        if conditional:
+            if item.op in tests and places(item)[1]:
+                raise Exception("Can't move %r after a test" % (item,))
+            settle = touches_pc(item) or SP in item
+            run.append((item, True, settle))
+        elif item.op in tests:
+            # If what the test guards needs the register caught up, then it
+            # has to be caught up by the test.
+            settle = (not isinstance(following, Instruction) or
+                      touches_pc(following) or SP in following)
+            run.append((item, False, settle))
+        elif touches_pc(item):
+            flush()
+            rv.append(access(item, register, 0))
+        elif SP in item and not shift(item):
+            # Anything else which mentions SP needs the register caught up.
+            run.append((item, False, True))
+        else:
+            run.append((item, False, False))
+
+    flush()
+    return rv
@@ -0,0 +1,360 @@
+"""
+A cycle-counting emulator for Notch's CPU.
+
+Only the parts of the CPU which Cauliflower actually emits are emulated: the
+basic opcodes, JSR, and every value form. Any other non-basic opcode,
+including the 0x0 word which the bootloaders end with, halts the CPU.
+"""
+
+from array import array
+import sys
+
+from cauliflower.assembler import (ADD, AND, BOR, DIV, IFB, IFE, IFG, IFN, JSR,
+                                   MOD, MUL, SET, SHL, SHR, SUB, XOR,
+                                   Data, Instruction, rdict, size)
+
+# Indices into the register file. The eight general-purpose registers come
+# first, in the same order as their value encodings.
+SP, PC, O = range(8, 11)
+
+# Kinds of locations that a value can resolve to.
+REGISTER, MEMORY, LITERAL = range(3)
+
+# The non-basic opcode for JSR.
+JSR_OPCODE = 0x1
+
+# Cycle costs of each opcode, not counting the cost of looking up values or
+# the extra cycle spent when a test fails.
+cycles = {
+    SET: 1,
+    ADD: 2,
+    SUB: 2,
+    MUL: 2,
+    DIV: 3,
+    MOD: 3,
+    SHL: 2,
+    SHR: 2,
+    AND: 1,
+    BOR: 1,
+    XOR: 1,
+    IFE: 2,
+    IFN: 2,
+    IFG: 2,
+    IFB: 2,
+}
+
+JSR_CYCLES = 2
+
+tests = {
+    IFE: lambda a, b: a == b,
+    IFN: lambda a, b: a != b,
+    IFG: lambda a, b: a > b,
+    IFB: lambda a, b: a & b != 0,
+}
+
+
+def value_size(code):
+    """
+    Return the number of trailing words required by an encoded value.
+    """
+
+    return 1 if 0x10 <= code < 0x18 or code in (0x1e, 0x1f) else 0
+
+
+# Next-word values are exactly the ones which cost a cycle to look up.
+value_cycles = value_size
+
+
+def instruction_size(word):
+    """
+    Return the total size, in words, of the instruction starting with the
+    given word.
+    """
+
+    if word & 0xf:
+        return 1 + value_size((word >> 4) & 0x3f) + value_size(word >> 10)
+    else:
+        return 1 + value_size(word >> 10)
+
+
+def instruction_cycles(word):
+    """
+    Return the number of cycles the instruction starting with the given word
+    costs, assuming that it is not a failing test.
+    """
+
+    op = word & 0xf
+    if op:
+        return (cycles[op] + value_cycles((word >> 4) & 0x3f) +
+                value_cycles(word >> 10))
+    else:
+        return JSR_CYCLES + value_cycles(word >> 10)
+
+
+def cost(code):
+    """
+    Return the size, in words, and the cycles of a sequence of instructions,
+    assuming that every instruction is executed once and no test fails.
+    """
+
+    words = size(code)
+    # Every trailing word costs a cycle to look up.
+    rv = words
+    for item in code:
+        if isinstance(item, Instruction):
+            rv -= 1
+            if item.op is JSR:
+                rv += JSR_CYCLES
+            else:
+                rv += cycles[item.op]
+        elif isinstance(item, Data):
+            rv -= 1
+    return words, rv
+
+
+class CPU(object):
+    """
+    The state of a CPU: memory, registers, and a running count of cycles.
+
+    When profiling, the number of times each address is called is kept in
+    the jumps dict. Calls are JSRs, and jumps to an absolute address, which is
+    how words are called and tail called without JSR. Branches within a word
+    are relative, and returns go through the stack, so neither counts.
+
+    A word which is tail called can be placed right after its caller, so that
+    the jump falls through to it. Given the addresses of the words, running
+    into one of them from the instruction before counts as a call, too.
+    """
+
+    def __init__(self, profile=False, entries=()):
+        self.memory = array("H", [0]) * 0x10000
+        self.registers = [0] * 11
+        self.cycles = 0
+        self.halted = False
+        self.jumps = {} if profile else None
+        self.entries = frozenset(entries) if profile else ()
+        # Whether the last instruction left PC alone.
+        self.falling = True
+
+
+    def jump(self, target):
+        """
+        Record a call.
+        """
+
+        self.jumps[target] = self.jumps.get(target, 0) + 1
+
+
+    def load(self, image, origin=0x0):
+        """
+        Copy a big-endian image into memory.
+        """
+
+        words = array("H", image)
+        if sys.byteorder == "little":
+            words.byteswap()
+        self.memory[origin:origin + len(words)] = words
+
+
+    def next_word(self):
+        """
+        Fetch the word at PC and advance PC.
+        """
+
+        pc = self.registers[PC]
+        self.registers[PC] = (pc + 1) & 0xffff
+        return self.memory[pc]
+
+
+    def value(self, code):
+        """
+        Resolve an encoded value to a location, consuming any trailing word
+        and charging the cost of looking it up.
+        """
+
+        registers = self.registers
+
+        if code < 0x8:
+            return REGISTER, code
+        elif code < 0x10:
+            return MEMORY, registers[code - 0x8]
+        elif code < 0x18:
+            self.cycles += 1
+            return MEMORY, (self.next_word() + registers[code - 0x10]) & 0xffff
+        elif code == 0x18:
+            # POP
+            sp = registers[SP]
+            registers[SP] = (sp + 1) & 0xffff
+            return MEMORY, sp
+        elif code == 0x19:
+            # PEEK
+            return MEMORY, registers[SP]
+        elif code == 0x1a:
+            # PUSH
+            registers[SP] = (registers[SP] - 1) & 0xffff
+            return MEMORY, registers[SP]
+        elif code == 0x1b:
+            return REGISTER, SP
+        elif code == 0x1c:
+            return REGISTER, PC
+        elif code == 0x1d:
+            return REGISTER, O
+        elif code == 0x1e:
+            self.cycles += 1
+            return MEMORY, self.next_word()
+        elif code == 0x1f:
+            self.cycles += 1
+            return LITERAL, self.next_word()
+        else:
+            return LITERAL, code - 0x20
+
+
+    def read(self, location):
+        kind, where = location
+        if kind == REGISTER:
+            return self.registers[where]
+        elif kind == MEMORY:
+            return self.memory[where]
+        else:
+            return where
+
+
+    def write(self, location, value):
+        kind, where = location
+        value &= 0xffff
+        if kind == REGISTER:
+            self.registers[where] = value
+            if where == PC:
+                self.falling = False
+        elif kind == MEMORY:
+            self.memory[where] = value
+        # Writes to literals silently fail.
+
+
+    def step(self):
+        """
+        Execute a single instruction.
+        """
+
+        registers = self.registers
+        if self.entries:
+            if self.falling and registers[PC] in self.entries:
+                self.jump(registers[PC])
+            self.falling = True
+        word = self.next_word()
+        op = word & 0xf
+
+        if not op:
+            if (word >> 4) & 0x3f != JSR_OPCODE:
+                # Illegal opcode. Leave PC pointing at it.
+                registers[PC] = (registers[PC] - 1) & 0xffff
+                self.halted = True
+                return
+
+            target = self.read(self.value(word >> 10))
+            registers[SP] = (registers[SP] - 1) & 0xffff
+            self.memory[registers[SP]] = registers[PC]
+            registers[PC] = target
+            self.falling = False
+            if self.jumps is not None:
+                self.jump(target)
+            self.cycles += JSR_CYCLES
+            return
+
+        a = self.value((word >> 4) & 0x3f)
+        b = self.value(word >> 10)
+        x = self.read(a)
+        y = self.read(b)
+        self.cycles += cycles[op]
+
+        if op in tests:
+            if not tests[op](x, y):
+                # Skip the next instruction, including its trailing words.
+                self.cycles += 1
+                pc = registers[PC]
+                pc += instruction_size(self.memory[pc])
+                registers[PC] = pc & 0xffff
+            return
+
+        if op == SET:
+            result = y
+        elif op == ADD:
+            result = x + y
+            registers[O] = result >> 16
+        elif op == SUB:
+            result = x - y
+            registers[O] = 0xffff if result < 0 else 0x0
+        elif op == MUL:
+            result = x * y
+            registers[O] = (result >> 16) & 0xffff
+        elif op == DIV:
+            if y:
+                result = x // y
+                registers[O] = ((x << 16) // y) & 0xffff
+            else:
+                result = registers[O] = 0x0
+        elif op == MOD:
+            result = x % y if y else 0x0
+        elif op == SHL:
+            result = x << y
+            registers[O] = (result >> 16) & 0xffff
+        elif op == SHR:
+            result = x >> y
+            registers[O] = ((x << 16) >> y) & 0xffff
+        elif op == AND:
+            result = x & y
+        elif op == BOR:
+            result = x | y
+        elif op == XOR:
+            result = x ^ y
+
+        if (self.jumps is not None and op == SET and a == (REGISTER, PC) and
+                b[0] == LITERAL):
+            self.jump(result & 0xffff)
+        self.write(a, result)
+
+
+    def run(self, limit=None):
+        """
+        Run until the CPU halts, and return the number of cycles spent.
+
+        If a limit is given, give up once that many cycles have been spent.
+        """
+
+        while not self.halted:
+            if limit is not None and self.cycles >= limit:
+                raise Exception("Didn't halt within %d cycles" % limit)
+            self.step()
+        return self.cycles
+
+
+    def register(self, register):
+        """
+        Return the contents of one of the assembler's general-purpose
+        registers.
+        """
+
+        return self.registers[rdict[register]]
+
+
+    def stack(self):
+        """
+        Return the contents of the stack, top first.
+        """
+
+        sp = self.registers[SP]
+        if not sp:
+            return []
+        return self.memory[sp:].tolist()
+
+
+def run(image, limit=None, profile=False, entries=()):
+    """
+    Load an image at the bottom of memory, run it from the start, and return
+    the halted CPU.
+    """
+
+    cpu = CPU(profile, entries)
+    cpu.load(image)
+    cpu.run(limit)
+    return cpu
@@ -0,0 +1,71 @@
+"""
+Constant folding.
+
+Arithmetic on literals is done at compile time, with the same sixteen-bit
+wraparound as the CPU. Whatever can't be folded entirely, like a literal
+followed by an operation on something already on the stack, is paired up into
+an Immediate, which compiles to a single instruction with the literal in it.
+"""
+
+from cauliflower.assembler import ADD, AND, BOR, DIV, MOD, MUL, SUB, XOR
+from cauliflower.builtins import Immediate, binops
+
+operations = {
+    ADD: lambda x, y: x + y,
+    SUB: lambda x, y: x - y,
+    MUL: lambda x, y: x * y,
+    # The CPU sets the result to zero on division by zero.
+    DIV: lambda x, y: x // y if y else 0x0,
+    MOD: lambda x, y: x % y if y else 0x0,
+    AND: lambda x, y: x & y,
+    BOR: lambda x, y: x | y,
+    XOR: lambda x, y: x ^ y,
+}
+
+
+def literal(word):
+    """
+    Return the value of a literal word, wrapped to sixteen bits, or None if
+    the word isn't a literal.
+    """
+
+    if not isinstance(word, str):
+        return None
+
+    try:
+        return int(word) & 0xffff
+    except ValueError:
+        return None
+
+
+def evaluate(op, x, y):
+    """
+    Apply a binary word to two values, as the CPU would.
+    """
+
+    return operations[binops[op]](x, y) & 0xffff
+
+
+def fold(words):
+    """
+    Fold the literal arithmetic in a list of words, returning a new list.
+    """
+
+    folded = []
+
+    for word in words:
+        if word in binops and folded:
+            y = literal(folded[-1])
+            if y is not None:
+                folded.pop()
+                word = Immediate(word, y)
+
+        if isinstance(word, Immediate) and folded:
+            x = literal(folded[-1])
+            if x is not None:
+                folded.pop()
+                word = str(evaluate(word.op, x, word.literal))
+
+        folded.append(word)
+
+    return folded
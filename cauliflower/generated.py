@@ -0,0 +1,12 @@
+"""
+Templates found by superoptimize.py, which beat the hand-written ones in
+builtins.
+
+This file is generated; run superoptimize.py to remake it.
+"""
+
+
+prims = {}
+
+
+tos_prims = {}
@@ -0,0 +1,196 @@
+"""
+Word-addressed memory images.
+
+An image is a growable array of words with a cursor, like a file that is
+addressed in words instead of bytes. Code is linked straight into it, words
+can be patched in place, and words which hold the address of something which
+isn't placed yet can be fixed up later.
+
+Words are kept in the host's byte order, and are only swapped to the CPU's
+big-endian order on the way out.
+"""
+
+from array import array
+import sys
+
+from cauliflower.assembler import encode_into, footprint, layout
+
+
+class View(object):
+    """
+    Some of the words of an image, without copying them.
+    """
+
+    def __init__(self, image, start, stop):
+        self.image = image
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        for address in range(self.start, self.stop):
+            yield self.image[address]
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError("View index %d out of range" % index)
+        return self.image[self.start + index]
+
+    def __setitem__(self, index, word):
+        if not 0 <= index < len(self):
+            raise IndexError("View index %d out of range" % index)
+        self.image[self.start + index] = word
+
+    def tostring(self):
+        return self.image.tostring(self.start, self.stop)
+
+
+class Image(object):
+    """
+    A word-addressed image of memory.
+    """
+
+    def __init__(self):
+        self.words = array("H")
+        self.position = 0
+        # One past the highest word written so far.
+        self.end = 0
+        # Addresses which should hold the address of a symbol.
+        self.fixups = []
+
+
+    def __len__(self):
+        return self.end
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.end)
+            if step != 1:
+                raise Exception("Can't take every %dth word of an image" %
+                                step)
+            return View(self, start, max(start, stop))
+        if not 0 <= index < self.end:
+            raise IndexError("Address 0x%x is outside of the image" % index)
+        return self.words[index]
+
+
+    def __setitem__(self, index, word):
+        if not 0 <= index < self.end:
+            raise IndexError("Address 0x%x is outside of the image" % index)
+        self.words[index] = word
+
+
+    def tell(self):
+        return self.position
+
+
+    def seek(self, address):
+        self.position = address
+
+
+    def reserve(self, end):
+        """
+        Make room for words up to the given address. Room is made in big
+        chunks, so that writing a word at a time doesn't copy the whole image
+        every time.
+        """
+
+        if end > len(self.words):
+            grow = max(end - len(self.words), len(self.words), 0x100)
+            self.words.extend(array("H", [0x0]) * grow)
+
+
+    def advance(self, end):
+        self.position = end
+        self.end = max(self.end, end)
+
+
+    def write(self, words):
+        """
+        Write some words at the cursor, and move past them.
+        """
+
+        if not isinstance(words, array):
+            words = array("H", words)
+        end = self.position + len(words)
+        self.reserve(end)
+        self.words[self.position:end] = words
+        self.advance(end)
+
+
+    def emit(self, code, symbols={}):
+        """
+        Link some code in place at the cursor, and move past it.
+
+        Returns the addresses of the labels in the code.
+        """
+
+        labels, short = layout(code, self.position, symbols)
+        table = dict(symbols)
+        table.update(labels)
+        end = (self.position + sum(footprint(item) for item in code) -
+               len(short))
+        self.reserve(end)
+        encode_into(self.words, self.position, code, table, short)
+        self.advance(end)
+        return labels
+
+
+    def fixup(self, address, name):
+        """
+        Fill in a word with the address of a symbol, once it's known.
+        """
+
+        self.fixups.append((address, name))
+
+
+    def resolve(self, symbols):
+        """
+        Fill in every fixup with the address of its symbol.
+        """
+
+        for address, name in self.fixups:
+            if name not in symbols:
+                raise Exception("Couldn't resolve symbol %s" % name)
+            self[address] = symbols[name]
+        self.fixups = []
+
+
+    def swap(self):
+        """
+        Swap the words between the host's byte order and the CPU's.
+        """
+
+        if sys.byteorder == "little":
+            self.words.byteswap()
+
+
+    def tostring(self, start=0, stop=None):
+        """
+        Return some of the image as a str, in the CPU's byte order.
+        """
+
+        if stop is None:
+            stop = self.end
+        rv = self.words[start:stop]
+        if sys.byteorder == "little":
+            rv.byteswap()
+        return rv.tostring()
+
+
+    def tofile(self, f):
+        """
+        Write the image to an open file, or an mmap, in the CPU's byte order.
+
+        The words are swapped in place and written straight from the array,
+        rather than copied into a str first.
+        """
+
+        self.swap()
+        try:
+            f.write(buffer(self.words, 0, self.end * 2))
+        finally:
+            self.swap()
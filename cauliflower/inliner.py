@@ -0,0 +1,158 @@
+"""
+Decide where to inline words.
+
+Every call site is decided on its own. Inlining a word at a site saves a call
+and a return every time the site runs, and costs however many words bigger
+than a call the word's body is. Sites are weighted by how often the word they
+sit in is called, either as guessed from the source or as measured by the
+emulator, and the total growth of the image is held to a budget.
+"""
+
+from cauliflower.assembler import Symbol, size
+from cauliflower.control import call, ret
+from cauliflower.emulator import cost
+from cauliflower.reader import Do, If, Until, While
+
+# How many times a loop is guessed to go around.
+iterations = 0x10
+
+
+def mentions(words, times=1):
+    """
+    Yield every word in a body, including the words inside if statements and
+    loops, along with how many times it runs each time the body does.
+    """
+
+    for word in words:
+        if isinstance(word, (If, Until, While, Do)):
+            inner = times if isinstance(word, If) else times * iterations
+            for part in word:
+                if part is None:
+                    continue
+                for mention in mentions(part, inner):
+                    yield mention
+        else:
+            yield word, times
+
+
+def static_counts(definitions, entry="main"):
+    """
+    Guess how many times each word is called, by counting how many times it
+    is mentioned by the words which call it, starting from a single call to
+    the entry point.
+
+    The definitions are (name, words) pairs, in order, with every word
+    defined before it is used. Branches are assumed to always be taken, and
+    loops to go around a fixed number of times.
+    """
+
+    names = set(name for name, words in definitions)
+    counts = dict.fromkeys(names, 0)
+    counts[entry] = 1
+    for name, words in reversed(definitions):
+        for word, times in mentions(words):
+            if word in names:
+                counts[word] += counts[name] * times
+    return counts
+
+
+def load_profile(f):
+    """
+    Read a profile, as written by emulate.py, into a dict of call counts.
+    """
+
+    counts = {}
+    for line in f:
+        name, count = line.split()
+        counts[name] = int(count)
+    return counts
+
+
+class Inliner(object):
+    """
+    A cost model for inlining, and a record of every decision it made.
+    """
+
+    def __init__(self, counts, budget, ratio=1, tos=False, jsr=False):
+        self.counts = counts
+        self.budget = budget
+        # The fewest cycles that inlining has to save per word of growth.
+        self.ratio = ratio
+        self.growth = 0
+        self.decisions = []
+        self.called = set()
+        # Every decision that came down to the budget, as how much the image
+        # would have grown by and whether the word was inlined.
+        self.checks = []
+
+        site = call(Symbol(None), tos, jsr)
+        self.call_size = size(site)
+        self.overhead = cost(site + ret(tos, jsr))[1]
+
+
+    def weight(self, name, parent=None):
+        """
+        Return how many times a word is called. Words which aren't in the
+        counts, like the bodies of if statements, can borrow the count of
+        the word they are part of.
+        """
+
+        if name in self.counts:
+            return self.counts[name]
+        return self.counts.get(parent, 0)
+
+
+    def decide(self, caller, callee, body, weight):
+        """
+        Decide whether to inline a word's body at a call site which runs the
+        given number of times.
+        """
+
+        growth = size(body) - self.call_size
+        saved = weight * self.overhead
+
+        if growth <= 0:
+            inline, reason = True, "smaller than a call"
+        elif not weight:
+            inline, reason = False, "never called"
+        elif saved < growth * self.ratio:
+            inline, reason = False, "too cold for its size"
+        else:
+            inline = self.growth + growth <= self.budget
+            self.checks.append((self.growth + growth, inline))
+            if inline:
+                reason = "saves %d cycles for %d words" % (saved, growth)
+            else:
+                reason = "over budget"
+
+        if inline:
+            self.growth += growth
+        else:
+            self.called.add(callee)
+
+        self.decisions.append((caller, callee, inline, reason))
+        return inline
+
+
+    def agrees(self, checks, start=0):
+        """
+        Whether decisions that came down to the budget, made when the image
+        had grown by start words, would go the same way now.
+        """
+
+        return all((total - start + self.growth <= self.budget) == inline
+                   for total, inline in checks)
+
+
+    def report(self):
+        """
+        Describe every decision, and how much of the budget was spent.
+        """
+
+        for caller, callee, inline, reason in self.decisions:
+            if inline:
+                yield "Inlined %s into %s: %s" % (callee, caller, reason)
+            else:
+                yield "Called %s from %s: %s" % (callee, caller, reason)
+        yield "Inlining grew the image by %d words, with a budget of %d" % (
+            self.growth, self.budget)
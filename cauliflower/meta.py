@@ -1,10 +1,10 @@
 """
 The metainterpreter and metabuiltins.
 
-ucode += assemble(SUB, X, ord("0"))
-ucode += assemble(ADD, C, X)
-ucode += assemble(ADD, A, 0x1)
-ucode += assemble(SUB, B, 0x1)
+ucode.append(Instruction(SUB, X, ord("0")))
+ucode.append(Instruction(ADD, C, X))
+ucode.append(Instruction(ADD, A, 0x1))
+ucode.append(Instruction(SUB, B, 0x1))
 ucode = until(ucode, (IFE, B, 0x0))
 ma.prim("snumber", preamble + ucode)
 There are seven Forth registers: W, IP, PSP, RSP, X, UP, and TOS. They are
@@ -21,36 +21,59 @@ To start the metainterpreter, set RSP to point to a safe area of return stack,
 put the address of QUIT into IP, and then call IP.
 """
 
-from StringIO import StringIO
-from struct import pack
+from cStringIO import StringIO
+from glob import glob
+from mmap import ACCESS_READ, mmap
+import os
+from stat import S_ISDIR
+from struct import pack, unpack
 
 from cauliflower.assembler import (A, ADD, AND, B, BOR, C, I, IFE, IFN, J,
                                    MUL, PEEK, PC, POP, PUSH, SET, SP, SUB, X,
-                                   XOR, Y, Z, Absolute, assemble, call, until)
+                                   XOR, Y, Z, Absolute, Data, Distance,
+                                   Instruction, Label, Symbol, call, local,
+                                   relabel, until)
+from cauliflower.cache import dump, fingerprint, load
+from cauliflower.image import Image
 from cauliflower.utilities import library, read, write
 
 
-class EvenStringIO(StringIO):
-    def seek(self, value, *args, **kwargs):
-        StringIO.seek(self, value * 2, *args, **kwargs)
+IMMEDIATE = 0x4000
+HIDDEN = 0x8000
 
-    def tell(self):
-        rv = StringIO.tell(self)
-        if rv % 2:
-            raise Exception("Offset %d is odd!" % rv)
-        return rv // 2
+# Ways of threading words together. Indirect threads jump to a shared NEXT
+# after every word, direct threads have a copy of NEXT in every assembly word,
+# and subroutine threads are machine code which calls each word in turn.
+models = "indirect", "direct", "subroutine"
 
+# Words which move IP by the offset which follows them.
+branches = "branch", "0branch", "nbranch", "0nbranch"
 
-IMMEDIATE = 0x4000
-HIDDEN = 0x8000
+# Bumped whenever the layout of a saved core changes.
+version = 1
+
+# Everything that goes into building a core.
+SOURCES = glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "*.py"))
+
+
+def hash_name(name):
+    """
+    Hash the name of a word, the same way that word does as it reads it.
+    """
+
+    rv = 0x0
+    for c in name:
+        rv = (rv * 0x1f + ord(c)) & 0xffff
+    return rv
 
 
 def PUSHRSP(register):
     """
     Push onto RSP.
     """
-    ucode = assemble(SUB, Y, 0x1)
-    ucode += assemble(SET, [Y], register)
+    ucode = [Instruction(SUB, Y, 0x1)]
+    ucode.append(Instruction(SET, [Y], register))
     return ucode
 
 
@@ -58,8 +81,8 @@ def POPRSP(register):
     """
     Pop from RSP.
     """
-    ucode = assemble(SET, register, [Y])
-    ucode += assemble(ADD, Y, 0x1)
+    ucode = [Instruction(SET, register, [Y])]
+    ucode.append(Instruction(ADD, Y, 0x1))
     return ucode
 
 
@@ -67,8 +90,8 @@ def _push(register):
     """
     Push onto the stack, manipulating both TOS and PSP.
     """
-    ucode = assemble(SET, PUSH, Z)
-    ucode += assemble(SET, Z, register)
+    ucode = [Instruction(SET, PUSH, Z)]
+    ucode.append(Instruction(SET, Z, register))
     return ucode
 
 
@@ -76,8 +99,8 @@ def _pop(register):
     """
     Pop off the stack, manipulating both TOS and PSP.
     """
-    ucode = assemble(SET, register, Z)
-    ucode += assemble(SET, Z, POP)
+    ucode = [Instruction(SET, register, Z)]
+    ucode.append(Instruction(SET, Z, POP))
     return ucode
 
 
@@ -93,89 +116,213 @@ class MetaAssembler(object):
     # Workspace address.
     workspace = 0x7000
 
+    # Number of chains in the dictionary's hash table. This needs to be a
+    # power of two.
+    buckets = 0x20
+
+    # Whether to say what's being written into the core as it's written.
+    verbose = False
+
+
+    def __init__(self, model="indirect"):
+        if model not in models:
+            raise Exception("Unknown threading model %r" % model)
+        self.model = model
 
-    def __init__(self):
         # Hold codewords for threads as we store them.
         self.asmwords = {}
         self.codewords = {}
         self.datawords = {}
+        # And the bodies of assembly words, for inlining.
+        self.asmcode = {}
+
+        # Library routines, as they're referenced.
+        self.library = {}
 
         # Initialize the space.
-        self.space = EvenStringIO()
+        self.space = Image()
         self.bootloader()
 
-        self.lib()
-
 
     def bootloader(self):
         """
         Set up the bootloader.
         """
 
-        self.space.write(assemble(SET, Y, 0xd000))
-        self.space.write(assemble(SET, J, 0x5))
-        self.space.write(assemble(SET, PC, [J]))
-
-        # Allocate space for the address of QUIT.
-        self.space.write("\x00\x00")
+        # Allocate space for the address of QUIT, right after the jump
+        # through it. It's filled in once QUIT exists.
+        labels = self.emit([
+            Instruction(SET, Y, 0xd000),
+            Instruction(SET, J, Symbol("quit")),
+            Instruction(SET, PC, [J]),
+            Label("quit"),
+            Data(0x0),
+        ])
+        self.space.fixup(labels["quit"], "quit")
 
         # Allocate space for STATE.
         self.STATE = self.space.tell()
-        self.space.write("\x00\x00")
+        self.space.write([0x0])
 
         # And HERE.
         self.HERE = self.space.tell()
-        self.space.write("\x00\x00")
+        self.space.write([0x0])
 
         # And LATEST, too.
         self.LATEST = self.space.tell()
-        self.space.write("\x00\x00")
+        self.space.write([0x0])
 
         # Don't forget FB.
         self.FB = self.space.tell()
-        self.space.write("\x80\x00")
+        self.space.write([0x8000])
 
         # NEXT. Increment IP and move through it.
-        ucode = assemble(ADD, J, 0x1)
-        ucode += assemble(SET, PC, [J])
+        ucode = [Instruction(ADD, J, 0x1)]
+        ucode.append(Instruction(SET, PC, [J]))
         self.prim("next", ucode)
 
         # EXIT. Pop RSP into IP and then call NEXT.
         ucode = POPRSP(J)
-        ucode += assemble(SET, PC, self.asmwords["next"])
+        ucode += self.next()
         self.prim("exit", ucode)
 
         # ENTER. Save IP to RSP, dereference IP to find the caller, enter the
         # new word, call NEXT.
         ucode = PUSHRSP(J)
-        ucode += assemble(SET, J, [J])
-        ucode += assemble(SET, PC, self.asmwords["next"])
+        ucode.append(Instruction(SET, J, [J]))
+        ucode += self.next()
         self.prim("enter", ucode)
 
+        # The hash of the last word read, and the hash table. These go after
+        # ENTER, which has to stay close enough to be a codeword.
+        self.HASH = self.space.tell()
+        self.space.write([0x0])
+        self.BUCKETS = self.space.tell()
+        self.space.write([0x0] * self.buckets)
 
-    def lib(self):
-        self.library = {}
-        for name in library:
-            print "Adding library function", name
+
+    def lib(self, name):
+        """
+        Return the address of a library routine, writing it into the core the
+        first time that it's referenced.
+        """
+
+        if name not in self.library:
+            if self.verbose:
+                print "Adding library function", name
             self.library[name] = self.space.tell()
-            self.space.write(library[name]())
+            self.emit(library[name]())
+        return self.library[name]
+
+
+    def save(self, f, source=None):
+        """
+        Write the core to an open file, along with a digest of the source it
+        was built from.
+
+        The symbol tables and the rest of the assembler are pickled into a
+        header, and the image follows it as raw words, so that it can be read
+        back without unpickling it.
+        """
+
+        state = dict(self.__dict__)
+        space = state.pop("space")
+        header = StringIO()
+        dump((version, source, state,
+              (space.position, space.end, space.fixups)), header)
+        header = header.getvalue()
+        f.write(pack("<I", len(header)))
+        f.write(header)
+        f.write(buffer(space.words, 0, space.end * 2))
+
+
+    @classmethod
+    def read(cls, path, source=None):
+        """
+        Read a core from a file, or return None if it was built from some
+        other source, or can't be read.
+
+        The file is mapped rather than read, and the image is only copied out
+        of the map once the header has been checked. The header is pickled,
+        so the file should be somewhere that nobody else can write to.
+        """
+
+        try:
+            with open(path, "rb") as f:
+                mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            # Missing, or empty, which can't be mapped.
+            return None
+        try:
+            length, = unpack("<I", mapped[:4])
+            saved, built, state, (position, end, fixups) = load(
+                StringIO(mapped[4:4 + length]))
+            if saved != version or built != source:
+                return None
+            words = mapped[4 + length:4 + length + end * 2]
+            if len(words) != end * 2:
+                return None
+            rv = cls.__new__(cls)
+            rv.__dict__.update(state)
+            rv.space = Image()
+            rv.space.words.fromstring(words)
+            rv.space.position = position
+            rv.space.end = end
+            rv.space.fixups = fixups
+            return rv
+        except Exception:
+            # A damaged file can fail to unpickle in any number of ways, and
+            # is just as out of date as one from other source.
+            return None
+        finally:
+            mapped.close()
 
 
     def finalize(self):
         # Write HERE and LATEST.
-        location = self.space.tell()
-        here = pack(">H", location)
-        latest = pack(">H", self.previous)
-        self.space.seek(self.HERE)
-        self.space.write(here)
-        self.space.seek(self.LATEST)
-        self.space.write(latest)
+        self.space[self.HERE] = self.space.tell()
+        self.space[self.LATEST] = self.previous
+
+        # And the address of QUIT, for the bootloader.
+        self.space.resolve(self.codewords)
+
+
+    def emit(self, code):
+        """
+        Link some code in place at the current location and write it into the
+        core. Returns the addresses of the labels in the code.
+        """
+
+        return self.space.emit(code)
+
 
-        self.space.seek(0x5)
-        self.space.write(pack(">H", self.codewords["quit"]))
+    def next(self):
+        """
+        Return the code which ends a word by moving on to the next one.
+
+        Indirect threads jump to NEXT; the other models have a copy of it at
+        the end of every word instead.
+        """
+
+        if self.model == "indirect":
+            return [Instruction(SET, PC, self.asmwords["next"])]
+        return [Instruction(ADD, J, 0x1), Instruction(SET, PC, [J])]
+
+
+    def call(self, target):
+        """
+        Return the code which calls a subroutine-threaded word.
 
-        # Reset file pointer.
-        self.space.seek(location)
+        The return address goes on RSP rather than the stack, since PSP is the
+        stack. The word returns through RSP, and the caller pops it.
+        """
+
+        back = local()
+        ucode = PUSHRSP(Symbol(back))
+        ucode.append(Instruction(SET, PC, target))
+        ucode.append(Label(back))
+        ucode.append(Instruction(ADD, Y, 0x1))
+        return ucode
 
 
     def prim(self, name, ucode):
@@ -184,33 +331,45 @@ class MetaAssembler(object):
         """
 
         self.asmwords[name] = self.space.tell()
-        self.space.write(ucode)
+        self.emit(ucode)
 
 
     def create(self, name, flags):
         """
         Write a header into the core and update the previous header marker.
+
+        Each header is chained onto the front of its bucket in the hash
+        table, by a link just before it:
+
+        |link|prev|len |name|
         """
 
+        bucket = self.BUCKETS + (hash_name(name) & (self.buckets - 1))
+        link = self.space.tell()
+        self.space.write([self.space[bucket]])
+        self.space[bucket] = link
+
         location = self.space.tell()
         self.datawords[name] = location
 
-        print "Creating data word", name, "at 0x%x" % location
+        if self.verbose:
+            print "Creating data word", name, "at 0x%x" % location
 
         length = len(name)
         if flags:
             length |= flags
-        header = pack(">HH", self.previous, length)
+        header = [self.previous, length]
 
         # Swap locations.
         self.previous = location
 
         self.space.write(header)
-        self.space.write(name.encode("utf-16-be"))
+        self.space.write([ord(c) for c in name])
 
         location = self.space.tell()
 
-        print "Creating code word", name, "at 0x%x" % location
+        if self.verbose:
+            print "Creating code word", name, "at 0x%x" % location
 
         self.codewords[name] = location
 
@@ -222,13 +381,20 @@ class MetaAssembler(object):
         Here's what the word looks like:
 
         |prev|len |name|asm |NEXT|
+
+        Subroutine-threaded words return through RSP instead of ending with
+        NEXT.
         """
 
-        print "Adding assembly word %s" % name
+        if self.verbose:
+            print "Adding assembly word %s" % name
 
         self.create(name, flags)
-        self.space.write(ucode)
-        self.space.write(assemble(SET, PC, self.asmwords["next"]))
+        self.asmcode[name] = ucode
+        if self.model == "subroutine":
+            self.emit(ucode + [Instruction(SET, PC, [Y])])
+        else:
+            self.emit(ucode + self.next())
 
 
     def thread(self, name, words, flags=None):
@@ -238,332 +404,507 @@ class MetaAssembler(object):
         Here's what a thread looks like:
 
         |prev|len |name|ENTER|word|EXIT|
+
+        Subroutine threads are compiled to machine code instead.
         """
 
-        print "Adding Forth thread %s" % name
+        if self.verbose:
+            print "Adding Forth thread %s" % name
 
         self.create(name, flags)
-        # ENTER/DOCOL bytecode.
-        ucode = assemble(SET, PC, self.asmwords["enter"])
-        self.space.write(ucode)
+        if self.model == "subroutine":
+            self.emit(self.subroutine(words))
+            return
+
+        # ENTER/DOCOL bytecode. ENTER starts IP on the codeword, so the
+        # codeword has to fit in a single word.
+        ucode = [Instruction(SET, PC, self.asmwords["enter"])]
+        if self.asmwords["enter"] > 0x1f:
+            raise Exception("ENTER is too far away to be a codeword")
         for word in words:
             if isinstance(word, int):
-                self.space.write(pack(">H", word))
+                ucode.append(Data(word))
             elif word in self.codewords:
-                self.space.write(pack(">H", self.codewords[word]))
+                ucode.append(Data(self.codewords[word]))
             else:
                 raise Exception("Can't reference unknown word %r" % word)
-        self.space.write(pack(">H", self.asmwords["exit"]))
-
-
-ma = MetaAssembler()
-
-# Deep primitives.
-
-ma.prim("read", read(A))
-ma.prim("write", write(A))
-
-# Top of the line: Go back to the beginning of the string.
-ucode = assemble(SET, B, 0x0)
-ucode += assemble(SET, C, ma.workspace)
-# Read a character into A.
-ucode += call(ma.asmwords["read"])
-ucode += assemble(SET, [C], A)
-ucode += assemble(ADD, B, 0x1)
-ucode += assemble(ADD, C, 0x1)
-# If it's a space, then we're done. Otherwise, go back to reading things from
-# the keyboard.
-ucode = until(ucode, (IFN, 0x20, [C]))
-ucode += assemble(SET, C, ma.workspace)
-ma.prim("word", ucode)
-
-preamble = assemble(SET, C, 0x0)
-ucode = assemble(MUL, C, 10)
-ucode += assemble(SET, X, [A])
-ucode += assemble(SUB, X, ord("0"))
-ucode += assemble(ADD, C, X)
-ucode += assemble(ADD, A, 0x1)
-ucode += assemble(SUB, B, 0x1)
-ucode = until(ucode, (IFE, B, 0x0))
-ma.prim("snumber", preamble + ucode)
-
-# Compiling words.
-
-ucode = _push([J])
-ucode += assemble(ADD, J, 0x1)
-ma.asm("literal", ucode)
-ma.asm("'", ucode)
-
-ucode = assemble(SET, PC, Z)
-ma.asm("call", ucode)
-
-# Low-level memory manipulation.
-
-ucode = assemble(SET, [Z], PEEK)
-# Move the stack back, and then pop the next word into TOS.
-ucode += assemble(ADD, SP, 0x1)
-ucode += _pop(Z)
-ma.asm("!", ucode)
+        ucode.append(Data(self.asmwords["exit"]))
+        self.emit(ucode)
 
-# TOS lets us cheat hard.
-ucode = assemble(SET, Z, [Z])
-ma.asm("@", ucode)
 
-ucode = assemble(ADD, [Z], PEEK)
-# Move the stack back, and then pop the next word into TOS.
-ucode += assemble(ADD, SP, 0x1)
-ucode += _pop(Z)
-ma.asm("+!", ucode)
-
-ucode = assemble(SUB, [Z], PEEK)
-# Move the stack back, and then pop the next word into TOS.
-ucode += assemble(ADD, SP, 0x1)
-ucode += _pop(Z)
-ma.asm("-!", ucode)
-
-# Low-level branching.
-
-ucode = assemble(ADD, J, [J + 0x1])
-ma.asm("branch", ucode)
+    def subroutine(self, words):
+        """
+        Compile a thread of words into subroutine-threaded machine code.
 
-# Ugh.
-ucode = assemble(IFN, Z, 0x0)
-ucode += assemble(ADD, J, [J + 0x1])
-ucode += assemble(IFE, Z, 0x0)
-ucode += assemble(ADD, J, 0x1)
-ma.asm("0branch", ucode)
+        Assembly words are copied in place and everything else is called.
+        Words which read IP are replaced: literals are pushed directly, and
+        branches become jumps to the words that they would have landed on.
+        """
 
-# Goddammit DCPU!
-ucode = assemble(SUB, J, [J + 0x1])
-ma.asm("nbranch", ucode)
+        # Find where every branch lands, and give each of those words a
+        # label. The cells after literals and branches aren't words.
+        data = set()
+        jumps = {}
+        for i, word in enumerate(words):
+            if word in ("literal", "'"):
+                data.add(i + 1)
+            elif word in branches:
+                data.add(i + 1)
+                if word.endswith("nbranch"):
+                    jumps[i] = i + 1 - words[i + 1]
+                else:
+                    jumps[i] = i + 1 + words[i + 1]
+        targets = {}
+        for i, target in jumps.items():
+            if target in data or not 0 <= target <= len(words):
+                raise Exception("Branch at %d doesn't land on a word" % i)
+            targets.setdefault(target, local())
+
+        ucode = []
+        for i, word in enumerate(words):
+            if i in targets:
+                ucode.append(Label(targets[i]))
+            if i in data:
+                continue
+            if word in ("literal", "'"):
+                ucode += _push(words[i + 1])
+            elif word in branches:
+                if word.startswith("0"):
+                    ucode.append(Instruction(IFN, Z, 0x0))
+                ucode.append(Instruction(SET, PC, Symbol(targets[jumps[i]])))
+            elif word == "call":
+                ucode += self.call(Z)
+            elif word in self.asmcode:
+                ucode += relabel(self.asmcode[word])
+            elif word in self.codewords:
+                ucode += self.call(self.codewords[word])
+            else:
+                raise Exception("Can't reference unknown word %r" % word)
+        if len(words) in targets:
+            ucode.append(Label(targets[len(words)]))
+        ucode.append(Instruction(SET, PC, [Y]))
+        return ucode
 
-ucode = assemble(IFN, Z, 0x0)
-ucode += assemble(SUB, J, [J + 0x1])
-ucode += assemble(IFE, Z, 0x0)
-ucode += assemble(ADD, J, 0x1)
-ma.asm("0nbranch", ucode)
 
-# Low-level tests.
+def IF(then, otherwise=[]):
+    """
+    Branch around some words.
 
-# I bet there's a trick to this. I'll revisit this later.
-ucode = assemble(IFN, J, 0x0)
-ucode += assemble(SET, A, 0x1)
-ucode += assemble(IFE, J, 0x0)
-ucode += assemble(SET, A, 0x0)
-ucode += assemble(SET, J, A)
-ma.asm("0=", ucode)
+    A branch moves IP by its offset, and then NEXT moves it one more, so the
+    offset is one less than the distance from the branch to its target.
+    """
 
-def IF(then, otherwise=[]):
     if otherwise:
-        then += ["branch", len(otherwise)]
-    return ["0=", "0branch", len(then)] + then + otherwise
+        then = then + ["branch", len(otherwise) + 1]
+    return ["0=", "0branch", len(then) + 1] + then + otherwise
 
 def UNTIL(loop):
-    return loop + ["0nbranch", len(loop)]
-
-# Main stack manipulation.
-
-ucode = assemble(SET, PUSH, Z)
-ma.asm("dup", ucode)
-
-# Return stack manipulation.
-
-ucode = _push(0xd000)
-ma.asm("r0", ucode)
-
-ucode = _push(Y)
-ma.asm("rsp@", ucode)
-
-ucode = _pop(Y)
-ma.asm("rsp!", ucode)
-
-ucode = _push([Y])
-ucode += assemble(ADD, Y, 0x1)
-ma.asm("r>", ucode)
-
-ucode = assemble(SUB, Y, 0x1)
-ucode += _pop([Y])
-ma.asm(">r", ucode)
-
-ucode = _push([Y])
-ma.asm("r@", ucode)
+    return loop + ["0nbranch", len(loop) + 1]
 
-ucode = _pop([Y])
-ma.asm("r!", ucode)
 
-ucode = assemble(ADD, Y, 0x1)
-ma.asm("rdrop", ucode)
-
-# Arithmetic.
-
-ucode = assemble(ADD, Z, POP)
-ma.asm("+", ucode)
-
-# Low-level input.
-
-ucode = assemble(SET, PUSH, Z)
-ucode += assemble(SET, A, Z)
-ucode += call(ma.asmwords["word"])
-ma.asm("key", ucode)
-
-# High-level input.
-
-ucode = call(ma.asmwords["word"])
-ucode += _push(B)
-ucode += _push(C)
-ma.asm("word", ucode)
-
-ucode = _pop(A)
-ucode += _pop(B)
-ucode += call(ma.asmwords["snumber"])
-ucode += _push(C)
-ma.asm("snumber", ucode)
-
-# Output.
-
-ucode = assemble(SET, A, [ma.FB])
-ucode += _pop([A])
-ucode += assemble(ADD, [ma.FB], 0x1)
-ma.asm("emit", ucode)
-
-# Global access.
-
-# This could be done in Forth, but it's so small in assembly!
-ucode = _pop([ma.HERE])
-ucode += assemble(ADD, [ma.HERE], 0x1)
-ma.asm(",", ucode)
-
-ucode = assemble(SET, [ma.STATE], 0x0)
-ma.asm("[", ucode)
-
-ucode = assemble(SET, [ma.STATE], 0x1)
-ma.asm("]", ucode)
-
-ucode = _push([ma.LATEST])
-ma.asm("latest", ucode)
-
-# Compiler stuff.
-
-ucode = call(ma.asmwords["read"])
-ucode += _push([C])
-ma.asm("char", ucode)
+def core(model="indirect", verbose=False):
+    """
+    Build the core, using one of the threading models.
+    """
 
-# Pop the target address (below TOS) into a working register. Leave length on
-# TOS.
-preamble = assemble(SET, A, POP)
-# Use B as our linked list pointer.
-preamble += assemble(SET, B, ma.LATEST)
-# Top of the loop. Dereference B to move along the list.
-ucode = assemble(SET, B, [B])
-# Compare lengths; if they don't match, go to the next one.
-ucode = until(ucode, (IFN, [B + 0x1], Z))
-# memcmp() the strings.
-ucode += assemble(ADD, B, 0x1)
-ucode += assemble(SET, C, A)
-ucode += assemble(SET, A, Z)
-ucode += call(ma.library["memcmp"])
-ucode += assemble(SUB, B, 0x1)
-# If it succeeded, push the address back onto the stack and then jump out.
-ucode += assemble(IFN, A, 0x0)
-ucode += assemble(SET, Z, B)
-ucode += assemble(IFN, A, 0x0)
-ucode += assemble(ADD, PC, 0x4)
-# Loop until we hit NULL.
-ucode = until(ucode, (IFE, B, 0x0))
-# We finished the loop and couldn't find anything. Guess we'll just set Z to
-# 0x0 and exit.
-ucode += assemble(SET, Z, 0x0)
-ma.asm("find", preamble + ucode)
-
-ma.thread("+1", ["literal", 0x1, "+"])
-
-ma.thread(">cfa", ["+1", "dup", "@", "+", "+1"])
-
-# Grab HERE. It's going to live in A for a bit.
-preamble = assemble(SET, A, [ma.HERE])
-# Write LATEST to HERE, update LATEST.
-preamble += assemble(SET, [A], [ma.LATEST])
-preamble += assemble(SET, [ma.LATEST], A)
-# Move ahead, write length.
-preamble += assemble(ADD, A, 0x1)
-preamble += assemble(SET, [A], Z)
-# Set the hidden flag.
-preamble += assemble(BOR, [A], HIDDEN)
-# SP is nerfed, so grab the source address and put it in B.
-preamble += assemble(SET, B, PEEK)
-# Loop. Copy from the source address to the target address.
-ucode = assemble(SUB, Z, 0x1)
-ucode += assemble(SET, [A], [B])
-ucode += assemble(ADD, A, 0x1)
-ucode += assemble(ADD, B, 0x1)
-# Break when we have no more bytes to copy.
-ucode = until(ucode, (IFE, Z, 0x0))
-# Write out the new HERE.
-ucode += assemble(SET, [ma.HERE], A)
-# Get the stack to be sane again. Shift it down and then pop, same as 2drop.
-ucode += assemble(ADD, SP, 0x1)
-ucode += assemble(SET, Z, POP)
-ma.asm("create", preamble + ucode)
-
-# The stack points to the top of the header. Move forward one...
-ucode = assemble(ADD, Z, 0x1)
-# Now XOR in the hidden flag.
-ucode += assemble(XOR, [Z], HIDDEN)
-# And pop the stack.
-ucode += assemble(SET, Z, POP)
-ma.asm("hidden", ucode)
-
-# We get to grab LATEST ourselves. On the plus side, no stack touching.
-ucode = assemble(SET, A, ma.LATEST)
-# XOR that flag!
-ucode += assemble(XOR, [A + 0x1], IMMEDIATE)
-ma.asm("immediate", ucode)
-
-ucode = assemble(AND, Z, IMMEDIATE)
-ma.asm("immediate?", ucode)
-
-ma.thread(":", [
-    "word",
-    "create",
-    "literal", ma.asmwords["enter"],
-    ",",
-    "latest",
-    "@",
-    "hidden",
-    "]",
-])
-
-ma.thread(";", [
-    "literal", ma.asmwords["exit"],
-    ",",
-    "latest",
-    "@",
-    "hidden",
-    "[",
-], flags=IMMEDIATE)
-
-ma.thread("interpret-found", [
-    "dup",
-    "+1",
-    "immediate?",
-    ] + IF([
-        ">cfa",
-        "call",
-    ], [
-        ">cfa",
+    ma = MetaAssembler(model)
+    ma.verbose = verbose
+
+    # Deep primitives.
+
+    ma.prim("read", read(A))
+    ma.prim("write", write(A))
+
+    # Top of the line: Go back to the beginning of the string, and start
+    # the hash over.
+    preamble = [Instruction(SET, B, 0x0)]
+    preamble.append(Instruction(SET, C, ma.workspace))
+    preamble.append(Instruction(SET, X, 0x0))
+    # Read a character into A. If it's a space, then we're done.
+    here = local()
+    done = local()
+    ucode = call(ma.asmwords["read"])
+    ucode.append(Instruction(IFE, A, 0x20))
+    ucode.append(Instruction(ADD, PC, Distance(here, done)))
+    ucode.append(Label(here))
+    ucode.append(Instruction(SET, [C], A))
+    ucode.append(Instruction(ADD, B, 0x1))
+    ucode.append(Instruction(ADD, C, 0x1))
+    # Hash it in. This has to match hash_name().
+    ucode.append(Instruction(MUL, X, 0x1f))
+    ucode.append(Instruction(ADD, X, A))
+    # Otherwise, go back to reading things from the keyboard.
+    ucode = until(ucode, (IFN, A, 0x20))
+    ucode.append(Label(done))
+    ucode.append(Instruction(SET, [ma.HASH], X))
+    ucode.append(Instruction(SET, C, ma.workspace))
+    ma.prim("word", preamble + ucode)
+
+    preamble = [Instruction(SET, C, 0x0)]
+    ucode = [Instruction(MUL, C, 10)]
+    ucode.append(Instruction(SET, X, [A]))
+    ucode.append(Instruction(SUB, X, ord("0")))
+    ucode.append(Instruction(ADD, C, X))
+    ucode.append(Instruction(ADD, A, 0x1))
+    ucode.append(Instruction(SUB, B, 0x1))
+    ucode = until(ucode, (IFE, B, 0x0))
+    ma.prim("snumber", preamble + ucode)
+
+    # Compiling words.
+
+    ucode = _push([J + 0x1])
+    ucode.append(Instruction(ADD, J, 0x1))
+    ma.asm("literal", ucode)
+    ma.asm("'", ucode)
+
+    ucode = [Instruction(SET, PC, Z)]
+    ma.asm("call", ucode)
+
+    # Low-level memory manipulation.
+
+    ucode = [Instruction(SET, [Z], PEEK)]
+    # Move the stack back, and then pop the next word into TOS.
+    ucode.append(Instruction(ADD, SP, 0x1))
+    ucode += _pop(Z)
+    ma.asm("!", ucode)
+
+    # TOS lets us cheat hard.
+    ucode = [Instruction(SET, Z, [Z])]
+    ma.asm("@", ucode)
+
+    ucode = [Instruction(ADD, [Z], PEEK)]
+    # Move the stack back, and then pop the next word into TOS.
+    ucode.append(Instruction(ADD, SP, 0x1))
+    ucode += _pop(Z)
+    ma.asm("+!", ucode)
+
+    ucode = [Instruction(SUB, [Z], PEEK)]
+    # Move the stack back, and then pop the next word into TOS.
+    ucode.append(Instruction(ADD, SP, 0x1))
+    ucode += _pop(Z)
+    ma.asm("-!", ucode)
+
+    # Low-level branching.
+
+    ucode = [Instruction(ADD, J, [J + 0x1])]
+    ma.asm("branch", ucode)
+
+    # Ugh.
+    ucode = [Instruction(IFN, Z, 0x0)]
+    ucode.append(Instruction(ADD, J, [J + 0x1]))
+    ucode.append(Instruction(IFE, Z, 0x0))
+    ucode.append(Instruction(ADD, J, 0x1))
+    ma.asm("0branch", ucode)
+
+    # Goddammit DCPU!
+    ucode = [Instruction(SUB, J, [J + 0x1])]
+    ma.asm("nbranch", ucode)
+
+    ucode = [Instruction(IFN, Z, 0x0)]
+    ucode.append(Instruction(SUB, J, [J + 0x1]))
+    ucode.append(Instruction(IFE, Z, 0x0))
+    ucode.append(Instruction(ADD, J, 0x1))
+    ma.asm("0nbranch", ucode)
+
+    # Low-level tests.
+
+    # I bet there's a trick to this. I'll revisit this later.
+    ucode = [Instruction(IFN, J, 0x0)]
+    ucode.append(Instruction(SET, A, 0x1))
+    ucode.append(Instruction(IFE, J, 0x0))
+    ucode.append(Instruction(SET, A, 0x0))
+    ucode.append(Instruction(SET, J, A))
+    ma.asm("0=", ucode)
+
+    # Main stack manipulation.
+
+    ucode = [Instruction(SET, PUSH, Z)]
+    ma.asm("dup", ucode)
+
+    # Return stack manipulation.
+
+    ucode = _push(0xd000)
+    ma.asm("r0", ucode)
+
+    ucode = _push(Y)
+    ma.asm("rsp@", ucode)
+
+    ucode = _pop(Y)
+    ma.asm("rsp!", ucode)
+
+    ucode = _push([Y])
+    ucode.append(Instruction(ADD, Y, 0x1))
+    ma.asm("r>", ucode)
+
+    ucode = [Instruction(SUB, Y, 0x1)]
+    ucode += _pop([Y])
+    ma.asm(">r", ucode)
+
+    ucode = _push([Y])
+    ma.asm("r@", ucode)
+
+    ucode = _pop([Y])
+    ma.asm("r!", ucode)
+
+    ucode = [Instruction(ADD, Y, 0x1)]
+    ma.asm("rdrop", ucode)
+
+    # Arithmetic.
+
+    ucode = [Instruction(ADD, Z, POP)]
+    ma.asm("+", ucode)
+
+    # Low-level input.
+
+    ucode = [Instruction(SET, PUSH, Z)]
+    ucode.append(Instruction(SET, A, Z))
+    ucode += call(ma.asmwords["word"])
+    ma.asm("key", ucode)
+
+    # High-level input.
+
+    ucode = call(ma.asmwords["word"])
+    ucode += _push(C)
+    ucode += _push(B)
+    ma.asm("word", ucode)
+
+    ucode = _pop(A)
+    ucode += _pop(B)
+    ucode += call(ma.asmwords["snumber"])
+    ucode += _push(C)
+    ma.asm("snumber", ucode)
+
+    # Output.
+
+    ucode = [Instruction(SET, A, [ma.FB])]
+    ucode += _pop([A])
+    ucode.append(Instruction(ADD, [ma.FB], 0x1))
+    ma.asm("emit", ucode)
+
+    # Global access.
+
+    # This could be done in Forth, but it's so small in assembly!
+    ucode = _pop([ma.HERE])
+    ucode.append(Instruction(ADD, [ma.HERE], 0x1))
+    ma.asm(",", ucode)
+
+    ucode = [Instruction(SET, [ma.STATE], 0x0)]
+    ma.asm("[", ucode)
+
+    ucode = [Instruction(SET, [ma.STATE], 0x1)]
+    ma.asm("]", ucode)
+
+    ucode = _push([ma.LATEST])
+    ma.asm("latest", ucode)
+
+    # Compiler stuff.
+
+    ucode = call(ma.asmwords["read"])
+    ucode += _push([C])
+    ma.asm("char", ucode)
+
+    # Pop the target address (below TOS) into a working register. Leave length
+    # on TOS.
+    preamble = [Instruction(SET, A, POP)]
+    # Use B as our linked list pointer. Only the words in the bucket that the
+    # last word read hashes to are searched.
+    preamble.append(Instruction(SET, B, [ma.HASH]))
+    preamble.append(Instruction(AND, B, ma.buckets - 1))
+    preamble.append(Instruction(ADD, B, ma.BUCKETS))
+    # Top of the loop. Dereference B to move along the chain, and give up at
+    # the end of it.
+    here = local()
+    missing = local()
+    ucode = [Instruction(SET, B, [B])]
+    ucode.append(Instruction(IFE, B, 0x0))
+    ucode.append(Instruction(ADD, PC, Distance(here, missing)))
+    ucode.append(Label(here))
+    # Compare lengths; if they don't match, go to the next one. Immediate
+    # words can be found, but hidden ones can't.
+    here = local()
+    skip = local()
+    ucode.append(Instruction(SET, C, [B + 0x2]))
+    ucode.append(Instruction(AND, C, 0xffff ^ IMMEDIATE))
+    ucode.append(Instruction(IFN, C, Z))
+    ucode.append(Instruction(ADD, PC, Distance(here, skip)))
+    ucode.append(Label(here))
+    # memcmp() the strings, holding onto both pointers.
+    ucode.append(Instruction(SET, PUSH, A))
+    ucode.append(Instruction(SET, PUSH, B))
+    ucode.append(Instruction(ADD, B, 0x3))
+    ucode.append(Instruction(SET, C, A))
+    ucode.append(Instruction(SET, A, Z))
+    ucode += call(ma.lib("memcmp"))
+    ucode.append(Instruction(SET, C, A))
+    ucode.append(Instruction(SET, B, POP))
+    ucode.append(Instruction(SET, A, POP))
+    # If it succeeded, jump out.
+    here = local()
+    found = local()
+    ucode.append(Instruction(IFN, C, 0x0))
+    ucode.append(Instruction(ADD, PC, Distance(here, found)))
+    ucode.append(Label(here))
+    ucode.append(Label(skip))
+    ucode = until(ucode, (IFN, B, 0x0))
+    # We got to the end of the chain and couldn't find anything, so leave
+    # 0x0, which is one past the end.
+    ucode.append(Label(missing))
+    ucode.append(Instruction(SUB, B, 0x1))
+    # B points at the word's chain; its header is right after.
+    ucode.append(Label(found))
+    ucode.append(Instruction(SET, Z, B))
+    ucode.append(Instruction(ADD, Z, 0x1))
+    ma.asm("find", preamble + ucode)
+
+    ma.thread("+1", ["literal", 0x1, "+"])
+
+    ma.thread(">cfa", ["+1", "dup", "@", "+", "+1"])
+
+    # Grab HERE. It's going to live in A for a bit.
+    preamble = [Instruction(SET, A, [ma.HERE])]
+    # Chain HERE onto the front of the bucket for the last word read.
+    preamble.append(Instruction(SET, B, [ma.HASH]))
+    preamble.append(Instruction(AND, B, ma.buckets - 1))
+    preamble.append(Instruction(ADD, B, ma.BUCKETS))
+    preamble.append(Instruction(SET, [A], [B]))
+    preamble.append(Instruction(SET, [B], A))
+    # Move ahead, write LATEST, update LATEST.
+    preamble.append(Instruction(ADD, A, 0x1))
+    preamble.append(Instruction(SET, [A], [ma.LATEST]))
+    preamble.append(Instruction(SET, [ma.LATEST], A))
+    # Move ahead, write length.
+    preamble.append(Instruction(ADD, A, 0x1))
+    preamble.append(Instruction(SET, [A], Z))
+    # Set the hidden flag.
+    preamble.append(Instruction(BOR, [A], HIDDEN))
+    # memcpy() the name in right after. SP is nerfed, so grab the source
+    # address from under TOS.
+    ucode = [Instruction(ADD, A, 0x1)]
+    ucode.append(Instruction(SET, C, A))
+    ucode.append(Instruction(SET, B, PEEK))
+    ucode.append(Instruction(SET, A, Z))
+    ucode += call(ma.lib("memcpy"))
+    # memcpy() leaves C at the end of the name, which is the new HERE.
+    ucode.append(Instruction(SET, [ma.HERE], C))
+    # Get the stack to be sane again. Shift it down and then pop, same as
+    # 2drop.
+    ucode.append(Instruction(ADD, SP, 0x1))
+    ucode.append(Instruction(SET, Z, POP))
+    ma.asm("create", preamble + ucode)
+
+    # The stack points to the top of the header. Move forward one...
+    ucode = [Instruction(ADD, Z, 0x1)]
+    # Now XOR in the hidden flag.
+    ucode.append(Instruction(XOR, [Z], HIDDEN))
+    # And pop the stack.
+    ucode.append(Instruction(SET, Z, POP))
+    ma.asm("hidden", ucode)
+
+    # We get to grab LATEST ourselves. On the plus side, no stack touching.
+    ucode = [Instruction(SET, A, ma.LATEST)]
+    # XOR that flag!
+    ucode.append(Instruction(XOR, [A + 0x1], IMMEDIATE))
+    ma.asm("immediate", ucode)
+
+    ucode = [Instruction(AND, Z, IMMEDIATE)]
+    ma.asm("immediate?", ucode)
+
+    ma.thread(":", [
+        "word",
+        "create",
+        "literal", ma.asmwords["enter"],
         ",",
+        "latest",
+        "@",
+        "hidden",
+        "]",
     ])
-)
-
-ma.thread("interpret", [
-    "word",
-    "find",
-    "dup",
-    ] + IF([
-        "interpret-found",
-    ])
-)
 
-ma.thread("quit", ["r0", "rsp!", "interpret", "nbranch", 0x2])
+    ma.thread(";", [
+        "literal", ma.asmwords["exit"],
+        ",",
+        "latest",
+        "@",
+        "hidden",
+        "[",
+    ], flags=IMMEDIATE)
+
+    ma.thread("interpret-found", [
+        "dup",
+        "+1",
+        "immediate?",
+        ] + IF([
+            ">cfa",
+            "call",
+        ], [
+            ">cfa",
+            ",",
+        ])
+    )
+
+    ma.thread("interpret", [
+        "word",
+        "find",
+        "dup",
+        ] + IF([
+            "interpret-found",
+        ])
+    )
+
+    ma.thread("quit", ["r0", "rsp!", "interpret", "nbranch", 0x2])
+
+    ma.finalize()
+
+    return ma
+
+
+def core_directory():
+    """
+    Return the directory that this user's cores are saved in, making it if
+    needed, or None if there isn't one that only this user can write to.
+    """
+
+    base = (os.environ.get("XDG_CACHE_HOME") or
+            os.path.join(os.path.expanduser("~"), ".cache"))
+    directory = os.path.join(base, "cauliflower")
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        info = os.lstat(directory)
+    except OSError:
+        return None
+    if (not S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            info.st_mode & 0077):
+        return None
+    return directory
+
+
+def cached_core(model="indirect", path=None):
+    """
+    Return a core, reading it from a file if it was saved there by this
+    version of the source, and otherwise building it and saving it there.
+
+    The file defaults to one for each model in core_directory(); if there's
+    no such directory, the core is built every time. Every call returns a
+    fresh core, which can be changed freely.
+    """
 
-ma.finalize()
+    if path is None:
+        directory = core_directory()
+        if directory is None:
+            return core(model)
+        path = os.path.join(directory, "%s.core" % model)
+    source = fingerprint(SOURCES)
+
+    ma = MetaAssembler.read(path, source)
+    if ma is not None and ma.model == model:
+        return ma
+
+    ma = core(model)
+    # Write it under another name first, so that nothing ever reads half of
+    # it.
+    partial = "%s.%d" % (path, os.getpid())
+    with open(partial, "wb") as f:
+        ma.save(f, source)
+    os.rename(partial, path)
+    return ma
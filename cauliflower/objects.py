@@ -0,0 +1,286 @@
+"""
+Relocatable objects, and a linker for them.
+
+An object holds a separately compiled module: every word it defines, along
+with everything that another module needs to know in order to use the word
+without compiling it again. Each word has its finished body, which is its
+section of the object, and its plain body, for inlining into other words.
+Words which are only ever inlined have no section.
+
+Sections are kept as position-independent code, the same as everything else
+before it's linked: jumps inside of a word are relative, and every Symbol is
+a relocation, to be filled in with the address of a word once it's placed.
+Leaving the encoding to the linker lets it still give short literals to the
+words placed lowest, and let words fall through to the words they jump to.
+Every object also lists the symbols that each of its sections needs, so that
+a missing word is caught before anything is laid out.
+
+Objects are compiled for one calling convention, and can only be linked with
+other objects compiled for the same one. They also remember which compiler
+made them, so that one made by an older compiler can be told apart from one
+that would be made now.
+
+A word which is defined by more than one object means the definition which
+was in scope where it was used: the words of an object call its own
+definitions, or else the ones from the objects before it. Definitions which
+are replaced by a later object are renamed after which definition they are,
+the same way that the reader renames words which are defined again in the
+source.
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+from itertools import count
+import os
+
+from cauliflower.assembler import (Data, Instruction, Label, Symbol, encode,
+                                   layout, relabel, size)
+from cauliflower.cache import dump, load
+from cauliflower.placement import arrange, references
+from cauliflower.reader import Scope
+
+# Bumped whenever the layout of an object changes.
+version = 2
+
+# Every object read from a file so far, by path, with when the file changed.
+opened = {}
+
+
+class Object(object):
+    """
+    A separately compiled module.
+    """
+
+    def __init__(self, abi, source=None, compiler=None):
+        # The calling convention, as (tos, jsr).
+        self.abi = abi
+        # A digest of the source the object was compiled from, if any.
+        self.source = source
+        # A fingerprint of the compiler which made the object, if known.
+        self.compiler = compiler
+        self.order = []
+        # The finished body of each word which can be called.
+        self.sections = {}
+        # Whether each word is always inlined, and its plain body.
+        self.inline = {}
+        # The symbols that each section refers to.
+        self.relocations = {}
+        # How many times each word is guessed to run, the effects of the
+        # words which only shuffle the stack, and the words which run do
+        # loops.
+        self.weights = {}
+        self.shuffles = {}
+        self.indexed = set()
+
+
+    def add(self, name, inline, ucode, body, weight=0, shuffle=None,
+            indexed=False):
+        """
+        Add a compiled word.
+
+        Labels are renamed after the word, so that the same module always
+        makes the same object, no matter what was compiled alongside it.
+        """
+
+        if name not in self.inline:
+            self.order.append(name)
+        self.inline[name] = inline, named(ucode, name)
+        self.weights[name] = weight
+        if body is not None:
+            self.sections[name] = named(body, name)
+            self.relocations[name] = sorted(references(self.sections[name]))
+        else:
+            self.sections.pop(name, None)
+            self.relocations.pop(name, None)
+        if shuffle is not None:
+            self.shuffles[name] = shuffle
+        else:
+            self.shuffles.pop(name, None)
+        if indexed:
+            self.indexed.add(name)
+        else:
+            self.indexed.discard(name)
+
+
+    def words(self, names={}):
+        """
+        Yield each word's name, whether it's always inlined, its plain body
+        and its section, in the order that they were added. Every label is
+        given a new name, so that the words can't clash with code compiled
+        since the object was made.
+
+        Words, and the symbols in their bodies, can be renamed, as scopes()
+        finds them.
+        """
+
+        for name in self.order:
+            inline, ucode = self.inline[name]
+            body = self.sections.get(name)
+            if body is not None:
+                body = relabel(rebind(body, names))
+            yield (names.get(name, name), inline,
+                   relabel(rebind(ucode, names)), body)
+
+
+    def current(self, abi, source, compiler):
+        """
+        Whether the object is what the given compiler would make from the
+        given source, for the given calling convention.
+        """
+
+        return (self.abi == abi and self.source == source and
+                self.compiler == compiler)
+
+
+    def save(self, f):
+        dump((version, self.__dict__), f)
+
+
+    @classmethod
+    def read(cls, f):
+        """
+        Read an object from an open file.
+        """
+
+        saved, state = load(f)
+        if saved != version:
+            raise Exception("Object is version %d, not version %d" %
+                            (saved, version))
+        rv = cls.__new__(cls)
+        rv.__dict__.update(state)
+        return rv
+
+
+def open_object(path):
+    """
+    Read an object from a file, or return the object last read from it, if
+    the file hasn't changed since.
+
+    Objects which are shared like this must never be changed.
+    """
+
+    mtime = os.stat(path).st_mtime
+    if path not in opened or opened[path][0] != mtime:
+        with open(path, "rb") as f:
+            opened[path] = mtime, Object.read(f)
+    return opened[path][1]
+
+
+def named(code, name):
+    """
+    Rename every label in some code after a word, in order.
+    """
+
+    serials = count()
+    return relabel(code, lambda: ".%s.%d" % (name, next(serials)))
+
+
+def rebind(code, names):
+    """
+    Return a copy of some code with its symbols renamed.
+    """
+
+    def rename(v):
+        if isinstance(v, list):
+            return [rename(v[0])]
+        elif isinstance(v, Symbol) and v.name in names:
+            return Symbol(names[v.name])
+        return v
+
+    return [Instruction(item.op, rename(item.a), rename(item.b))
+            if isinstance(item, Instruction) else item for item in code]
+
+
+def scopes(objects, later=()):
+    """
+    Find the definition that each name in each of some objects means, given
+    the names of any words defined after all of them.
+
+    Returns a dict for each object, from each name to the name of the
+    definition it means there.
+    """
+
+    scope = Scope([name for obj in objects for name in obj.order] +
+                  list(later))
+    rv = []
+    for obj in objects:
+        names = dict(scope.names)
+        for name in obj.order:
+            names[name] = scope.define(name)
+        rv.append(names)
+    return rv
+
+
+def digest(text):
+    return sha1(text).hexdigest()
+
+
+def combine(objects):
+    """
+    Gather up the sections and weights of some objects. A word defined by
+    more than one object is called by its name in the last of them, and the
+    words of the others keep calling the definitions they were made with.
+
+    Local labels only have to be unique within the run that made them, so
+    every section gets new ones.
+    """
+
+    abis = set(obj.abi for obj in objects)
+    if len(abis) > 1:
+        raise Exception("Can't link objects made for different calling "
+                        "conventions: %s" % sorted(abis))
+
+    sections = OrderedDict()
+    needs = {}
+    weights = {}
+    for obj, names in zip(objects, scopes(objects)):
+        for name in obj.order:
+            if names[name] != name:
+                print "Word %s is redefined; the old one is %s" % (
+                    name, names[name])
+            if name in obj.sections:
+                sections[names[name]] = relabel(rebind(obj.sections[name],
+                                                       names))
+                needs[names[name]] = sorted(names.get(symbol, symbol) for
+                                            symbol in obj.relocations[name])
+            weights[names[name]] = obj.weights[name]
+    return sections, needs, weights
+
+
+def link_objects(objects, start, roots, weights={}):
+    """
+    Link some objects into an image, which starts with some code, and then
+    holds every word which can be reached from the roots.
+
+    Weights given here are used to lay the words out, in place of the ones
+    that the objects were compiled with.
+
+    Returns the image, the address of every symbol, the words which were
+    placed, in order, and the words which were left out.
+    """
+
+    sections, needs, guesses = combine(objects)
+    guesses.update(weights)
+
+    for name in roots:
+        if name not in sections:
+            raise Exception("Can't export undefined word %r" % name)
+
+    placed = arrange(sections, guesses, roots)
+    for name, body in placed:
+        for symbol in needs[name]:
+            if symbol not in sections and not symbol.startswith("."):
+                raise Exception("Word %s needs undefined word %s" %
+                                (name, symbol))
+
+    code = list(start)
+    code.append(Data(0x0))
+    for name, body in placed:
+        code.append(Label(name))
+        code += body
+
+    kept = set(name for name, body in placed)
+    removed = [(name, size(sections[name])) for name in sorted(sections)
+               if name not in kept]
+    labels, short = layout(code)
+    return encode(code, labels, short), labels, placed, removed
@@ -0,0 +1,275 @@
+"""
+A peephole optimizer for compiled words.
+
+Builtins and calls are emitted from fixed templates, so the places where two
+templates meet are usually wasteful: a value is pushed only to be popped
+right back off, or pushed only to be dropped. The optimizer walks over a
+word's instructions and lets each rule rewrite a few instructions at a time,
+until no rule applies anymore.
+
+A rule is a function which takes a list of instructions and an index, and
+returns either None, if it doesn't apply at that index, or a tuple of the
+number of instructions it consumes and a list of instructions to replace
+them with.
+"""
+
+from cauliflower.assembler import (A, ADD, B, C, IFB, IFE, IFG, IFN, JSR,
+                                   PC, PEEK, POP, PUSH, SET, SP, SUB,
+                                   Instruction, Offset, commutative,
+                                   registers, size)
+from cauliflower.emulator import cost
+
+# Registers which no template expects to survive past its own end. Every
+# template sets these before reading them.
+scratch = A, B, C
+
+tests = IFB, IFE, IFG, IFN
+
+# Values which move or read through SP.
+stacky = POP, PEEK, PUSH, SP
+
+
+def uses(v, register):
+    """
+    Whether a value reads the given register to figure out where it is.
+    """
+
+    if isinstance(v, list):
+        iv, = v
+        return iv is register or (isinstance(iv, Offset) and
+                                  iv.register is register)
+    return False
+
+
+def reads(instruction, register):
+    op, a, b = instruction
+    return (b is register or uses(a, register) or uses(b, register) or
+            (a is register and op != SET))
+
+
+def writes(instruction, register):
+    op, a, b = instruction
+    return a is register and op is not JSR
+
+
+def touches_pc(instruction):
+    op, a, b = instruction
+    return op is JSR or op in tests or a is PC or b is PC
+
+
+def dead(code, i, register):
+    """
+    Whether the register's value is dead going into instruction i.
+
+    This is conservative; anything that branches, or could be branched to, is
+    assumed to need the register.
+    """
+
+    for instruction in code[i:]:
+        if not isinstance(instruction, Instruction):
+            return False
+        if touches_pc(instruction) or reads(instruction, register):
+            return False
+        if writes(instruction, register):
+            return True
+    return register in scratch
+
+
+def pinned(code):
+    """
+    Find the indices of instructions which must not be touched, because
+    something is counting on their exact size or position.
+    """
+
+    rv = set()
+    sizes = [size([item]) for item in code]
+
+    for i, item in enumerate(code):
+        if not isinstance(item, Instruction):
+            # Labels can be jumped to, and data is data.
+            rv.add(i)
+            continue
+
+        op, a, b = item
+        if op in tests:
+            # The instruction after a test is conditional.
+            rv.update((i, i + 1))
+        elif a is PC and op in (ADD, SUB) and isinstance(b, int):
+            # Relative jump; everything skipped over is spoken for.
+            rv.add(i)
+            distance = b
+            step = 1 if op == ADD else -1
+            j = i if op == ADD else i + 1
+            while distance > 0 and 0 <= j + step < len(code):
+                j += step
+                distance -= sizes[j]
+                rv.add(j)
+        elif b is PC:
+            # PC is being read in order to compute a return address, which is
+            # only good until the next jump.
+            j = i
+            while j < len(code):
+                rv.add(j)
+                if isinstance(code[j], Instruction) and code[j].a is PC:
+                    break
+                j += 1
+        elif touches_pc((op, a, b)):
+            rv.add(i)
+
+    return rv
+
+
+def window(code, i, length):
+    """
+    Return the instructions at i, if there are enough of them.
+    """
+
+    rv = code[i:i + length]
+    if len(rv) == length and all(isinstance(x, Instruction) for x in rv):
+        return rv
+
+
+def push_pop(code, i):
+    """
+    SET PUSH, x; op y, POP -> op y, x
+    """
+
+    (op1, a1, b1), (op2, a2, b2) = code[i:i + 2]
+    if (op1 == SET and a1 is PUSH and b2 is POP and op2 not in tests and
+        op2 is not JSR and b1 not in stacky and a2 not in stacky and
+        not uses(b1, SP) and not uses(a2, SP)):
+        if op2 == SET and a2 is b1:
+            return 2, []
+        return 2, [Instruction(op2, a2, b1)]
+
+
+def pop_push(code, i):
+    """
+    SET r, POP; SET PUSH, r -> SET r, PEEK
+    """
+
+    (op1, a1, b1), (op2, a2, b2) = code[i:i + 2]
+    if (op1 == SET and b1 is POP and op2 == SET and a2 is PUSH and
+        b2 is a1 and a1 not in stacky):
+        return 2, [Instruction(SET, a1, PEEK)]
+
+
+def push_drop(code, i):
+    """
+    SET PUSH, x; ADD SP, 1 -> nothing
+    """
+
+    (op1, a1, b1), (op2, a2, b2) = code[i:i + 2]
+    if (op1 == SET and a1 is PUSH and op2 == ADD and a2 is SP and b2 == 0x1
+        and b1 is not POP and b1 is not PUSH):
+        return 2, []
+
+
+def forward(code, i):
+    """
+    SET r, x; op y, r -> op y, x
+
+    Only done when r is dead afterwards, and when x is a literal or a register
+    which can't be disturbed by y.
+    """
+
+    (op1, a1, b1), (op2, a2, b2) = code[i:i + 2]
+    if (op1 == SET and a1 in scratch and b2 is a1 and op2 is not JSR and
+        a2 is not a1 and not uses(a2, a1) and
+        (isinstance(b1, int) or b1 in scratch) and dead(code, i + 2, a1)):
+        return 2, [Instruction(op2, a2, b1)]
+
+
+def spill(code, i):
+    """
+    SET PUSH, r; op PEEK, x; SET r, POP -> op r, x
+
+    This is the shape of binary operations on a cached top of stack.
+    """
+
+    instructions = window(code, i, 3)
+    if instructions is None:
+        return None
+    (op1, a1, b1), (op2, a2, b2), (op3, a3, b3) = instructions
+    if (op1 == SET and a1 is PUSH and b1 in registers and a2 is PEEK and
+        op2 not in tests and op2 is not JSR and b2 not in stacky and
+        not uses(b2, SP) and op3 == SET and a3 is b1 and b3 is POP):
+        return 3, [Instruction(op2, b1, b2)]
+
+
+def spill_literal(code, i):
+    """
+    SET PUSH, r; SET r, x; op PEEK, r; SET r, POP -> op r, x
+    SET PUSH, r; SET r, x; op r, POP -> op r, x, if op is commutative
+
+    This is the shape of a literal followed by a binary operation on a cached
+    top of stack.
+    """
+
+    instructions = window(code, i, 3)
+    if instructions is None:
+        return None
+    (op1, a1, b1), (op2, a2, b2), (op3, a3, b3) = instructions
+    if not (op1 == SET and a1 is PUSH and b1 in registers and op2 == SET and
+            a2 is b1 and (isinstance(b2, int) or b2 in registers) and
+            b2 is not b1 and op3 not in tests and op3 is not JSR):
+        return None
+
+    if op3 in commutative and a3 is b1 and b3 is POP:
+        return 3, [Instruction(op3, b1, b2)]
+
+    instructions = window(code, i, 4)
+    if instructions is None:
+        return None
+    op4, a4, b4 = instructions[3]
+    if a3 is PEEK and b3 is b1 and op4 == SET and a4 is b1 and b4 is POP:
+        return 4, [Instruction(op3, b1, b2)]
+
+
+rules = [
+    push_pop,
+    pop_push,
+    push_drop,
+    forward,
+    spill,
+    spill_literal,
+]
+
+
+def optimize(code, rules=rules, stats=None):
+    """
+    Optimize a list of instructions and return the optimized list.
+
+    If a dict is provided for stats, the words and cycles saved by each rule
+    are accumulated into it, keyed by rule name.
+    """
+
+    code = list(code)
+
+    changed = True
+    while changed:
+        changed = False
+        frozen = pinned(code)
+        for i in range(len(code) - 1):
+            if i in frozen or i + 1 in frozen:
+                continue
+            for rule in rules:
+                match = rule(code, i)
+                if match is None:
+                    continue
+                count, replacement = match
+                if frozen.intersection(range(i, i + count)):
+                    continue
+                if stats is not None:
+                    before = cost(code[i:i + count])
+                    after = cost(replacement)
+                    words, cycles = stats.get(rule.__name__, (0, 0))
+                    stats[rule.__name__] = (words + before[0] - after[0],
+                                            cycles + before[1] - after[1])
+                code[i:i + count] = replacement
+                changed = True
+                break
+            if changed:
+                break
+
+    return code
@@ -0,0 +1,114 @@
+"""
+Decide which words go into the image, and where.
+
+Only words which can be reached from an entry point are kept. The rest are
+laid out hottest first, since the lowest addresses fit into inline literals.
+A word which ends by jumping to another word is followed by that word, so that
+the jump can be dropped and the word can fall through instead.
+"""
+
+from cauliflower.assembler import (IFB, IFE, IFG, IFN, PC, SET, Instruction,
+                                   Symbol)
+
+tests = IFB, IFE, IFG, IFN
+
+
+def references(code):
+    """
+    Find the names of the symbols which some code refers to.
+    """
+
+    rv = set()
+    for item in code:
+        if isinstance(item, Instruction):
+            for v in item.a, item.b:
+                if isinstance(v, list):
+                    v, = v
+                if isinstance(v, Symbol):
+                    rv.add(v.name)
+    return rv
+
+
+def reachable(bodies, roots):
+    """
+    Find the names of every word which can be reached from the given roots.
+    """
+
+    rv = set()
+    stack = list(roots)
+    while stack:
+        name = stack.pop()
+        if name in rv or name not in bodies:
+            continue
+        rv.add(name)
+        stack.extend(references(bodies[name]))
+    return rv
+
+
+def successor(code):
+    """
+    Return the name of the word which some code always ends by jumping to, or
+    None if it doesn't.
+    """
+
+    if not code or not isinstance(code[-1], Instruction):
+        return None
+
+    op, a, b = code[-1]
+    if op != SET or a is not PC or not isinstance(b, Symbol):
+        return None
+
+    # A jump right after a test is only sometimes taken.
+    if len(code) > 1 and isinstance(code[-2], Instruction):
+        if code[-2].op in tests:
+            return None
+
+    return b.name
+
+
+def arrange(bodies, counts, roots):
+    """
+    Lay out the words which can be reached from the roots.
+
+    Words are first strung together into chains, each word followed by the
+    word it ends by jumping to; when several words jump to the same word, the
+    hottest one gets it. The chains are then placed in order of their
+    hottest words.
+
+    Returns a list of (name, body) pairs in the order that they should be
+    placed, with every jump that falls through to the next word dropped.
+    """
+
+    keep = reachable(bodies, roots)
+    # Sorting is stable, so words which are equally hot keep their order.
+    order = sorted((name for name in bodies if name in keep),
+                   key=lambda name: -counts.get(name, 0))
+
+    following = {}
+    heads = set(order)
+    for name in order:
+        target = successor(bodies[name])
+        if target in heads and target != name:
+            following[name] = target
+            heads.discard(target)
+
+    chains = []
+    for name in order:
+        if name in heads:
+            chain = []
+            while name is not None:
+                chain.append(name)
+                name = following.get(name)
+            chains.append(chain)
+    chains.sort(key=lambda chain: -max(counts.get(name, 0)
+                                       for name in chain))
+
+    placed = sum(chains, [])
+
+    rv = []
+    for name in placed:
+        body = bodies[name]
+        if name in following:
+            body = body[:-1]
+        rv.append((name, body))
+    return rv
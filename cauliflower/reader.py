@@ -0,0 +1,303 @@
+"""
+Read Forth source.
+
+Source is read a line at a time, and every token remembers where it came
+from, so that errors can point at it. Definitions are parsed as they are read;
+the bodies of if statements and loops are nested inside the definitions that
+they are part of, to any depth.
+"""
+
+from collections import namedtuple
+import re
+
+# An if statement. Each branch is a tuple of words, and the else branch is
+# None if there isn't one.
+If = namedtuple("If", "then, otherwise")
+
+# Loops, with each of their parts as a tuple of words: begin ... until,
+# begin ... while ... repeat, and do ... loop.
+Until = namedtuple("Until", "body")
+While = namedtuple("While", "condition, body")
+Do = namedtuple("Do", "body")
+
+# The word which closes each kind of statement, for errors.
+closers = {"if": "then", "begin": "until", "do": "loop"}
+
+# Words which start the second part of a statement, and what they're part of.
+middles = {"else": "if", "while": "begin"}
+
+# Words which close a statement: what they close, how many parts it has, and
+# what to make of the parts.
+endings = {
+    "then": ("if", (1, 2), lambda then, otherwise=None: If(then, otherwise)),
+    "until": ("begin", (1,), Until),
+    "repeat": ("begin", (2,), While),
+    "loop": ("do", (1,), Do),
+}
+
+
+class Token(str):
+    """
+    A word of source, along with the file, line and column it started at.
+    """
+
+    def __new__(cls, word, filename, line, column):
+        self = str.__new__(cls, word)
+        self.filename = filename
+        self.line = line
+        self.column = column
+        return self
+
+    def __getnewargs__(self):
+        return str(self), self.filename, self.line, self.column
+
+    @property
+    def position(self):
+        return "%s:%d:%d" % (self.filename, self.line, self.column)
+
+
+def tokenize(f, filename="<source>"):
+    """
+    Split an open file into lowercased tokens, one line at a time.
+    """
+
+    for line, text in enumerate(f, 1):
+        for match in re.finditer(r"\S+", text):
+            yield Token(match.group().lower(), filename, line,
+                        match.start() + 1)
+
+
+def walk(words):
+    """
+    Yield every word in a body, including the words inside if statements and
+    loops.
+    """
+
+    for word in words:
+        if isinstance(word, (If, Until, While, Do)):
+            for part in word:
+                if part is None:
+                    continue
+                for inner in walk(part):
+                    yield inner
+        else:
+            yield word
+
+
+def blocks(words):
+    """
+    Yield the blocks of every if statement in a body, including the ones
+    nested inside of other statements.
+    """
+
+    for word in words:
+        if isinstance(word, If):
+            yield word.then
+            if word.otherwise is not None:
+                yield word.otherwise
+        if isinstance(word, (If, Until, While, Do)):
+            for part in word:
+                if part is None:
+                    continue
+                for block in blocks(part):
+                    yield block
+
+
+def dependencies(definitions):
+    """
+    Find the earlier definitions that each definition has to be compiled
+    after: every definition so far of each word that it uses or redefines,
+    and the first definition to hold each of its blocks, since that's the
+    one which compiles a block that is shared.
+
+    Returns a sorted list of indices for each definition.
+    """
+
+    defined = {}
+    holders = {}
+    rv = []
+    for i, (name, words) in enumerate(definitions):
+        needs = set(defined.get(name, ()))
+        for word in walk(words):
+            needs.update(defined.get(word, ()))
+        for block in blocks(words):
+            needs.add(holders.setdefault(block, i))
+        needs.discard(i)
+        rv.append(sorted(needs))
+        defined.setdefault(name, []).append(i)
+    return rv
+
+
+class Scope(object):
+    """
+    Which definition of each word is in scope, as definitions are made in
+    order.
+
+    Every definition of a word which is defined again later gets a name of its
+    own, made from the word's name and which definition of it it is, so that
+    the words which used it can still call it once it's been redefined. The
+    last definition keeps the word's name.
+    """
+
+    def __init__(self, names):
+        # How many times each word is defined, all told.
+        self.total = {}
+        for name in names:
+            self.total[name] = self.total.get(name, 0) + 1
+        self.made = {}
+        self.names = {}
+
+
+    def define(self, name):
+        """
+        Make a definition of a word, and return the name it's known by.
+        """
+
+        made = self.made[name] = self.made.get(name, 0) + 1
+        if made < self.total.get(name, 0):
+            self.names[name] = "%s~%d" % (name, made - 1)
+        else:
+            self.names[name] = name
+        return self.names[name]
+
+
+    def get(self, name):
+        """
+        Return the name of the definition of a word which is in scope.
+        """
+
+        return self.names.get(name, name)
+
+
+def rename(token, name):
+    """
+    Give a token another name, keeping where it came from.
+    """
+
+    if isinstance(token, Token) and token != name:
+        return Token(name, token.filename, token.line, token.column)
+    return name
+
+
+def bind(words, scope):
+    """
+    Point every word in a body, and in its if statements and loops, at the
+    definition of it which is in scope.
+    """
+
+    rv = []
+    for word in words:
+        if isinstance(word, (If, Until, While, Do)):
+            rv.append(type(word)(*[None if part is None else
+                                   tuple(bind(part, scope))
+                                   for part in word]))
+        else:
+            rv.append(rename(word, scope.get(word)))
+    return rv
+
+
+def scoped(definitions, imported=()):
+    """
+    Give every definition of a word which is defined again later a name of its
+    own, and point every word in every body at the definition of it which is
+    in scope there. Words defined in objects are counted as defined before
+    any of the definitions, in the order given.
+
+    Returns the definitions, renamed.
+    """
+
+    definitions = list(definitions)
+    scope = Scope(list(imported) + [name for name, words in definitions])
+    for name in imported:
+        scope.define(name)
+    rv = []
+    for name, words in definitions:
+        # A word which uses its own name means the definition before it.
+        words = bind(words, scope)
+        rv.append((rename(name, scope.define(name)), words))
+    return rv
+
+
+def definitions(tokens):
+    """
+    Find the word definitions in some tokens, and yield each one's name and
+    words.
+    """
+
+    comment = None
+    start = None
+    name = None
+    # Every open statement, innermost last, as its opening token and the
+    # lists of words in each of its parts so far.
+    opens = []
+    # The lists of words being added to, innermost last.
+    blocks = []
+
+    for token in tokens:
+        # Handle comments. Whether or not a Forth permits nested comments is
+        # pretty up-in-the-air; this Forth does not permit nesting of
+        # comments.
+        if comment is not None:
+            if token == ")":
+                comment = None
+            continue
+        elif token == "(":
+            comment = token
+            continue
+        elif token == ")":
+            raise Exception("%s: Unmatched )" % token.position)
+
+        # Look for subroutines.
+        if start is None:
+            if token == ":":
+                start = token
+                blocks = [[]]
+                continue
+            raise Exception("%s: Lone word %r in tokenizer!" % (
+                token.position, str(token)))
+
+        if token == ":":
+            raise Exception("%s: Word definition inside of another" %
+                            token.position)
+        elif token == ";":
+            if name is None:
+                raise Exception("%s: Empty word definition!" %
+                                start.position)
+            if opens:
+                opening = opens[-1][0]
+                raise Exception("%s: %s without %s" % (
+                    opening.position, opening, closers[opening]))
+            yield name, blocks[0]
+            start = name = None
+        elif name is None:
+            name = token
+        elif token in closers:
+            opens.append([token, [[]]])
+            blocks.append(opens[-1][1][0])
+        elif token in middles:
+            opening = middles[token]
+            if not opens or opens[-1][0] != opening or len(opens[-1][1]) > 1:
+                raise Exception("%s: %s without %s" % (token.position, token,
+                                                       opening))
+            blocks[-1] = []
+            opens[-1][1].append(blocks[-1])
+        elif token in endings:
+            opening, counts, make = endings[token]
+            if not opens or opens[-1][0] != opening:
+                raise Exception("%s: %s without %s" % (token.position, token,
+                                                       opening))
+            if len(opens[-1][1]) not in counts:
+                # Either a repeat without a while, or an until with one.
+                raise Exception("%s: %s %s while" % (
+                    token.position, token,
+                    "without" if token == "repeat" else "after"))
+            opening, parts = opens.pop()
+            blocks.pop()
+            blocks[-1].append(make(*[tuple(part) for part in parts]))
+        else:
+            blocks[-1].append(token)
+
+    if comment is not None:
+        raise Exception("%s: Unterminated comment" % comment.position)
+    if start is not None:
+        raise Exception("%s: Unterminated word definition" % start.position)
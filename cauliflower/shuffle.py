@@ -0,0 +1,281 @@
+"""
+Stack shuffles.
+
+Words like swap, over and rot only move things around on the stack, but their
+templates pop everything they touch into registers and push it all back, and
+a run of them does that over and over. Instead, a run of shuffles is simulated
+on a symbolic stack, and only its net effect is compiled: each value which is
+still needed is read once, and each slot which changes is written once.
+
+Literals can be part of a run, and so can words which are defined entirely in
+terms of shuffles, like nip and tuck.
+"""
+
+from collections import namedtuple
+
+from cauliflower.assembler import (A, ADD, B, C, PEEK, POP, PUSH, SET, SP, Z,
+                                   Instruction)
+from cauliflower.emulator import cost
+from cauliflower.folding import literal
+
+# A value which was already on the stack before a shuffle, by how deep it was;
+# the top of the stack is at depth 0.
+Slot = namedtuple("Slot", "depth")
+
+# What a shuffle does to the stack: how many values it takes off the top, and
+# the values it leaves in their place, bottom first. Each value left is either
+# a Slot or a literal.
+Effect = namedtuple("Effect", "taken, left")
+
+# A run of shuffle words, along with their combined effect.
+Shuffle = namedtuple("Shuffle", "words, effect")
+
+effects = {
+    "drop": Effect(1, ()),
+    "dup": Effect(1, (Slot(0), Slot(0))),
+    "over": Effect(2, (Slot(1), Slot(0), Slot(1))),
+    "rot": Effect(3, (Slot(1), Slot(0), Slot(2))),
+    "swap": Effect(2, (Slot(0), Slot(1))),
+}
+
+# Registers which values can be held in while they're being moved.
+scratch = A, B, C
+
+
+def shuffling(word, effects=effects):
+    """
+    Whether a word can be part of a shuffle.
+    """
+
+    return literal(word) is not None or word in effects
+
+
+def simulate(words, effects=effects):
+    """
+    Find the combined effect of some shuffle words.
+    """
+
+    stack = []
+    taken = 0
+
+    for word in words:
+        value = literal(word)
+        if value is not None:
+            stack.append(value)
+            continue
+
+        effect = effects[word]
+        # Whatever the word takes that the run hasn't put on the stack itself
+        # was there before the run started.
+        while len(stack) < effect.taken:
+            stack.insert(0, Slot(taken))
+            taken += 1
+
+        args = stack[len(stack) - effect.taken:]
+        del stack[len(stack) - effect.taken:]
+        for value in effect.left:
+            if isinstance(value, Slot):
+                value = args[-1 - value.depth]
+            stack.append(value)
+
+    return Effect(taken, tuple(stack))
+
+
+def shuffle(effect, tos=False):
+    """
+    Compile the effect of a shuffle, optionally caching the top of the stack
+    in Z. Returns None if the shuffle needs more registers than there are.
+
+    Slots below the deepest one which changes are left alone. Everything
+    above it is popped, keeping the values which are still needed in
+    registers, and then the new values are pushed in its place. Values which
+    weren't popped are either read from where they are, or loaded into
+    registers first, and the last slot to be popped can be overwritten in
+    place rather than popped and pushed again; whichever way is cheapest is
+    used.
+    """
+
+    taken, left = effect
+    left = list(left)
+    # With a cached top of stack, the slot at depth 0 is Z, and the rest of
+    # the slots are in memory.
+    first = 1 if tos else 0
+
+    if tos:
+        # Z always holds something, so the shuffle has to take something and
+        # leave something. Taking one more slot and leaving it be is free.
+        if not taken:
+            left.insert(0, Slot(0))
+            taken = 1
+        if not left:
+            left.append(Slot(taken))
+            taken += 1
+
+    dropped = taken - len(left)
+
+    # The slot that each value left in memory ends up in, deepest first.
+    placed = [(dropped + len(left) - 1 - i, value)
+              for i, value in enumerate(left[:len(left) - first])]
+    top = left[-1] if tos else None
+
+    # Everything from just above the deepest slot which changes is rewritten.
+    bottom = max([first, dropped + first] +
+                 [depth + 1 for depth, value in placed
+                  if depth < first or value != Slot(depth)])
+    writes = [(depth, value) for depth, value in placed if depth < bottom]
+
+    candidates = []
+    for reuse in False, True:
+        if reuse and not (bottom > first and writes):
+            continue
+        for load in False, True:
+            code = moves(first, bottom, writes, top, reuse, load)
+            if code is not None:
+                candidates.append(code)
+
+    if not candidates:
+        return None
+    # Fewest cycles, and then fewest words.
+    return min(candidates, key=lambda code: cost(code)[::-1])
+
+
+def moves(first, bottom, writes, top, reuse, load):
+    """
+    Compile the moves which rewrite the slots above bottom, and put top into
+    Z if it isn't None. Returns None if there aren't enough registers.
+
+    If reuse is set, the last slot to be popped is overwritten in place,
+    rather than popped and pushed again. If load is set, the values which
+    aren't popped are loaded into registers, rather than read in place.
+    """
+
+    sp = bottom - 1 if reuse else bottom
+
+    needed = set(value for depth, value in writes)
+    if top is not None:
+        needed.add(top)
+
+    popped = [depth for depth in range(first, bottom) if Slot(depth) in needed]
+    deep = sorted(value.depth for value in needed
+                  if isinstance(value, Slot) and value.depth >= bottom)
+    # The slot SP stops at can be loaded with PEEK; any others have to be
+    # reached through a copy of SP.
+    if load or deep == [sp]:
+        loaded, unloaded = deep, []
+    else:
+        loaded, unloaded = [], deep
+    reach = [depth for depth in deep if depth != sp]
+
+    where = {}
+    if top is not None:
+        where[Slot(0)] = Z
+    free = list(scratch)
+    # If nothing needs the old top of the stack, the new one can be read right
+    # into Z.
+    direct = top is not None and Slot(0) not in needed
+    for depth in popped + loaded:
+        if direct and Slot(depth) == top:
+            where[top] = Z
+        elif free:
+            where[Slot(depth)] = free.pop(0)
+        else:
+            return None
+
+    base = None
+    if reach:
+        if not free:
+            return None
+        base = free.pop(0)
+    for depth in unloaded:
+        if depth == sp:
+            where[Slot(depth)] = [base]
+        else:
+            where[Slot(depth)] = [base + (depth - sp)]
+
+    code = []
+
+    skipped = 0
+    for depth in range(first, sp):
+        if Slot(depth) not in needed:
+            skipped += 1
+            continue
+        # Registers which haven't been loaded yet can hold the slots which
+        # aren't needed.
+        spare = free + [where[Slot(d)] for d in popped + loaded if d > depth]
+        code += skip(skipped, spare + [base])
+        skipped = 0
+        code.append(Instruction(SET, where[Slot(depth)], POP))
+    spare = free + [where[Slot(d)] for d in popped + loaded if d >= sp]
+    code += skip(skipped, spare + [base])
+
+    if Slot(sp) in needed and sp not in unloaded:
+        code.append(Instruction(SET, where[Slot(sp)], PEEK))
+
+    if base is not None:
+        code.append(Instruction(SET, base, SP))
+        for depth in loaded:
+            if depth != sp:
+                code.append(Instruction(SET, where[Slot(depth)],
+                                        [base + (depth - sp)]))
+
+    for i, (depth, value) in enumerate(writes):
+        target = PEEK if reuse and not i else PUSH
+        code.append(Instruction(SET, target, where.get(value, value)))
+
+    if top is not None and top != Slot(0) and where.get(top) is not Z:
+        code.append(Instruction(SET, Z, where.get(top, top)))
+
+    return code
+
+
+def skip(count, spare):
+    """
+    Throw away some slots from the top of the stack. A single slot is cheaper
+    to pop into a spare register, if there is one.
+    """
+
+    if not count:
+        return []
+    spare = [register for register in spare if register is not None]
+    if count == 1 and spare:
+        return [Instruction(SET, spare[0], POP)]
+    return [Instruction(ADD, SP, count)]
+
+
+def collapse(run, effects=effects, tos=False):
+    """
+    Turn a run of shuffle words into a Shuffle, if it has any shuffles in it
+    and can be compiled.
+    """
+
+    if any(word in effects for word in run):
+        effect = simulate(run, effects)
+        if shuffle(effect, tos) is not None:
+            return [Shuffle(tuple(run), effect)]
+    return list(run)
+
+
+def gather(words, effects=effects, tos=False):
+    """
+    Replace each run of shuffle words in a list of words with a Shuffle.
+
+    A run is cut short if it would need more registers than there are.
+    """
+
+    rv = []
+    run = []
+
+    for word in words:
+        if not shuffling(word, effects):
+            rv += collapse(run, effects, tos)
+            run = []
+            rv.append(word)
+            continue
+
+        if run and shuffle(simulate(run + [word], effects), tos) is None:
+            rv += collapse(run, effects, tos)
+            run = []
+        run.append(word)
+
+    rv += collapse(run, effects, tos)
+    return rv
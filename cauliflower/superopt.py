@@ -0,0 +1,339 @@
+"""
+A superoptimizer for short, straight-line templates.
+
+Candidates are built out of a small alphabet of instructions, made from the
+opcodes and operands of a reference sequence along with the scratch registers,
+the stack, and some small literals. Every candidate which would be shorter or
+faster than the reference is run next to it on the same random machine
+states, and a candidate which leaves every live register and every live word
+of memory the same as the reference does, on every state, is a winner.
+
+Passing the tests only makes it very likely that a winner is equivalent to the
+reference, not certain, so winners should be read over before they're used.
+
+A template is never compiled alone, either: the peephole optimizer works on
+it along with its neighbours, and with JSR calls, its stack moves into a
+register. A winner is only worth using if it still wins once that's done.
+"""
+
+from array import array
+from random import Random
+
+from cauliflower import emulator
+from cauliflower.assembler import (A, ADD, AND, B, BOR, C, DIV, I, IFB, IFE,
+                                   IFG, IFN, J, MOD, MUL, O, PC, PEEK, POP,
+                                   PUSH, SET, SHL, SHR, SP, SUB, X, XOR, Y, Z,
+                                   Instruction, Offset, lookup, rdict)
+from cauliflower.control import data_stack, move_stack
+from cauliflower.emulator import CPU, cost
+from cauliflower.peephole import optimize
+
+# Candidates are loaded at the bottom of memory, and nothing is compared below
+# DATA, since the candidates and the reference have different code there.
+DATA = 0x100
+
+# Registers which no template expects to survive past its own end.
+scratch = A, B, C
+
+# Everything else is live, unless told otherwise.
+everything = A, B, C, X, Y, Z, I, J
+
+# How much of the stack below SP is filled in, and thrown away afterwards.
+slack = 0x20
+
+names = {
+    A: "A", B: "B", C: "C", X: "X", Y: "Y", Z: "Z", I: "I", J: "J",
+    POP: "POP", PEEK: "PEEK", PUSH: "PUSH", SP: "SP", PC: "PC", O: "O",
+}
+opnames = {
+    SET: "SET", ADD: "ADD", SUB: "SUB", MUL: "MUL", DIV: "DIV", MOD: "MOD",
+    SHL: "SHL", SHR: "SHR", AND: "AND", BOR: "BOR", XOR: "XOR", IFE: "IFE",
+    IFN: "IFN", IFG: "IFG", IFB: "IFB",
+}
+
+
+def mentions(v):
+    """
+    Return the register that a value reads or writes, if any.
+    """
+
+    if isinstance(v, list):
+        v, = v
+    if isinstance(v, Offset):
+        v = v.register
+    return v if v in rdict else None
+
+
+def alphabet(reference, ops=(SET,), literals=(0x0, 0x1)):
+    """
+    Make every instruction which a candidate for the reference could be built
+    out of.
+    """
+
+    forms = list(scratch) + [POP, PEEK, PUSH, SP] + list(literals)
+    opcodes = list(ops)
+    for op, a, b in reference:
+        if op not in opcodes:
+            opcodes.append(op)
+        for v in a, b:
+            if v not in forms:
+                forms.append(v)
+
+    rv = []
+    for op in opcodes:
+        for a in forms:
+            # Writing to a literal does nothing at all.
+            if isinstance(a, int):
+                continue
+            for b in forms:
+                if op == SET and a == b:
+                    continue
+                rv.append(Instruction(op, a, b))
+    return rv
+
+
+def states(count, seed=0):
+    """
+    Make some random machine states, as pairs of registers and memory.
+
+    Registers are kept away from the bottom of memory, so that nothing reads
+    the code being tested, and everything near the stack and near where the
+    registers point is filled with junk.
+    """
+
+    rng = Random(seed)
+    for i in range(count):
+        registers = [rng.randrange(0x1000, 0xf000) for register in range(8)]
+        sp = rng.randrange(0x1000, 0xf000)
+        registers += [sp, 0x0, 0x0]
+
+        memory = array("H", [0x0]) * 0x10000
+        for base in registers[:9]:
+            for address in range(base - slack, base + slack):
+                memory[address] = rng.randrange(0x10000)
+        yield registers, memory
+
+
+def execute(words, state, cpu=None, limit=0x100):
+    """
+    Run some encoded code on a copy of a machine state, and return the CPU.
+
+    A CPU can be given to be reused, which saves making a new one every time.
+    """
+
+    registers, memory = state
+    if cpu is None:
+        cpu = CPU()
+    cpu.memory[:] = memory
+    cpu.registers[:] = registers
+    cpu.cycles = 0
+    cpu.halted = False
+    cpu.memory[:len(words) + 1] = array("H", words + [0x0])
+    cpu.run(limit)
+    return cpu
+
+
+def live_registers(cpu, live):
+    """
+    Return the live registers of a CPU, followed by SP.
+    """
+
+    return ([cpu.registers[rdict[register]] for register in live] +
+            [cpu.registers[emulator.SP]])
+
+
+def live_memory(cpu):
+    """
+    Return the live memory of a CPU. Anything just below SP is dead.
+    """
+
+    sp = cpu.registers[emulator.SP]
+    rv = cpu.memory[DATA:]
+    lo = max(sp - slack, DATA)
+    hi = max(sp, lo)
+    rv[lo - DATA:hi - DATA] = array("H", [0x0]) * (hi - lo)
+    return rv
+
+
+def observe(cpu, live):
+    """
+    Return the live parts of a CPU's state.
+    """
+
+    return live_registers(cpu, live), live_memory(cpu)
+
+
+def matches(cpu, live, wanted):
+    """
+    Whether the live parts of a CPU's state are as wanted. Memory is only
+    looked at if the registers match.
+    """
+
+    registers, memory = wanted
+    return (live_registers(cpu, live) == registers and
+            live_memory(cpu) == memory)
+
+
+def words(code):
+    rv = []
+    for op, a, b in code:
+        rv += lookup(op, a, b)
+    return rv
+
+
+def better(candidate, target):
+    """
+    Whether a cost is shorter or faster than another, without being worse in
+    either.
+    """
+
+    return candidate != target and all(x <= y for x, y in
+                                       zip(candidate, target))
+
+
+def canonical(registers):
+    """
+    Whether the scratch registers in a candidate are first used in order.
+    Since they all start out dead, a candidate which uses them in another
+    order is just a renaming of one which doesn't.
+    """
+
+    seen = []
+    for register in registers:
+        if register in scratch and register not in seen:
+            seen.append(register)
+    return seen == list(scratch[:len(seen)])
+
+
+def sequences(letters, costs, length, target):
+    """
+    Yield the indices of every sequence of up to length letters which might
+    beat the target cost, shortest first.
+    """
+
+    for n in range(1, length + 1):
+        stack = [[]]
+        while stack:
+            prefix = stack.pop()
+            if len(prefix) == n:
+                yield prefix
+                continue
+            spent = [sum(costs[i][k] for i in prefix) for k in (0, 1)]
+            for i in reversed(range(len(letters))):
+                if all(s + c <= t for s, c, t in zip(spent, costs[i], target)):
+                    stack.append(prefix + [i])
+
+
+def search(reference, live=None, length=3, count=16, ops=(SET,), seed=0):
+    """
+    Find every sequence of up to length instructions which is shorter or
+    faster than the reference, and does the same thing to the live registers,
+    SP, and memory above SP.
+
+    Returns a list of winners, cheapest first.
+    """
+
+    if live is None:
+        live = [r for r in everything if r not in scratch]
+
+    target = cost(reference)
+    tests = list(states(count, seed))
+    expected = [observe(execute(words(reference), state), live)
+                for state in tests]
+
+    letters = alphabet(reference, ops)
+    costs = [cost([letter]) for letter in letters]
+    encoded = [list(lookup(*letter)) for letter in letters]
+    registers = [[mentions(letter.a), mentions(letter.b)]
+                 for letter in letters]
+
+    cpu = CPU()
+    winners = []
+    for indices in sequences(letters, costs, length, target):
+        total = tuple(sum(costs[i][k] for i in indices) for k in (0, 1))
+        if not better(total, target):
+            continue
+        if not canonical(sum((registers[i] for i in indices), [])):
+            continue
+        code = sum((encoded[i] for i in indices), [])
+        for state, wanted in zip(tests, expected):
+            if not matches(execute(code, state, cpu), live, wanted):
+                break
+        else:
+            winners.append([letters[i] for i in indices])
+
+    winners.sort(key=lambda code: cost(code)[::-1])
+    return winners
+
+
+def settled(code, tos=False, jsr=False):
+    """
+    Return the cost of some code once the compiler is done with it: with its
+    stack moved into a register for JSR calls, and peephole optimized.
+    """
+
+    if jsr:
+        code = move_stack(code, data_stack(tos, jsr))
+    return cost(optimize(code))
+
+
+def holds(reference, winner, contexts, tos=False):
+    """
+    Whether a winner still beats the reference once it's compiled between
+    each of some pairs of code before and after it, with and without JSR
+    calls. It has to be no worse anywhere, and better somewhere.
+    """
+
+    costs = [(settled(before + winner + after, tos, jsr),
+              settled(before + reference + after, tos, jsr))
+             for jsr in (False, True) for before, after in contexts]
+    return (all(all(x <= y for x, y in zip(mine, theirs))
+                for mine, theirs in costs) and
+            any(mine != theirs for mine, theirs in costs))
+
+
+def windows(code):
+    """
+    Split some code into its straight-line runs, which are everything between
+    labels, tests, jumps and data.
+    """
+
+    rv = []
+    run = []
+    for item in code:
+        straight = (isinstance(item, Instruction) and item.op in opnames and
+                    item.op not in (IFB, IFE, IFG, IFN) and
+                    PC not in (item.a, item.b))
+        if straight:
+            run.append(item)
+        else:
+            if run:
+                rv.append(run)
+            run = []
+    if run:
+        rv.append(run)
+    return rv
+
+
+def operand(v):
+    """
+    Write a value the way it would be written in the source.
+    """
+
+    if isinstance(v, list):
+        v, = v
+        return "[%s]" % operand(v)
+    elif isinstance(v, Offset):
+        return "%s + 0x%x" % (names[v.register], v.offset)
+    elif isinstance(v, int):
+        return "0x%x" % v
+    return names[v]
+
+
+def source(instruction):
+    """
+    Write an instruction the way it would be written in the source.
+    """
+
+    op, a, b = instruction
+    return "Instruction(%s, %s, %s)" % (opnames[op], operand(a), operand(b))
@@ -1,6 +1,11 @@
+from array import array
 from unittest import TestCase
 
-from cauliflower.assembler import A, JSR, PC, PUSH, SET, Z, Absolute, assemble
+from cauliflower.assembler import (A, ADD, B, IFE, JSR, PC, POP, PUSH, SET,
+                                   SUB, Z, Absolute, Data, Distance,
+                                   Instruction, Label, Symbol, assemble,
+                                   disassemble, encode, encode_into, link,
+                                   relabel, size, until)
 
 class TestAssembler(TestCase):
 
@@ -35,3 +40,127 @@ class TestAssembler(TestCase):
     def test_set_register_literal(self):
         expected = "\x7c\x01\x00\x30"
         self.assertEqual(expected, assemble(SET, A, 0x30))
+
+    def test_set_push_negative_literal(self):
+        expected = "\x7d\xa1\xff\xfd"
+        self.assertEqual(expected, assemble(SET, PUSH, -3))
+
+    def test_encode_memoized(self):
+        code = [Instruction(SET, [Z], A), Instruction(SET, [Z], B)] * 2
+        self.assertEqual(encode(code), "\x00\xd1\x04\xd1" * 2)
+
+    def test_encode_into(self):
+        buf = array("H", [0xffff]) * 6
+        code = [
+            Instruction(SET, A, 0x30),
+            Data(0x1234),
+            Instruction(SET, PC, Symbol("word")),
+        ]
+        end = encode_into(buf, 1, code, {"word": 0x4})
+        self.assertEqual(end, 6)
+        self.assertEqual(list(buf),
+                         [0xffff, 0x7c01, 0x0030, 0x1234, 0x7dc1, 0x0004])
+
+    def test_instruction_unpack(self):
+        op, a, b = Instruction(SET, A, 0x30)
+        self.assertEqual((op, a, b), (SET, A, 0x30))
+
+    def test_size(self):
+        code = [
+            Instruction(SET, PC, 0x11),
+            Instruction(SET, A, 0x30),
+            Instruction(JSR, Symbol("main")),
+            Label("main"),
+            Data(0x0),
+        ]
+        self.assertEqual(size(code), 6)
+
+    def test_link_label(self):
+        code = [
+            Instruction(SET, PC, Symbol("end")),
+            Instruction(SET, A, 0x30),
+            Label("end"),
+        ]
+        # The label is close enough to be an inline literal.
+        expected = "\x91\xc1\x7c\x01\x00\x30"
+        self.assertEqual(expected, link(code, 0x1))
+
+    def test_link_label_long(self):
+        code = [
+            Instruction(SET, PC, Symbol("end")),
+            Instruction(SET, A, 0x30),
+            Label("end"),
+        ]
+        expected = "\x7d\xc1\x00\x24\x7c\x01\x00\x30"
+        self.assertEqual(expected, link(code, 0x20))
+
+    def test_link_distance(self):
+        code = [
+            Instruction(ADD, PC, Distance("start", "end")),
+            Label("start"),
+            Instruction(SET, A, 0x30),
+            Label("end"),
+        ]
+        expected = "\x89\xc2\x7c\x01\x00\x30"
+        self.assertEqual(expected, link(code))
+        self.assertEqual(size(code), 3)
+
+    def test_relaxation(self):
+        code = [
+            Label("top"),
+            Instruction(ADD, PC, Distance("start", "end")),
+            Label("start"),
+        ]
+        code += [Instruction(SET, A, B)] * 0x1d
+        code += [
+            Label("end"),
+            Instruction(SUB, PC, Distance("top", "bottom")),
+            Label("bottom"),
+        ]
+        self.assertEqual(size(code), 0x1f)
+        # Only the backwards jump grows, once it no longer fits inline.
+        code[3:3] = [Instruction(SET, A, B)] * 2
+        self.assertEqual(size(code), 0x22)
+
+    def test_relabel(self):
+        code = [
+            Label("top"),
+            Instruction(SUB, PC, Distance("top", "bottom")),
+            Instruction(SET, PC, Symbol("top")),
+            Instruction(SET, PC, Symbol("elsewhere")),
+            Label("bottom"),
+        ]
+        copy = relabel(code)
+        self.assertNotEqual(copy[0].name, "top")
+        self.assertEqual(copy[1].b, Distance(copy[0].name, copy[4].name))
+        self.assertEqual(copy[2].b, Symbol(copy[0].name))
+        self.assertEqual(copy[3], code[3])
+        self.assertEqual(size(copy), size(code))
+
+    def test_relabel_fresh(self):
+        code = [Label("a"), Instruction(SET, PC, Symbol("a")), Label("b")]
+        copy = relabel(code, iter(["x", "y"]).next)
+        self.assertEqual([copy[0].name, copy[2].name], ["x", "y"])
+        self.assertEqual(copy[1], Instruction(SET, PC, Symbol("x")))
+
+    def test_until(self):
+        code = until([Instruction(ADD, A, 0x1)], (IFE, A, 0x10))
+        self.assertEqual(size(code), 3)
+        self.assertEqual(link(code)[-2:], "\x8d\xc3")
+
+    def test_link_symbol(self):
+        expected = "\x7c\x10\x00\x42"
+        code = [Instruction(JSR, Symbol("word"))]
+        self.assertEqual(expected, link(code, symbols={"word": 0x42}))
+
+    def test_link_unknown_symbol(self):
+        code = [Instruction(JSR, Symbol("word"))]
+        self.assertRaises(Exception, link, code)
+
+    def test_disassemble(self):
+        code = [
+            Instruction(SET, PC, Absolute(0x11)),
+            Instruction(SET, [Z + 0x1234], POP),
+            Instruction(JSR, 0x42),
+        ]
+        self.assertEqual(disassemble(encode(code)), code)
@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+from cauliflower.assembler import SET, X, Z, Data, Instruction, encode
+from cauliflower.builtins import Immediate, builtin, binops, prims
+from cauliflower.emulator import run
+
+def execute(words, tos=False):
+    """
+    Run some builtins and return the resulting stack, top first.
+    """
+
+    # Keep the return stack well away from the data stack.
+    code = [Instruction(SET, X, 0xc000)]
+    for word in words:
+        code += builtin(word, tos)
+    code.append(Data(0x0))
+    cpu = run(encode(code))
+    if tos:
+        # The bottom of the stack is whatever Z held before the first push.
+        return [cpu.register(Z)] + cpu.stack()[:-1]
+    return cpu.stack()
+
+class TestTOS(TestCase):
+
+    setup = ["3", "5", "7", "11"]
+
+    def test_prims(self):
+        for prim in prims:
+            if prim in (">r", "r@", "rdrop"):
+                continue
+            words = self.setup + [prim]
+            self.assertEqual(execute(words, True), execute(words), prim)
+
+    def test_binops(self):
+        for op in binops:
+            words = self.setup + [op]
+            self.assertEqual(execute(words, True), execute(words), op)
+
+    def test_return_stack(self):
+        words = self.setup + [">r", "r@", "+", "r@", "rdrop"]
+        self.assertEqual(execute(words, True), execute(words))
+
+    def test_immediates(self):
+        for op in binops:
+            for i in (0, 1, 3, 8, 0x40):
+                words = self.setup + [Immediate(op, i)]
+                self.assertEqual(execute(words, True), execute(words),
+                                 (op, i))
+
+class TestImmediate(TestCase):
+
+    def test_matches_stack(self):
+        for op in binops:
+            for i in (0, 1, 2, 3, 8, 0x40, 0xfffd):
+                words = ["3", "5", "1234", Immediate(op, i)]
+                expected = ["3", "5", "1234", str(i), op]
+                self.assertEqual(execute(words), execute(expected), (op, i))
+
+    def test_strength_reduction(self):
+        for op in "*", "/", "mod":
+            ucode = builtin(Immediate(op, 8))
+            self.assertNotIn(binops[op], [i.op for i in ucode], op)
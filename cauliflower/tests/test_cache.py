@@ -0,0 +1,93 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from cauliflower.assembler import (ADD, JSR, PC, POP, SET, Z, Distance,
+                                   Instruction, Label, Symbol)
+from cauliflower.cache import Cache
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.cache = Cache(self.directory, 0x10000)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_miss(self):
+        self.assertEqual(self.cache.get(self.cache.key("nothing")), None)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_key(self):
+        self.assertEqual(self.cache.key("a", (1, 2)),
+                         self.cache.key("a", (1, 2)))
+        self.assertNotEqual(self.cache.key("a", (1, 2)),
+                            self.cache.key("a", (2, 1)))
+
+    def test_roundtrip(self):
+        code = [
+            Label("top"),
+            Instruction(SET, [Z + 0x1], POP),
+            Instruction(ADD, PC, Distance("top", "top")),
+            Instruction(JSR, Symbol("word")),
+        ]
+        key = self.cache.key("word")
+        self.cache.put(key, {"code": code})
+        loaded = self.cache.get(key)["code"]
+        self.assertEqual(loaded[1:], code[1:])
+        self.assertEqual(loaded[0].name, "top")
+        # Registers and opcodes have to be the very same objects.
+        self.assertTrue(loaded[1].b is POP)
+        self.assertTrue(loaded[1].a[0].register is Z)
+        self.assertTrue(loaded[3].op is JSR)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_evict(self):
+        cache = Cache(self.directory, 0x200)
+        for i in range(8):
+            cache.put(cache.key(i), "x" * 0x80)
+        self.assertTrue(cache.evictions)
+        self.assertTrue(sum(size for path, mtime, size in cache.usage())
+                        <= 0x200)
+        # The most recent entry survives.
+        self.assertEqual(cache.get(cache.key(7)), "x" * 0x80)
+
+    def test_shared(self):
+        # Another compiler is halfway through writing an entry out, and has
+        # thrown out an entry that this one knows about.
+        with open(os.path.join(self.directory, ".partial.1"), "wb") as f:
+            f.write("x" * 0x100)
+        for i in range(3):
+            self.cache.put(self.cache.key(i), "x")
+        os.remove(self.cache.path(self.cache.key(0)))
+        self.assertEqual(sorted(path for path, mtime, size in
+                                self.cache.usage()),
+                         sorted(self.cache.path(self.cache.key(i))
+                                for i in (1, 2)))
+        self.cache.limit = 0
+        self.cache.evict()
+        self.assertEqual(self.cache.evictions, 2)
+
+    def test_damaged(self):
+        key = self.cache.key("word")
+        for length in 0, 0x10:
+            self.cache.put(key, {"code": [Instruction(JSR, Symbol("word"))]})
+            with open(self.cache.path(key), "rb") as f:
+                saved = f.read()
+            with open(self.cache.path(key), "wb") as f:
+                f.write(saved[:length])
+            self.assertEqual(self.cache.get(key), None)
+            self.assertFalse(os.path.exists(self.cache.path(key)))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_abandoned(self):
+        old = os.path.join(self.directory, ".old.1")
+        new = os.path.join(self.directory, ".new.2")
+        for path in old, new:
+            with open(path, "wb") as f:
+                f.write("x")
+        os.utime(old, (0, 0))
+        self.cache.evict()
+        self.assertEqual(os.listdir(self.directory), [".new.2"])
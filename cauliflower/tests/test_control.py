@@ -0,0 +1,230 @@
+from unittest import TestCase
+
+from cauliflower.assembler import (ADD, C, I, IFE, IFN, J, PC, PEEK, POP,
+                                   SET, SP, PUSH, X, Z, Data, Instruction,
+                                   Label, Symbol, link)
+from cauliflower.builtins import binops, builtin, prims, tos_prims
+from cauliflower.control import (begin_until, begin_while, call, call_stack,
+                                 data_stack, do_loop, if_alone, if_else,
+                                 if_then, jump, move_stack, ret)
+from cauliflower.emulator import CPU, run
+
+def stack(cpu, tos=False, jsr=False):
+    """
+    Return the data stack of a halted CPU, top first.
+    """
+
+    if jsr:
+        return cpu.memory[cpu.register(data_stack(tos, jsr)):0xd000].tolist()
+    return cpu.stack()
+
+def execute(flag, tail, tos=False, jsr=False):
+    """
+    Call a word which ends with a branch on the flag, made as a tail or not,
+    and return the resulting stack, top first.
+    """
+
+    if jsr:
+        code = [Instruction(SET, data_stack(tos, jsr), 0xd000)]
+    else:
+        code = [Instruction(SET, call_stack(tos), 0xd000)]
+    code += call(Symbol("branch"), tos, jsr)
+    code.append(Instruction(SET, PUSH, 0x99))
+    code.append(Data(0x0))
+
+    code.append(Label("branch"))
+    code.append(Instruction(SET, PUSH, flag))
+    if tos:
+        # Move the flag into the cached top of the stack.
+        code.append(Instruction(SET, PUSH, Z))
+        code.append(Instruction(SET, Z, flag))
+    code += tail
+
+    code.append(Label("yes"))
+    code.append(Instruction(SET, PUSH, 0x1))
+    code += ret(tos, jsr)
+    code.append(Label("no"))
+    code.append(Instruction(SET, PUSH, 0x2))
+    code += ret(tos, jsr)
+
+    if jsr:
+        code = move_stack(code, data_stack(tos, jsr))
+    return stack(run(link(code)), tos, jsr)
+
+class TestTailCalls(TestCase):
+
+    def test_jump(self):
+        tail = jump(Symbol("yes"))
+        self.assertEqual(execute(0x0, tail)[:2], [0x99, 0x1])
+
+    def test_if_alone(self):
+        for tos in (False, True):
+            expected = [execute(flag, if_alone(Symbol("yes"), tos) + ret(tos),
+                                tos) for flag in (0x0, 0x1)]
+            for jsr in (False, True):
+                plain = (if_alone(Symbol("yes"), tos, jsr=jsr) +
+                         ret(tos, jsr))
+                tail = if_alone(Symbol("yes"), tos, tail=True, jsr=jsr)
+                for flag, wanted in zip((0x0, 0x1), expected):
+                    self.assertEqual(execute(flag, tail, tos, jsr), wanted)
+                    self.assertEqual(execute(flag, plain, tos, jsr), wanted)
+
+    def test_if_else(self):
+        for tos in (False, True):
+            expected = [execute(flag, if_else(Symbol("yes"), Symbol("no"),
+                                              tos) + ret(tos), tos)
+                        for flag in (0x0, 0x1)]
+            for jsr in (False, True):
+                plain = (if_else(Symbol("yes"), Symbol("no"), tos, jsr=jsr) +
+                         ret(tos, jsr))
+                tail = if_else(Symbol("yes"), Symbol("no"), tos, tail=True,
+                               jsr=jsr)
+                for flag, wanted in zip((0x0, 0x1), expected):
+                    self.assertEqual(execute(flag, tail, tos, jsr), wanted)
+                    self.assertEqual(execute(flag, plain, tos, jsr), wanted)
+
+class TestInlineIf(TestCase):
+
+    def test_if_then(self):
+        for tos in (False, True):
+            block = [Instruction(SET, PUSH, 0x1)]
+            plain = if_alone(Symbol("yes"), tos) + ret(tos)
+            inline = if_then(block, tos=tos) + ret(tos)
+            for flag in (0x0, 0x1):
+                self.assertEqual(execute(flag, inline, tos),
+                                 execute(flag, plain, tos))
+
+    def test_if_then_else(self):
+        for tos in (False, True):
+            block = [Instruction(SET, PUSH, 0x1)]
+            otherwise = [Instruction(SET, PUSH, 0x2)]
+            plain = if_else(Symbol("yes"), Symbol("no"), tos) + ret(tos)
+            inline = if_then(block, otherwise, tos) + ret(tos)
+            for flag in (0x0, 0x1):
+                self.assertEqual(execute(flag, inline, tos),
+                                 execute(flag, plain, tos))
+
+def loop(code, stack, tos=False):
+    """
+    Run some code on a stack, given top first, and return the halted CPU. The
+    code should count in C, since testing a flag with a cached top of stack
+    uses A.
+    """
+
+    setup = [Instruction(SET, X, 0xc000)]
+    for value in reversed(stack):
+        setup.append(Instruction(SET, PUSH, value))
+    if tos:
+        setup.append(Instruction(SET, Z, setup.pop().b))
+
+    cpu = CPU()
+    cpu.load(link(setup + code + [Data(0x0)]))
+    cpu.run(0x10000)
+    return cpu
+
+def flag(condition, tos):
+    """
+    Push a flag which is true if a condition holds.
+    """
+
+    if tos:
+        code = [Instruction(SET, PUSH, Z), Instruction(SET, Z, 0x0)]
+        target = Z
+    else:
+        code = [Instruction(SET, PUSH, 0x0)]
+        target = PEEK
+    return code + [condition, Instruction(SET, target, 0x1)]
+
+class TestLoops(TestCase):
+
+    def test_begin_until(self):
+        for tos in (False, True):
+            body = [Instruction(ADD, C, 0x1)]
+            body += flag(Instruction(IFE, C, 0x5), tos)
+            cpu = loop([Instruction(SET, C, 0x0)] + begin_until(body, tos),
+                       [0x99], tos)
+            self.assertEqual(cpu.register(C), 0x5)
+            self.assertEqual(cpu.register(Z) if tos else cpu.stack()[0],
+                             0x99)
+
+    def test_begin_while(self):
+        for tos in (False, True):
+            # The body never runs if the condition starts out false.
+            for start, count in (0x0, 0x5), (0x5, 0x0):
+                condition = flag(Instruction(IFN, C, 0x5), tos)
+                body = [Instruction(ADD, C, 0x1), Instruction(ADD, J, 0x1)]
+                code = [Instruction(SET, C, start), Instruction(SET, J, 0x0)]
+                cpu = loop(code + begin_while(condition, body, tos), [0x99],
+                           tos)
+                self.assertEqual(cpu.register(J), count)
+
+    def test_do_loop(self):
+        body = [Instruction(ADD, PEEK, I)]
+        cpu = loop(do_loop(body), [0x0, 0x5, 0x0])
+        self.assertEqual(cpu.stack()[0], 0xa)
+
+    def test_do_loop_tos(self):
+        body = [Instruction(ADD, Z, I)]
+        cpu = loop(do_loop(body, tos=True), [0x2, 0x5, 0x0], tos=True)
+        self.assertEqual(cpu.register(Z), 0x9)
+
+    def test_do_loop_nested(self):
+        for tos in (False, True):
+            code = [Instruction(SET, I, 0x7), Instruction(SET, J, 0x9)]
+            code += do_loop([], tos, nested=True)
+            cpu = loop(code, [0x4, 0x8, 0x0], tos)
+            self.assertEqual((cpu.register(I), cpu.register(J)), (0x7, 0x9))
+            self.assertEqual(cpu.register(X), 0xc000)
+
+def moved(code, values, tos=False, jsr=False):
+    """
+    Run some code on a stack, given top first, and return the stack that it
+    leaves, with the data stack moved out of SP if asked.
+    """
+
+    setup = [Instruction(SET, data_stack(tos, True), 0xd000)]
+    for value in reversed(values):
+        setup.append(Instruction(SET, PUSH, value))
+    if tos:
+        setup.append(Instruction(SET, Z, setup.pop().b))
+    code = setup + code + [Data(0x0)]
+    if jsr:
+        code = move_stack(code, data_stack(tos, jsr))
+
+    cpu = run(link(code))
+    rv = stack(cpu, tos, jsr)
+    return [cpu.register(Z)] + rv if tos else rv
+
+class TestMoveStack(TestCase):
+
+    values = [0x5, 0x7, 0x9, 0xb, 0xd]
+
+    def test_builtins(self):
+        for tos, table in (False, prims), (True, tos_prims):
+            for word in sorted(table) + sorted(binops) + ["42"]:
+                if word in ("i", "j", ">r", "r@", "rdrop"):
+                    continue
+                code = builtin(word, tos)
+                self.assertEqual(moved(code, self.values, tos, True),
+                                 moved(code, self.values, tos), word)
+
+    def test_tests(self):
+        # A test which guards a push, a test which guards a jump, and SP
+        # being read.
+        for tos in (False, True):
+            for flag in (0x0, 0x1):
+                code = if_then([Instruction(SET, PUSH, 0x3)],
+                               [Instruction(ADD, PEEK, 0x4)], tos)
+                code += [Instruction(IFE, POP, 0x5),
+                         Instruction(SET, PC, Symbol("end"))]
+                code += [Instruction(SET, C, SP),
+                         Instruction(SET, PUSH, [C + 0x1]), Label("end")]
+                self.assertEqual(moved(code, [flag, 0x1] + self.values, tos,
+                                       True),
+                                 moved(code, [flag, 0x1] + self.values, tos))
+
+    def test_fewer_moves(self):
+        # Swapping twice needs the stack register moved not even once.
+        code = builtin("swap") * 2
+        ucode = move_stack(code, Z)
+        self.assertFalse([op for op, a, b in ucode if a is Z])
@@ -0,0 +1,147 @@
+from unittest import TestCase
+
+from cauliflower.assembler import (A, ADD, B, DIV, IFE, IFN, JSR, MUL, PC, POP,
+                                   PUSH, SET, SUB, Z, Absolute, Data,
+                                   Distance, Instruction, Label, Symbol,
+                                   assemble, encode, layout)
+from cauliflower.emulator import O, run
+
+HALT = "\x00\x00"
+
+class TestEmulator(TestCase):
+
+    def test_set_register_literal(self):
+        cpu = run(assemble(SET, A, 0x30) + HALT)
+        self.assertEqual(cpu.register(A), 0x30)
+        # One cycle for SET, one for the trailing literal.
+        self.assertEqual(cpu.cycles, 2)
+
+    def test_inline_literal(self):
+        cpu = run(assemble(SET, A, 0x11) + HALT)
+        self.assertEqual(cpu.register(A), 0x11)
+        self.assertEqual(cpu.cycles, 1)
+
+    def test_push_pop(self):
+        ucode = assemble(SET, PUSH, 0x3)
+        ucode += assemble(SET, PUSH, 0x4)
+        ucode += assemble(SET, A, POP)
+        cpu = run(ucode + HALT)
+        self.assertEqual(cpu.register(A), 0x4)
+        self.assertEqual(cpu.stack(), [0x3])
+
+    def test_add_overflow(self):
+        ucode = assemble(SET, A, 0xffff)
+        ucode += assemble(ADD, A, 0x2)
+        cpu = run(ucode + HALT)
+        self.assertEqual(cpu.register(A), 0x1)
+        self.assertEqual(cpu.registers[O], 0x1)
+        self.assertEqual(cpu.cycles, 4)
+
+    def test_sub_underflow(self):
+        cpu = run(assemble(SUB, A, 0x1) + HALT)
+        self.assertEqual(cpu.register(A), 0xffff)
+        self.assertEqual(cpu.registers[O], 0xffff)
+
+    def test_mul_div(self):
+        ucode = assemble(SET, A, 0x6)
+        ucode += assemble(MUL, A, 0x7)
+        ucode += assemble(DIV, A, 0x2)
+        cpu = run(ucode + HALT)
+        self.assertEqual(cpu.register(A), 21)
+        self.assertEqual(cpu.cycles, 6)
+
+    def test_div_zero(self):
+        ucode = assemble(SET, A, 0x6)
+        ucode += assemble(DIV, A, 0x0)
+        cpu = run(ucode + HALT)
+        self.assertEqual(cpu.register(A), 0x0)
+
+    def test_failed_test_skips_long_instruction(self):
+        ucode = assemble(IFN, A, 0x0)
+        ucode += assemble(SET, A, Absolute(0x1))
+        ucode += assemble(SET, B, 0x2)
+        cpu = run(ucode + HALT)
+        self.assertEqual(cpu.register(A), 0x0)
+        self.assertEqual(cpu.register(B), 0x2)
+        # Three cycles for the failed test and one for SET.
+        self.assertEqual(cpu.cycles, 4)
+
+    def test_passed_test(self):
+        ucode = assemble(IFE, A, 0x0)
+        ucode += assemble(SET, A, 0x1)
+        cpu = run(ucode + HALT)
+        self.assertEqual(cpu.register(A), 0x1)
+        self.assertEqual(cpu.cycles, 3)
+
+    def test_jsr(self):
+        # 0x0: JSR 0x3, 0x2: halt, 0x3: SET A, 0x1, 0x4: SET PC, POP
+        ucode = assemble(JSR, Absolute(0x3))
+        ucode += HALT
+        ucode += assemble(SET, A, 0x1)
+        ucode += assemble(SET, PC, POP)
+        cpu = run(ucode)
+        self.assertEqual(cpu.register(A), 0x1)
+        self.assertEqual(cpu.stack(), [])
+        self.assertEqual(cpu.cycles, 5)
+
+    def test_read_pc(self):
+        ucode = assemble(SET, A, 0x0)
+        ucode += assemble(SET, Z, PC)
+        cpu = run(ucode + HALT)
+        self.assertEqual(cpu.register(Z), 0x2)
+
+    def test_limit(self):
+        self.assertRaises(Exception, run, assemble(SUB, PC, 0x1), 100)
+
+    def test_profile(self):
+        ucode = assemble(JSR, Absolute(0x5))
+        ucode += assemble(JSR, Absolute(0x5))
+        ucode += HALT
+        ucode += assemble(SET, PC, POP)
+        cpu = run(ucode, profile=True)
+        self.assertEqual(cpu.jumps[0x5], 2)
+        # Returns aren't calls.
+        self.assertFalse(0x2 in cpu.jumps)
+
+    def test_profile_loop(self):
+        # A word which starts with a loop is called twice, and tail called
+        # once, but jumps back to its start on every pass.
+        code = [
+            Instruction(JSR, Symbol("spin")),
+            Instruction(JSR, Symbol("spin")),
+            Instruction(SET, PUSH, Symbol("done")),
+            Instruction(SET, PC, Symbol("spin")),
+            Label("done"),
+            Data(0x0),
+            Label("spin"),
+            Instruction(ADD, B, 0x1),
+            Instruction(IFN, B, 0x10),
+            Instruction(SUB, PC, Distance("spin", "bottom")),
+            Label("bottom"),
+            Instruction(SET, B, 0x0),
+            Instruction(SET, PC, POP),
+        ]
+        labels, short = layout(code)
+        image = encode(code, labels, short)
+        cpu = run(image, profile=True)
+        self.assertEqual(cpu.register(B), 0x0)
+        self.assertEqual(cpu.jumps, {labels["spin"]: 3})
+        cpu = run(image, profile=True, entries=[labels["spin"]])
+        self.assertEqual(cpu.jumps, {labels["spin"]: 3})
+
+    def test_profile_fall(self):
+        # The first word tail calls the second by running into it.
+        code = [
+            Instruction(JSR, Symbol("first")),
+            Data(0x0),
+            Label("first"),
+            Instruction(SET, A, 0x1),
+            Label("second"),
+            Instruction(ADD, A, 0x1),
+            Instruction(SET, PC, POP),
+        ]
+        labels, short = layout(code)
+        entries = labels["first"], labels["second"]
+        cpu = run(encode(code, labels, short), profile=True, entries=entries)
+        self.assertEqual(cpu.register(A), 0x2)
+        self.assertEqual(cpu.jumps, dict((entry, 1) for entry in entries))
@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+from cauliflower.builtins import Immediate
+from cauliflower.folding import evaluate, fold, literal
+
+class TestFolding(TestCase):
+
+    def test_literal(self):
+        self.assertEqual(literal("42"), 42)
+        self.assertEqual(literal("-1"), 0xffff)
+        self.assertEqual(literal("dup"), None)
+
+    def test_wraparound(self):
+        self.assertEqual(evaluate("+", 0xffff, 0x2), 0x1)
+        self.assertEqual(evaluate("-", 0x0, 0x1), 0xffff)
+        self.assertEqual(evaluate("*", 0x100, 0x100), 0x0)
+
+    def test_division_by_zero(self):
+        self.assertEqual(evaluate("/", 0x5, 0x0), 0x0)
+        self.assertEqual(evaluate("mod", 0x5, 0x0), 0x0)
+
+    def test_fold(self):
+        self.assertEqual(fold(["3", "4", "+"]), ["7"])
+
+    def test_fold_chain(self):
+        self.assertEqual(fold(["3", "4", "+", "2", "*", "dup"]),
+                         ["14", "dup"])
+
+    def test_fold_order(self):
+        self.assertEqual(fold(["3", "4", "-"]), ["65535"])
+
+    def test_immediate(self):
+        self.assertEqual(fold(["dup", "8", "*"]),
+                         ["dup", Immediate("*", 8)])
+
+    def test_no_fold(self):
+        words = ["dup", "*", "if", "3", "then"]
+        self.assertEqual(fold(words), words)
+
+    def test_idempotent(self):
+        words = fold(["dup", "3", "+", "if", "4", "5", "*", "then"])
+        self.assertEqual(fold(words), words)
@@ -0,0 +1,81 @@
+from tempfile import TemporaryFile
+from unittest import TestCase
+
+from cauliflower.assembler import (ADD, PC, SET, A, Distance, Instruction,
+                                   Label, Symbol)
+from cauliflower.image import Image
+
+class TestImage(TestCase):
+
+    def setUp(self):
+        self.image = Image()
+
+    def test_write(self):
+        self.image.write([0x1234, 0x5678])
+        self.assertEqual(self.image.tell(), 2)
+        self.assertEqual(len(self.image), 2)
+        self.assertEqual(self.image.tostring(), "\x12\x34\x56\x78")
+
+    def test_write_grows(self):
+        for i in range(0x300):
+            self.image.write([i])
+        self.assertEqual(len(self.image), 0x300)
+        self.assertEqual(self.image[0x2ff], 0x2ff)
+
+    def test_seek_patch(self):
+        self.image.write([0x0, 0x0, 0x0])
+        self.image.seek(1)
+        self.image.write([0xffff])
+        self.assertEqual(self.image.tell(), 2)
+        self.assertEqual(len(self.image), 3)
+        self.assertEqual(self.image.tostring(), "\x00\x00\xff\xff\x00\x00")
+
+    def test_setitem(self):
+        self.image.write([0x0, 0x0])
+        self.image[1] = 0xbeef
+        self.assertEqual(self.image.tostring(), "\x00\x00\xbe\xef")
+
+    def test_setitem_outside(self):
+        self.image.write([0x0])
+        self.assertRaises(IndexError, self.image.__setitem__, 1, 0x0)
+
+    def test_view(self):
+        self.image.write([0x1, 0x2, 0x3, 0x4])
+        view = self.image[1:3]
+        self.assertEqual(list(view), [0x2, 0x3])
+        view[0] = 0xaaaa
+        self.assertEqual(self.image[1], 0xaaaa)
+        self.assertEqual(view.tostring(), "\xaa\xaa\x00\x03")
+
+    def test_emit(self):
+        self.image.write([0x0])
+        labels = self.image.emit([
+            Label("top"),
+            Instruction(ADD, A, Distance("top", "bottom")),
+            Instruction(SET, PC, Symbol("top")),
+            Label("bottom"),
+        ])
+        self.assertEqual(labels, {"top": 0x1, "bottom": 0x3})
+        self.assertEqual(self.image.tell(), 0x3)
+        self.assertEqual(self.image.tostring(1), "\x88\x02\x85\xc1")
+
+    def test_fixup(self):
+        self.image.write([0x0, 0x0])
+        self.image.fixup(1, "quit")
+        self.image.resolve({"quit": 0x1234})
+        self.assertEqual(self.image[1], 0x1234)
+        self.assertEqual(self.image.fixups, [])
+
+    def test_fixup_missing(self):
+        self.image.write([0x0])
+        self.image.fixup(0, "quit")
+        self.assertRaises(Exception, self.image.resolve, {})
+
+    def test_tofile(self):
+        self.image.write([0x1234, 0xabcd])
+        f = TemporaryFile()
+        self.image.tofile(f)
+        f.seek(0)
+        self.assertEqual(f.read(), "\x12\x34\xab\xcd")
+        # The image is left in the host's order afterwards.
+        self.assertEqual(self.image[0], 0x1234)
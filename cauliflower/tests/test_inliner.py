@@ -0,0 +1,69 @@
+from StringIO import StringIO
+from unittest import TestCase
+
+from cauliflower.assembler import ADD, PEEK, Instruction
+from cauliflower.inliner import Inliner, load_profile, static_counts
+
+class TestStaticCounts(TestCase):
+
+    def test_counts(self):
+        definitions = [
+            ("sq", ["dup", "*"]),
+            ("cube", ["dup", "sq", "*"]),
+            ("unused", ["sq"]),
+            ("main", ["3", "sq", "cube", "cube"]),
+        ]
+        counts = static_counts(definitions)
+        self.assertEqual(counts["main"], 1)
+        self.assertEqual(counts["cube"], 2)
+        self.assertEqual(counts["sq"], 3)
+        self.assertEqual(counts["unused"], 0)
+
+    def test_load_profile(self):
+        f = StringIO("sq 12\nmain 1\n")
+        self.assertEqual(load_profile(f), {"sq": 12, "main": 1})
+
+class TestInliner(TestCase):
+
+    def setUp(self):
+        self.inliner = Inliner({}, 0x10)
+
+    def body(self, length):
+        return [Instruction(ADD, PEEK, 0x1)] * length
+
+    def test_small(self):
+        self.assertTrue(self.inliner.decide("main", "w", self.body(2), 0))
+
+    def test_cold(self):
+        self.assertFalse(self.inliner.decide("main", "w", self.body(10), 0))
+        self.assertEqual(self.inliner.called, set(["w"]))
+
+    def test_hot(self):
+        self.assertTrue(self.inliner.decide("main", "w", self.body(10), 100))
+        self.assertEqual(self.inliner.growth, 10 - self.inliner.call_size)
+
+    def test_too_cold_for_size(self):
+        self.assertFalse(self.inliner.decide("main", "w", self.body(20), 1))
+
+    def test_budget(self):
+        self.assertTrue(self.inliner.decide("main", "w", self.body(20), 100))
+        self.assertFalse(self.inliner.decide("main", "w", self.body(20), 100))
+        caller, callee, inline, reason = self.inliner.decisions[-1]
+        self.assertEqual(reason, "over budget")
+
+    def test_agrees(self):
+        self.inliner.decide("main", "w", self.body(20), 100)
+        self.inliner.decide("main", "w", self.body(20), 100)
+        checks = self.inliner.checks
+        self.assertEqual([inline for total, inline in checks], [True, False])
+        self.assertTrue(self.inliner.agrees(checks, self.inliner.growth))
+        # With less of the budget left, the first word wouldn't fit either.
+        self.assertFalse(self.inliner.agrees(checks))
+        # Decisions which didn't come down to the budget always agree.
+        self.inliner.decide("main", "w", self.body(1), 100)
+        self.assertEqual(self.inliner.checks, checks)
+
+    def test_weight_parent(self):
+        inliner = Inliner({"main": 3}, 0x10)
+        self.assertEqual(inliner.weight("main_if_0", "main"), 3)
+        self.assertEqual(inliner.weight("other"), 0)
@@ -0,0 +1,232 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from cauliflower import emulator
+from cauliflower.assembler import (PC, SET, J, Y, Z, Data, Instruction,
+                                   Label, Symbol)
+from cauliflower.cache import fingerprint
+from cauliflower.emulator import CPU
+from cauliflower.meta import (SOURCES, UNTIL, MetaAssembler, cached_core,
+                              core, core_directory, hash_name, models)
+
+def execute(ma, words, name="main"):
+    """
+    Add a thread to a core, ending it with a word which halts, and then run
+    it. Returns the halted CPU.
+    """
+
+    if "halt" not in ma.codewords:
+        ma.asm("halt", [Data(0x0)])
+    ma.thread(name, words + ["halt"])
+
+    # Start the same way that the bootloader does.
+    entry = ma.space.tell()
+    ma.emit([
+        Instruction(SET, Y, 0xd000),
+        Instruction(SET, J, Symbol(name)),
+        Instruction(SET, PC, [J]),
+        Label(name),
+        Data(ma.codewords[name]),
+    ])
+
+    cpu = CPU()
+    cpu.load(ma.space.tostring())
+    cpu.registers[emulator.PC] = entry
+    cpu.run(0x4000)
+    return cpu
+
+def bench(model):
+    """
+    Build a core, and time a thread which counts down a loop and then finds
+    the codeword of the latest word in the core, which is quit.
+
+    Returns the halted CPU and the core.
+    """
+
+    ma = core(model)
+    cpu = execute(ma, ["literal", 0x10] +
+                  UNTIL([">r", "r>", "literal", 0xffff, "+"]) +
+                  ["latest", ">cfa"])
+    return cpu, ma
+
+def string(ma, s):
+    """
+    Write a string into a core, and return its address.
+    """
+
+    address = ma.space.tell()
+    ma.space.write([ord(c) for c in s])
+    return address
+
+def find(ma, name, words=[]):
+    """
+    Look a name up after running some words, as if word had just read it.
+    """
+
+    ma.space[ma.HASH] = hash_name(name)
+    address = string(ma, name)
+    return execute(ma, words + ["literal", address, "literal", len(name),
+                                "find"])
+
+class TestModels(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = dict((model, bench(model)) for model in models)
+
+    def test_unknown(self):
+        self.assertRaises(Exception, core, "token")
+
+    def test_same_result(self):
+        for model in models:
+            cpu, ma = self.results[model]
+            self.assertEqual(cpu.register(Z), ma.codewords["quit"])
+            self.assertEqual(cpu.stack(), [0x0, 0x0])
+
+    def test_faster(self):
+        indirect = self.results["indirect"][0].cycles
+        direct = self.results["direct"][0].cycles
+        subroutine = self.results["subroutine"][0].cycles
+        self.assertLess(direct, indirect)
+        self.assertLess(subroutine, direct)
+
+class TestDictionary(TestCase):
+
+    def setUp(self):
+        self.ma = core()
+        # Keep new words clear of the threads that tests add.
+        self.ma.space[self.ma.HERE] = 0x6000
+
+    def test_find(self):
+        for name in "dup", "+", ">cfa", "quit":
+            ma = core()
+            cpu = find(ma, name)
+            self.assertEqual(cpu.register(Z), ma.datawords[name])
+
+    def test_find_immediate(self):
+        cpu = find(self.ma, ";")
+        self.assertEqual(cpu.register(Z), self.ma.datawords[";"])
+
+    def test_find_missing(self):
+        cpu = find(self.ma, "dip")
+        self.assertEqual(cpu.register(Z), 0x0)
+
+    def test_create(self):
+        name = string(self.ma, "frob")
+        cpu = find(self.ma, "frob", ["literal", name, "literal", 0x4,
+                                     "create", "latest", "hidden"])
+        self.assertEqual(cpu.register(Z), cpu.memory[self.ma.LATEST])
+
+    def test_create_hidden(self):
+        name = string(self.ma, "frob")
+        cpu = find(self.ma, "frob", ["literal", name, "literal", 0x4,
+                                     "create"])
+        self.assertEqual(cpu.register(Z), 0x0)
+
+    def test_latest(self):
+        headers = []
+        header = self.ma.space[self.ma.LATEST]
+        while header:
+            headers.append(header)
+            header = self.ma.space[header]
+        self.assertEqual(sorted(headers), sorted(self.ma.datawords.values()))
+
+class TestCached(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, "core")
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_same(self):
+        for model in models:
+            built = core(model)
+            cached_core(model, self.path)
+            ma = cached_core(model, self.path)
+            self.assertEqual(ma.space.tostring(), built.space.tostring())
+            self.assertEqual(ma.codewords, built.codewords)
+            self.assertEqual(ma.asmwords, built.asmwords)
+            self.assertEqual(ma.datawords, built.datawords)
+            self.assertEqual(ma.space.tell(), built.space.tell())
+
+    def test_runs(self):
+        cached_core(path=self.path)
+        ma = cached_core(path=self.path)
+        cpu = find(ma, "dup")
+        self.assertEqual(cpu.register(Z), ma.datawords["dup"])
+
+    def test_fresh(self):
+        cached_core(path=self.path)
+        ma = cached_core(path=self.path)
+        ma.thread("frob", ["dup"])
+        self.assertFalse("frob" in cached_core(path=self.path).codewords)
+
+    def test_stale(self):
+        with open(self.path, "wb") as f:
+            core().save(f, "old")
+        self.assertEqual(MetaAssembler.read(self.path, "new"), None)
+        self.assertNotEqual(MetaAssembler.read(self.path, "old"), None)
+
+    def test_rebuilt(self):
+        with open(self.path, "wb") as f:
+            core("direct").save(f, "old")
+        ma = cached_core("direct", self.path)
+        self.assertEqual(ma.space.tostring(), core("direct").space.tostring())
+        self.assertEqual(MetaAssembler.read(self.path, "old"), None)
+
+    def test_model(self):
+        cached_core("direct", self.path)
+        self.assertEqual(cached_core("subroutine", self.path).model,
+                         "subroutine")
+
+    def test_truncated(self):
+        for length in 0, 2, 0x40, -2:
+            with open(self.path, "wb") as f:
+                core().save(f, "old")
+            with open(self.path, "rb") as f:
+                saved = f.read()
+            with open(self.path, "wb") as f:
+                f.write(saved[:length])
+            self.assertEqual(MetaAssembler.read(self.path, "old"), None)
+            ma = cached_core(path=self.path)
+            self.assertEqual(ma.space.tostring(), core().space.tostring())
+            # And saved again.
+            self.assertNotEqual(MetaAssembler.read(self.path,
+                                                   fingerprint(SOURCES)),
+                                None)
+
+    def test_missing(self):
+        self.assertEqual(MetaAssembler.read(self.path), None)
+
+class TestCoreDirectory(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.saved = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = self.directory
+
+    def tearDown(self):
+        if self.saved is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.saved
+        rmtree(self.directory)
+
+    def test_private(self):
+        directory = core_directory()
+        self.assertEqual(os.stat(directory).st_mode & 0777, 0700)
+        cached_core()
+        self.assertTrue(os.path.exists(os.path.join(directory,
+                                                    "indirect.core")))
+
+    def test_shared(self):
+        directory = os.path.join(self.directory, "cauliflower")
+        os.mkdir(directory)
+        os.chmod(directory, 0777)
+        self.assertEqual(core_directory(), None)
+        cached_core()
+        self.assertEqual(os.listdir(directory), [])
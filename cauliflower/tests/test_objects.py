@@ -0,0 +1,193 @@
+import os
+from shutil import copy, copytree, rmtree
+from StringIO import StringIO
+from subprocess import check_output
+import sys
+from tempfile import mkdtemp, mkstemp
+from unittest import TestCase
+
+from cauliflower.assembler import (A, ADD, PC, PUSH, SET, Data, Distance,
+                                   Instruction, Label, Symbol)
+from cauliflower.cache import dump
+from cauliflower.control import call, jump, ret
+from cauliflower.emulator import run
+from cauliflower.objects import Object, link_objects, open_object, scopes
+
+start = call(Symbol("main"), False) + [Data(0x0)]
+
+def library():
+    """
+    Make an object with a word which loops, one which falls through to it,
+    and one that nothing uses.
+    """
+
+    obj = Object((False, False))
+    obj.add("count", False, [], [
+        Label("top"),
+        Instruction(ADD, PC, Distance("top", "top")),
+    ] + ret(False))
+    obj.add("seven", False, [Instruction(SET, PUSH, 0x7)],
+            [Instruction(SET, PUSH, 0x7)] + jump(Symbol("count")))
+    obj.add("unused", False, [], ret(False), weight=0x10)
+    obj.add("twice", True, [Instruction(SET, PUSH, 0x2)], None)
+    return obj
+
+class TestObject(TestCase):
+
+    def test_roundtrip(self):
+        obj = library()
+        f = StringIO()
+        obj.save(f)
+        f.seek(0)
+        loaded = Object.read(f)
+        self.assertEqual(loaded.order, obj.order)
+        self.assertEqual(loaded.abi, obj.abi)
+        self.assertEqual(loaded.sections["seven"], obj.sections["seven"])
+        self.assertEqual(loaded.relocations["seven"], ["count"])
+        self.assertTrue(loaded.sections["count"][1].op is ADD)
+
+    def test_version(self):
+        f = StringIO()
+        obj = library()
+        dump((0, obj.__dict__), f)
+        f.seek(0)
+        self.assertRaises(Exception, Object.read, f)
+
+    def test_open(self):
+        handle, path = mkstemp()
+        try:
+            with os.fdopen(handle, "wb") as f:
+                library().save(f)
+            obj = open_object(path)
+            self.assertTrue(open_object(path) is obj)
+            with open(path, "wb") as f:
+                Object((True, False)).save(f)
+            os.utime(path, (0, 0))
+            self.assertEqual(open_object(path).abi, (True, False))
+        finally:
+            os.remove(path)
+
+    def test_current(self):
+        obj = Object((False, False), "source", "compiler")
+        self.assertTrue(obj.current((False, False), "source", "compiler"))
+        self.assertFalse(obj.current((True, False), "source", "compiler"))
+        self.assertFalse(obj.current((False, False), "changed", "compiler"))
+        self.assertFalse(obj.current((False, False), "source", "changed"))
+
+    def test_prebuilt_compiler(self):
+        """
+        A prebuilt prelude made by another version of the compiler isn't
+        used.
+        """
+
+        top = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+        scratch = mkdtemp()
+        try:
+            for name in "test.py", "prelude.forth":
+                copy(os.path.join(top, name), scratch)
+            copytree(os.path.join(top, "cauliflower"),
+                     os.path.join(scratch, "cauliflower"))
+            os.mkdir(os.path.join(scratch, "lib"))
+            source = os.path.join(scratch, "source.forth")
+            with open(source, "wb") as f:
+                f.write(": main 1 ;\n")
+            compiler = [sys.executable, os.path.join(scratch, "test.py"),
+                        source, os.path.join(scratch, "output")]
+            # Build the prelude's object with this compiler, then check that
+            # it's used until the compiler changes.
+            check_output([sys.executable, os.path.join(scratch, "test.py"),
+                          os.path.join(scratch, "prelude.forth"),
+                          os.path.join(scratch, "lib", "prelude.obj"),
+                          "--object", "--no-prelude"])
+            self.assertFalse("Compiling prelude" in check_output(compiler))
+            with open(os.path.join(scratch, "cauliflower", "reader.py"),
+                      "ab") as f:
+                f.write("\n")
+            self.assertTrue("Compiling prelude" in check_output(compiler))
+        finally:
+            rmtree(scratch)
+
+    def test_readded(self):
+        obj = Object((False, False))
+        obj.add("a", False, [], ret(False), shuffle="effect", indexed=True)
+        obj.add("a", False, [], ret(False))
+        self.assertFalse("a" in obj.shuffles)
+        self.assertFalse("a" in obj.indexed)
+
+    def test_inline(self):
+        obj = library()
+        self.assertFalse("twice" in obj.sections)
+        words = dict((name, (inline, body))
+                     for name, inline, ucode, body in obj.words())
+        self.assertEqual(words["twice"], (True, None))
+
+    def test_labels(self):
+        body = library().sections["count"]
+        self.assertEqual(body[0].name, ".count.0")
+        self.assertEqual(body[1].b, Distance(".count.0", ".count.0"))
+
+    def test_words_relabelled(self):
+        name, inline, ucode, body = next(library().words())
+        self.assertNotEqual(body[0].name, "top")
+        self.assertEqual(body[1].b, Distance(body[0].name, body[0].name))
+
+class TestLink(TestCase):
+
+    def main(self, words):
+        obj = Object((False, False))
+        obj.add("main", False, [], [Instruction(SET, A, 0x1)] + words)
+        return obj
+
+    def test_link(self):
+        image, symbols, placed, removed = link_objects(
+            [library(), self.main(jump(Symbol("seven")))], start, ["main"])
+        self.assertEqual([name for name, body in placed],
+                         ["main", "seven", "count"])
+        self.assertEqual([name for name, n in removed], ["unused"])
+        # Both jumps fall through.
+        self.assertEqual(symbols["count"], symbols["seven"] + 1)
+        self.assertEqual(run(image).stack(), [0x7])
+
+    def test_weights(self):
+        image, symbols, placed, removed = link_objects(
+            [library(), self.main(call(Symbol("unused"), False) +
+                                  jump(Symbol("seven")))],
+            start, ["main"], {"main": 0x1, "unused": 0x0})
+        self.assertEqual(placed[-1][0], "unused")
+
+    def test_redefined(self):
+        obj = self.main(ret(False))
+        obj.add("seven", False, [], [Instruction(SET, PUSH, 0x8)] + ret(False))
+        image, symbols, placed, removed = link_objects(
+            [library(), obj], start, ["main", "seven"])
+        self.assertEqual(dict(placed)["seven"][0].b, 0x8)
+
+    def test_redefined_callee(self):
+        # The library's seven keeps jumping to the library's count.
+        obj = self.main(jump(Symbol("seven")))
+        obj.add("count", False, [], [Instruction(SET, PUSH, 0x8)] +
+                ret(False))
+        image, symbols, placed, removed = link_objects(
+            [library(), obj], start, ["main", "count"])
+        self.assertEqual(symbols["count~0"], symbols["seven"] + 1)
+        self.assertEqual(run(image).stack(), [0x7])
+
+    def test_scopes(self):
+        later = Object((False, False))
+        later.add("count", False, [], ret(False))
+        first, second = scopes([library(), later], ["seven"])
+        self.assertEqual(first["count"], "count~0")
+        self.assertEqual(first["seven"], "seven~0")
+        self.assertEqual(second["count"], "count")
+        self.assertEqual(second["seven"], "seven~0")
+        self.assertEqual(second["twice"], "twice")
+
+    def test_undefined(self):
+        self.assertRaises(Exception, link_objects,
+                          [self.main(jump(Symbol("eight")))], start, ["main"])
+        self.assertRaises(Exception, link_objects, [library()], start,
+                          ["main"])
+
+    def test_abi(self):
+        self.assertRaises(Exception, link_objects,
+                          [library(), Object((True, False))], start, ["main"])
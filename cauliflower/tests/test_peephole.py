@@ -0,0 +1,93 @@
+from unittest import TestCase
+
+from cauliflower.assembler import (A, ADD, B, IFE, MUL, PC, PEEK, POP, PUSH,
+                                   SET, SP, SUB, Z, Data, Instruction, encode)
+from cauliflower.builtins import builtin
+from cauliflower.emulator import run
+from cauliflower.peephole import optimize
+
+class TestPeephole(TestCase):
+
+    def test_push_pop(self):
+        code = [
+            Instruction(SET, PUSH, 0x3),
+            Instruction(SET, A, POP),
+        ]
+        self.assertEqual(optimize(code), [Instruction(SET, A, 0x3)])
+
+    def test_push_pop_same(self):
+        code = [
+            Instruction(SET, PUSH, A),
+            Instruction(SET, A, POP),
+        ]
+        self.assertEqual(optimize(code), [])
+
+    def test_pop_push(self):
+        code = [
+            Instruction(SET, A, POP),
+            Instruction(SET, PUSH, A),
+        ]
+        self.assertEqual(optimize(code), [Instruction(SET, A, PEEK)])
+
+    def test_push_drop(self):
+        code = [
+            Instruction(SET, PUSH, 0x3),
+            Instruction(ADD, SP, 0x1),
+        ]
+        self.assertEqual(optimize(code), [])
+
+    def test_literal_binop(self):
+        code = builtin("3") + builtin("+")
+        self.assertEqual(optimize(code), [Instruction(ADD, PEEK, 0x3)])
+
+    def test_tos_square(self):
+        code = builtin("dup", True) + builtin("*", True)
+        self.assertEqual(optimize(code), [Instruction(MUL, Z, Z)])
+
+    def test_tos_literal_binop(self):
+        code = builtin("3", True) + builtin("-", True)
+        self.assertEqual(optimize(code), [Instruction(SUB, Z, 0x3)])
+
+    def test_tos_literal_commutative(self):
+        code = builtin("3", True) + builtin("+", True)
+        self.assertEqual(optimize(code), [Instruction(ADD, Z, 0x3)])
+
+    def test_forward_live(self):
+        code = [
+            Instruction(SET, A, 0x3),
+            Instruction(ADD, PEEK, A),
+            Instruction(SET, PUSH, A),
+        ]
+        self.assertEqual(optimize(code), code)
+
+    def test_conditional_untouched(self):
+        code = [
+            Instruction(IFE, B, 0x0),
+            Instruction(SET, PUSH, A),
+            Instruction(SET, A, POP),
+        ]
+        self.assertEqual(optimize(code), code)
+
+    def test_relative_jump_untouched(self):
+        code = [
+            Instruction(ADD, PC, 0x2),
+            Instruction(SET, PUSH, A),
+            Instruction(SET, A, POP),
+        ]
+        self.assertEqual(optimize(code), code)
+
+    def test_stats(self):
+        stats = {}
+        optimize(builtin("3") + builtin("+"), stats=stats)
+        self.assertEqual(stats["push_pop"], (1, 1))
+        self.assertEqual(stats["forward"], (1, 1))
+
+    def test_equivalent(self):
+        words = "3 4 dup rot + swap over * 2 - 7 and".split()
+        code = []
+        for word in words:
+            code += builtin(word)
+        expected = run(encode(code + [Data(0x0)]))
+        cpu = run(encode(optimize(code) + [Data(0x0)]))
+        self.assertEqual(cpu.stack(), expected.stack())
+        self.assertTrue(cpu.cycles < expected.cycles)
@@ -0,0 +1,55 @@
+from unittest import TestCase
+
+from cauliflower.assembler import A, IFE, PC, POP, SET, Z, Instruction, Symbol
+from cauliflower.placement import arrange, reachable, successor
+
+def jump(name):
+    return Instruction(SET, PC, Symbol(name))
+
+ret = Instruction(SET, PC, [Z])
+
+class TestPlacement(TestCase):
+
+    bodies = {
+        "main": [jump("a")],
+        "a": [Instruction(SET, A, 0x1), jump("b")],
+        "b": [Instruction(SET, A, Symbol("c")), ret],
+        "c": [ret],
+        "dead": [jump("a")],
+    }
+
+    def test_reachable(self):
+        self.assertEqual(reachable(self.bodies, ["main"]),
+                         set(["main", "a", "b", "c"]))
+
+    def test_reachable_export(self):
+        self.assertTrue("dead" in reachable(self.bodies, ["main", "dead"]))
+
+    def test_successor(self):
+        self.assertEqual(successor(self.bodies["a"]), "b")
+        self.assertEqual(successor(self.bodies["b"]), None)
+
+    def test_successor_conditional(self):
+        code = [Instruction(IFE, 0x0, POP), jump("a")]
+        self.assertEqual(successor(code), None)
+
+    def test_arrange_falls_through(self):
+        counts = {"main": 1, "a": 1, "b": 1, "c": 5}
+        placed = arrange(self.bodies, counts, ["main"])
+        self.assertEqual([name for name, body in placed],
+                         ["c", "main", "a", "b"])
+        bodies = dict(placed)
+        self.assertEqual(bodies["main"], [])
+        self.assertEqual(bodies["a"], [Instruction(SET, A, 0x1)])
+        self.assertEqual(bodies["b"], self.bodies["b"])
+
+    def test_arrange_hottest_caller(self):
+        bodies = {
+            "x": [jump("z")],
+            "y": [jump("z")],
+            "z": [ret],
+        }
+        counts = {"x": 1, "y": 3, "z": 4}
+        placed = arrange(bodies, counts, ["x", "y"])
+        self.assertEqual([name for name, body in placed], ["y", "z", "x"])
+        self.assertEqual(dict(placed)["x"], [jump("z")])
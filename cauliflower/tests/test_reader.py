@@ -0,0 +1,138 @@
+from cPickle import dumps, loads
+from StringIO import StringIO
+from unittest import TestCase
+
+from cauliflower.reader import (Do, If, Until, While, blocks, definitions,
+                                dependencies, scoped, tokenize, walk)
+
+def read(source):
+    return list(definitions(tokenize(StringIO(source), "test.forth")))
+
+class TestReader(TestCase):
+
+    def test_tokenize(self):
+        tokens = list(tokenize(StringIO(": Sq\n  DUP * ;"), "test.forth"))
+        self.assertEqual(tokens, [":", "sq", "dup", "*", ";"])
+        self.assertEqual(tokens[2].position, "test.forth:2:3")
+
+    def test_pickle(self):
+        token = next(tokenize(StringIO("  dup"), "test.forth"))
+        copy = loads(dumps(token, 2))
+        self.assertEqual(copy, "dup")
+        self.assertEqual(copy.position, "test.forth:1:3")
+
+    def test_definition(self):
+        self.assertEqual(read(": sq dup * ;"), [("sq", ["dup", "*"])])
+
+    def test_comment(self):
+        self.assertEqual(read("( x -- x*x ) : sq ( x ) dup * ;"),
+                         [("sq", ["dup", "*"])])
+
+    def test_if(self):
+        self.assertEqual(read(": f if 1 else 2 then 3 ;"),
+                         [("f", [If(("1",), ("2",)), "3"])])
+
+    def test_if_alone(self):
+        self.assertEqual(read(": f if 1 then ;"), [("f", [If(("1",), None)])])
+
+    def test_nested_if(self):
+        words = read(": f if if 1 then else 2 if 3 else 4 then then ;")[0][1]
+        self.assertEqual(words, [
+            If((If(("1",), None),), ("2", If(("3",), ("4",)))),
+        ])
+        self.assertEqual(list(walk(words)), ["1", "2", "3", "4"])
+        self.assertEqual(list(blocks(words)), [
+            (If(("1",), None),), ("2", If(("3",), ("4",))), ("1",), ("3",),
+            ("4",),
+        ])
+
+    def test_errors(self):
+        for source, position in [
+            (": f 1 then ;", "1:7"),
+            (": f if 1 ;", "1:5"),
+            (": f if 1 else 2 else 3 then ;", "1:17"),
+            (": ;", "1:1"),
+            ("1 : f ;", "1:1"),
+            (": f 1 ) ;", "1:7"),
+            (": f ( 1 ;", "1:5"),
+            (": f 1", "1:1"),
+            (": f : g ;", "1:5"),
+        ]:
+            try:
+                read(source)
+            except Exception as e:
+                self.assertTrue(str(e).startswith("test.forth:" + position),
+                                (source, str(e)))
+            else:
+                self.fail(source)
+
+    def test_until(self):
+        self.assertEqual(read(": f begin 1 - dup until ;"),
+                         [("f", [Until(("1", "-", "dup"))])])
+
+    def test_while(self):
+        self.assertEqual(read(": f begin dup while 1 - repeat ;"),
+                         [("f", [While(("dup",), ("1", "-"))])])
+
+    def test_do(self):
+        words = read(": f 4 0 do i if 1 then loop ;")[0][1]
+        self.assertEqual(words, ["4", "0", Do(("i", If(("1",), None)))])
+        self.assertEqual(list(walk(words)), ["4", "0", "i", "1"])
+        self.assertEqual(list(blocks(words)), [("1",)])
+
+    def test_dependencies(self):
+        definitions = read("""
+            : sq dup * ;
+            : f if sq then ;
+            : g 2 ;
+            : h begin f until 0 if 1 then ;
+            : sq sq sq ;
+            : k g if 1 then sq ;
+        """)
+        # The second sq needs the first, and k needs both of them, along
+        # with h, which holds the same block first.
+        self.assertEqual(dependencies(definitions),
+                         [[], [0], [], [1], [0], [0, 2, 3, 4]])
+
+    def test_scoped(self):
+        definitions = scoped(read("""
+            : a 1 ;
+            : f dup if a then begin a until ;
+            : a a 2 ;
+            : main a ;
+        """))
+        self.assertEqual(definitions, [
+            ("a~0", ["1"]),
+            ("f", ["dup", If(("a~0",), None), Until(("a~0",))]),
+            ("a", ["a~0", "2"]),
+            ("main", ["a"]),
+        ])
+        # Renamed words still know where they came from.
+        self.assertEqual(definitions[1][1][1].then[0].position,
+                         "test.forth:3:24")
+
+    def test_scoped_imported(self):
+        definitions = scoped(read(": f a ; : a 2 ; : g a ;"), ["a", "b"])
+        self.assertEqual(definitions, [("f", ["a~0"]), ("a", ["2"]),
+                                       ("g", ["a"])])
+        self.assertEqual(scoped(read(": f a b ;"), ["a", "b"]),
+                         [("f", ["a", "b"])])
+
+    def test_loop_errors(self):
+        for source, position in [
+            (": f begin 1 ;", "1:5"),
+            (": f do 1 ;", "1:5"),
+            (": f 1 until ;", "1:7"),
+            (": f begin 1 loop ;", "1:13"),
+            (": f begin 1 repeat ;", "1:13"),
+            (": f begin 1 while 2 until ;", "1:21"),
+            (": f do 1 while 2 loop ;", "1:10"),
+            (": f if begin then until ;", "1:14"),
+        ]:
+            try:
+                read(source)
+            except Exception as e:
+                self.assertTrue(str(e).startswith("test.forth:" + position),
+                                (source, str(e)))
+            else:
+                self.fail(source)
@@ -0,0 +1,160 @@
+from itertools import product
+import os
+from shutil import rmtree
+from subprocess import check_call
+import sys
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from cauliflower.assembler import (I, J, SET, X, Z, Data, Instruction,
+                                   encode)
+from cauliflower.builtins import builtin
+from cauliflower.emulator import cost, run
+from cauliflower.shuffle import (Effect, Shuffle, Slot, effects, gather,
+                                 shuffle, simulate)
+
+def execute(code, tos=False):
+    """
+    Run some code after setting up a stack, and return the resulting stack,
+    top first.
+    """
+
+    setup = [Instruction(SET, X, 0xc000)]
+    for word in "3", "5", "7", "11":
+        setup += builtin(word, tos)
+    cpu = run(encode(setup + code + [Data(0x0)]))
+    if tos:
+        return [cpu.register(Z)] + cpu.stack()[:-1]
+    return cpu.stack()
+
+def compile_program(source, flags=()):
+    """
+    Compile a program with the compiler, run it, and return the halted CPU.
+    """
+
+    compiler = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                            "test.py")
+    scratch = mkdtemp()
+    try:
+        path = os.path.join(scratch, "source.forth")
+        output = os.path.join(scratch, "output")
+        with open(path, "wb") as f:
+            f.write(source)
+        with open(os.devnull, "wb") as null:
+            check_call([sys.executable, compiler, path, output] + list(flags),
+                       stdout=null)
+        with open(output, "rb") as f:
+            return run(f.read())
+    finally:
+        rmtree(scratch)
+
+def templates(words, tos=False):
+    return sum([builtin(word, tos) for word in words], [])
+
+class TestSimulate(TestCase):
+
+    def test_builtin(self):
+        for word in effects:
+            self.assertEqual(simulate([word]), effects[word])
+
+    def test_swap_swap(self):
+        self.assertEqual(simulate(["swap", "swap"]),
+                         Effect(2, (Slot(1), Slot(0))))
+
+    def test_tuck(self):
+        self.assertEqual(simulate(["swap", "over"]),
+                         Effect(2, (Slot(0), Slot(1), Slot(0))))
+
+    def test_literal(self):
+        self.assertEqual(simulate(["7", "swap"]),
+                         Effect(1, (7, Slot(0))))
+
+    def test_defined(self):
+        table = dict(effects)
+        table["nip"] = simulate(["swap", "drop"])
+        self.assertEqual(simulate(["nip", "dup"], table),
+                         Effect(2, (Slot(0), Slot(0))))
+
+class TestShuffle(TestCase):
+
+    words = ["drop", "dup", "over", "rot", "swap", "2"]
+
+    def test_matches_templates(self):
+        for tos in False, True:
+            for run in product(self.words, repeat=3):
+                code = shuffle(simulate(run), tos)
+                self.assertEqual(execute(code, tos),
+                                 execute(templates(run, tos), tos),
+                                 (run, tos))
+
+    def test_no_slower(self):
+        for tos in False, True:
+            for run in product(self.words, repeat=2):
+                code = shuffle(simulate(run), tos)
+                self.assertTrue(cost(code) <= cost(templates(run, tos)),
+                                (run, tos))
+
+    def test_rot_rot(self):
+        # Three slots change, so three writes and three reads.
+        code = shuffle(simulate(["rot", "rot"]))
+        self.assertEqual(len(code), 6)
+
+    def test_2dup(self):
+        code = shuffle(simulate(["over", "over"]))
+        self.assertEqual(cost(code), (4, 4))
+
+    def test_nip_tos(self):
+        code = shuffle(simulate(["swap", "drop"]), True)
+        self.assertEqual(len(code), 1)
+
+    def test_identity(self):
+        for tos in False, True:
+            self.assertEqual(shuffle(simulate(["swap", "swap"]), tos), [])
+
+class TestGather(TestCase):
+
+    def test_run(self):
+        words = ["dup", "*", "swap", "over", "-"]
+        self.assertEqual(gather(words), [
+            Shuffle(("dup",), simulate(["dup"])),
+            "*",
+            Shuffle(("swap", "over"), simulate(["swap", "over"])),
+            "-",
+        ])
+
+    def test_literals_alone(self):
+        self.assertEqual(gather(["1", "2", "+"]), ["1", "2", "+"])
+
+    def test_literals_in_run(self):
+        self.assertEqual(gather(["1", "swap"]),
+                         [Shuffle(("1", "swap"), simulate(["1", "swap"]))])
+
+class TestRedefined(TestCase):
+
+    def test_not_shuffle(self):
+        for flags in [], ["--tos"], ["--jsr"]:
+            cpu = compile_program(": a swap ; : a 1 + ; : main 1 2 a ;",
+                                  flags)
+            self.assertEqual(cpu.register(I), 0x3)
+
+    def test_uses_old(self):
+        cpu = compile_program(": a swap ; : a a a 1 + ; : main 1 2 a ;")
+        self.assertEqual(cpu.register(I), 0x3)
+
+    def test_called(self):
+        # w1 keeps calling the first w0, even when it isn't inlined.
+        source = (": w0 100 dup * dup * dup * 1 + 2 + 3 + dup * ; "
+                  ": w1 w0 1 + ; : w0 200 ; : main w1 w0 ;")
+        for flags in [], ["--jsr"]:
+            cpu = compile_program(source, flags + ["--budget", "0"])
+            self.assertEqual(cpu.register(I), 200)
+            self.assertEqual(cpu.register(J), 0x25)
+
+    def test_shared_block(self):
+        # The blocks are spelled the same, but mean different words.
+        source = (": a 1 ; : f dup if a then ; : a 2 ; : g dup if a then ; "
+                  ": main 5 g 7 ;")
+        for flags in [], ["--tos"], ["--jsr"]:
+            cpu = compile_program(source, flags)
+            self.assertEqual(cpu.register(I), 7)
+            self.assertEqual(cpu.register(J), 2)
@@ -0,0 +1,66 @@
+from unittest import TestCase
+
+from cauliflower.assembler import (A, ADD, B, C, IFN, PC, PEEK, POP, PUSH,
+                                   SET, SP, SUB, Instruction, Label)
+from cauliflower.superopt import (alphabet, better, canonical, holds,
+                                  search, source, windows)
+
+class TestSuperopt(TestCase):
+
+    def test_better(self):
+        self.assertTrue(better((1, 1), (1, 2)))
+        self.assertTrue(better((1, 2), (2, 2)))
+        self.assertFalse(better((1, 2), (1, 2)))
+        self.assertFalse(better((1, 3), (2, 2)))
+
+    def test_canonical(self):
+        self.assertTrue(canonical([A, None, B, A]))
+        self.assertFalse(canonical([B, A]))
+        self.assertFalse(canonical([A, C]))
+
+    def test_alphabet(self):
+        letters = alphabet([Instruction(ADD, SP, 0x1)])
+        self.assertTrue(Instruction(ADD, SP, 0x1) in letters)
+        self.assertTrue(Instruction(SET, A, POP) in letters)
+        self.assertFalse(Instruction(SET, A, A) in letters)
+        self.assertFalse([l for l in letters if isinstance(l.a, int)])
+
+    def test_drop(self):
+        winners = search([Instruction(ADD, SP, 0x1)], length=1)
+        self.assertEqual(winners[0], [Instruction(SET, A, POP)])
+
+    def test_holds(self):
+        reference = [Instruction(SET, A, 0x1), Instruction(SET, A, 0x1)]
+        self.assertTrue(holds(reference, reference[:1], [([], [])]))
+
+    def test_drop_loses(self):
+        # Moving the stack for JSR calls makes ADD SP, 1 free, and the
+        # peephole optimizer throws it away after a push.
+        reference = [Instruction(ADD, SP, 0x1)]
+        winner = [Instruction(SET, A, POP)]
+        self.assertFalse(holds(reference, winner, [([], [])]))
+        self.assertFalse(holds(reference, winner,
+                               [([Instruction(SET, PUSH, 0x7)], [])]))
+
+    def test_dup(self):
+        # SET PUSH, PEEK moves SP before reading it, so it isn't a dup.
+        reference = [
+            Instruction(SET, A, PEEK),
+            Instruction(SET, PUSH, A),
+        ]
+        self.assertEqual(search(reference, length=1), [])
+
+    def test_windows(self):
+        code = [
+            Instruction(SET, A, 0x1),
+            Label("top"),
+            Instruction(SUB, B, 0x1),
+            Instruction(SUB, C, 0x1),
+            Instruction(IFN, A, 0x0),
+            Instruction(SET, PC, 0x0),
+        ]
+        self.assertEqual(windows(code), [code[:1], code[2:4]])
+
+    def test_source(self):
+        self.assertEqual(source(Instruction(SET, PUSH, [A + 0x1])),
+                         "Instruction(SET, PUSH, [A + 0x1])")
@@ -0,0 +1,111 @@
+from array import array
+from unittest import TestCase
+
+from cauliflower.assembler import (A, B, C, JSR, SET, Data, Instruction,
+                                   encode, layout)
+from cauliflower.emulator import CPU, cost
+from cauliflower.utilities import copy, library
+
+ROUTINE = 0x100
+SOURCE = 0x1000
+TARGET = 0x2000
+
+def link(code, origin=0x0):
+    labels, short = layout(code, origin)
+    return encode(code, labels, short)
+
+def call(name, a, b, c, memory={}):
+    """
+    Call a library routine with some registers and memory, and return the
+    halted CPU and the cycles spent in the routine, not counting the JSR.
+    """
+
+    setup = [
+        Instruction(SET, A, a),
+        Instruction(SET, B, b),
+        Instruction(SET, C, c),
+        Instruction(JSR, ROUTINE),
+    ]
+    cpu = CPU()
+    for address, words in memory.items():
+        cpu.memory[address:address + len(words)] = array("H", words)
+    cpu.load(link(setup + [Data(0x0)]))
+    cpu.load(link(library[name](), ROUTINE), ROUTINE)
+    cpu.run(0x10000)
+    return cpu, cpu.cycles - cost(setup)[1]
+
+def fill(address, count, start=0x1):
+    return {address: range(start, start + count)}
+
+class TestMemcmp(TestCase):
+
+    def test_empty(self):
+        cpu, cycles = call("memcmp", 0x0, SOURCE, TARGET)
+        self.assertNotEqual(cpu.register(A), 0x0)
+        self.assertEqual(cycles, 6)
+
+    def test_match(self):
+        for n in 1, 2, 7:
+            memory = fill(SOURCE, n)
+            memory.update(fill(TARGET, n))
+            cpu, cycles = call("memcmp", n, SOURCE, TARGET, memory)
+            self.assertNotEqual(cpu.register(A), 0x0)
+            self.assertEqual(cycles, 6 + 11 * n)
+
+    def test_mismatch(self):
+        memory = fill(SOURCE, 8)
+        memory.update(fill(TARGET, 3))
+        cpu, cycles = call("memcmp", 8, SOURCE, TARGET, memory)
+        self.assertEqual(cpu.register(A), 0x0)
+        # Three words match, and the fourth stops the comparison.
+        self.assertEqual(cycles, 11 + 11 * 3)
+
+class TestCopies(TestCase):
+
+    def test_memcpy(self):
+        for n in range(10):
+            cpu, cycles = call("memcpy", n, SOURCE, TARGET,
+                               fill(SOURCE, n + 1))
+            self.assertEqual(cpu.memory[TARGET:TARGET + n + 1].tolist(),
+                             range(1, n + 1) + [0x0])
+            self.assertEqual(cpu.register(C), TARGET + n)
+            self.assertTrue(0 < cycles - 20 * (n // 4) - 11 * (n % 4) <= 9)
+
+    def test_memcpy_faster(self):
+        cpu, cycles = call("memcpy", 0x40, SOURCE, TARGET, fill(SOURCE, 0x40))
+        # The old copy spent 11 cycles on every word.
+        self.assertLess(cycles, 0x40 * 6)
+
+    def test_memmove(self):
+        n = 0x9
+        forward = call("memcpy", n, SOURCE, TARGET)[1]
+        self.assertEqual(call("memmove", n, TARGET, SOURCE)[1], forward + 3)
+        self.assertEqual(call("memmove", n, SOURCE, TARGET)[1], forward + 8)
+
+    def test_memmove_overlap(self):
+        for n in range(10):
+            for distance in -3, -1, 1, 3:
+                cpu, cycles = call("memmove", n, SOURCE, SOURCE + distance,
+                                   fill(SOURCE, n))
+                self.assertEqual(
+                    cpu.memory[SOURCE + distance:
+                               SOURCE + distance + n].tolist(),
+                    range(1, n + 1))
+
+    def test_memset(self):
+        for n in range(10):
+            cpu, cycles = call("memset", n, 0x55, TARGET)
+            self.assertEqual(cpu.memory[TARGET:TARGET + n + 1].tolist(),
+                             [0x55] * n + [0x0])
+            self.assertTrue(0 < cycles - 15 * (n // 4) - 9 * (n % 4) <= 9)
+
+    def test_copy(self):
+        for n in range(5):
+            code = [Instruction(SET, B, SOURCE), Instruction(SET, C, TARGET)]
+            cpu = CPU()
+            cpu.memory[SOURCE:SOURCE + n] = array("H", range(1, n + 1))
+            cpu.load(encode(code + copy(n) + [Data(0x0)]))
+            cpu.run()
+            self.assertEqual(cpu.memory[TARGET:TARGET + n].tolist(),
+                             range(1, n + 1))
+            self.assertEqual(cost(copy(n))[1], 3 * n - 2 if n else 0)
@@ -1,6 +1,6 @@
-from cauliflower.assembler import (A, ADD, B, BOR, C, IFE, IFG, IFN, PC, POP,
-                                   PUSH, SET, SUB, X, XOR, Y, Z, assemble,
-                                   until)
+from cauliflower.assembler import (A, ADD, B, C, IFE, IFG, IFN, PC, POP, PUSH,
+                                   SET, SUB, Y, Z, Data, Distance, Instruction,
+                                   Label, local, until)
 
 # All of these utility functions expect SP to point to their caller, or at
 # least where their caller would like to return to, and assume that SP is safe
@@ -9,48 +9,170 @@ from cauliflower.assembler import (A, ADD, B, BOR, C, IFE, IFG, IFN, PC, POP,
 def memcmp():
     """
     Put a length in A, two addresses in B and C, and fill A with whether
-    they match (non-zero) or don't match (zero).
+    they match (non-zero) or don't match (zero). Clobbers B and C.
+
+    The comparison stops at the first mismatch. Costs 6 + 11n cycles for
+    strings of length n which match, and 11 + 11k for strings which don't,
+    where k is how many words matched first.
     """
 
-    # Save X.
-    preamble = assemble(SET, PUSH, X)
-    preamble += assemble(SET, X, 0x0)
-    preamble += assemble(ADD, B, A)
-    preamble += assemble(ADD, C, A)
+    here = local()
+    same = local()
+    differ = local()
+    # Empty strings always match.
+    preamble = [Instruction(IFE, A, 0x0)]
+    preamble.append(Instruction(ADD, PC, Distance(here, same)))
+    preamble.append(Label(here))
+    # Turn A into the end of B, so that there's one less thing to count.
+    preamble.append(Instruction(ADD, A, B))
     # Top of the loop.
-    ucode = assemble(SUB, B, 0x1)
-    ucode += assemble(SUB, C, 0x1)
-    ucode += assemble(IFE, [B], [C])
-    ucode += assemble(BOR, X, 0xffff)
-    ucode = until(ucode, (IFN, A, 0x0))
-    ucode += assemble(SET, A, X)
-    ucode += assemble(XOR, A, 0xffff)
-    # Restore X.
-    ucode += assemble(SET, X, POP)
-    ucode += assemble(SET, PC, POP)
+    here = local()
+    ucode = [Instruction(IFN, [B], [C])]
+    ucode.append(Instruction(ADD, PC, Distance(here, differ)))
+    ucode.append(Label(here))
+    ucode.append(Instruction(ADD, B, 0x1))
+    ucode.append(Instruction(ADD, C, 0x1))
+    ucode = until(ucode, (IFN, B, A))
+    ucode.append(Label(same))
+    ucode.append(Instruction(SET, A, 0x1))
+    ucode.append(Instruction(SET, PC, POP))
+    ucode.append(Label(differ))
+    ucode.append(Instruction(SET, A, 0x0))
+    ucode.append(Instruction(SET, PC, POP))
     return preamble + ucode
 
 
-def memcpy():
+def copy(count):
     """
-    Copy A bytes from B to C. Clobbers A.
+    Copy a known number of words from B to C, in line. Costs 1 cycle for the
+    first word and 3 for each one after it.
+    """
+
+    ucode = [Instruction(SET, [C], [B])] if count else []
+    for i in range(1, count):
+        ucode.append(Instruction(SET, [C + i], [B + i]))
+    return ucode
+
 
-    The copy is made back to front. No overlapping check is done.
+def _copy(forward):
     """
+    Copy A words from B to C, four at a time and then one at a time, leaving
+    A at zero.
 
-    preamble = assemble(ADD, B, A)
-    preamble += assemble(ADD, C, A)
-    # Top of the loop.
-    ucode = assemble(SUB, A, 0x1)
-    ucode += assemble(SUB, B, 0x1)
-    ucode += assemble(SUB, C, 0x1)
-    ucode += assemble(SET, [C], [B])
-    ucode = until(ucode, (IFN, A, 0x0))
-    # And return.
-    ucode += assemble(SET, PC, POP)
+    Going forward, B and C are left just past the end of the copy. Going
+    backward, B and C should start just past the end, and are left at the
+    beginning.
+    """
+
+    here = local()
+    tail = local()
+    preamble = [Instruction(IFG, 0x4, A)]
+    preamble.append(Instruction(ADD, PC, Distance(here, tail)))
+    preamble.append(Label(here))
+
+    # The first copy is one word shorter and one cycle faster than the rest.
+    offsets = range(4) if forward else range(3, -1, -1)
+    block = [Instruction(SET, [C + i] if i else [C], [B + i] if i else [B])
+             for i in offsets]
+    step = ADD if forward else SUB
+    if forward:
+        block += [Instruction(ADD, B, 0x4), Instruction(ADD, C, 0x4)]
+    else:
+        block = [Instruction(SUB, B, 0x4), Instruction(SUB, C, 0x4)] + block
+    block.append(Instruction(SUB, A, 0x4))
+    ucode = until(block, (IFG, A, 0x3))
+
+    here = local()
+    done = local()
+    ucode.append(Label(tail))
+    ucode.append(Instruction(IFE, A, 0x0))
+    ucode.append(Instruction(ADD, PC, Distance(here, done)))
+    ucode.append(Label(here))
+    single = [Instruction(SET, [C], [B])]
+    single.append(Instruction(step, B, 0x1))
+    single.append(Instruction(step, C, 0x1))
+    if not forward:
+        single.reverse()
+    single.append(Instruction(SUB, A, 0x1))
+    ucode += until(single, (IFN, A, 0x0))
+    ucode.append(Label(done))
     return preamble + ucode
 
 
+def memcpy():
+    """
+    Copy A words from B to C. Clobbers A, and leaves B and C just past the
+    end of the copy.
+
+    The copy is made front to back, four words at a time. No overlapping
+    check is done, so C shouldn't be between B and the end of the copy.
+    Costs 20 cycles for every four words, 11 for each word left over, and
+    at most 9 more.
+    """
+
+    ucode = _copy(True)
+    ucode.append(Instruction(SET, PC, POP))
+    return ucode
+
+
+def memmove():
+    """
+    Copy A words from B to C, even if they overlap. Clobbers A, B and C.
+
+    If C is after B, the copy is made back to front. Costs the same as
+    memcpy, plus 3 cycles going forward or 8 going backward.
+    """
+
+    here = local()
+    backward = local()
+    ucode = [Instruction(IFG, C, B)]
+    ucode.append(Instruction(ADD, PC, Distance(here, backward)))
+    ucode.append(Label(here))
+    ucode += _copy(True)
+    ucode.append(Instruction(SET, PC, POP))
+    ucode.append(Label(backward))
+    ucode.append(Instruction(ADD, B, A))
+    ucode.append(Instruction(ADD, C, A))
+    ucode += _copy(False)
+    ucode.append(Instruction(SET, PC, POP))
+    return ucode
+
+
+def memset():
+    """
+    Fill A words at C with B. Clobbers A, and leaves C just past the end.
+
+    Costs 15 cycles for every four words, 9 for each word left over, and at
+    most 9 more.
+    """
+
+    here = local()
+    tail = local()
+    ucode = [Instruction(IFG, 0x4, A)]
+    ucode.append(Instruction(ADD, PC, Distance(here, tail)))
+    ucode.append(Label(here))
+    block = [Instruction(SET, [C], B)]
+    for i in range(1, 4):
+        block.append(Instruction(SET, [C + i], B))
+    block.append(Instruction(ADD, C, 0x4))
+    block.append(Instruction(SUB, A, 0x4))
+    ucode += until(block, (IFG, A, 0x3))
+
+    here = local()
+    done = local()
+    ucode.append(Label(tail))
+    ucode.append(Instruction(IFE, A, 0x0))
+    ucode.append(Instruction(ADD, PC, Distance(here, done)))
+    ucode.append(Label(here))
+    single = [Instruction(SET, [C], B)]
+    single.append(Instruction(ADD, C, 0x1))
+    single.append(Instruction(SUB, A, 0x1))
+    ucode += until(single, (IFN, A, 0x0))
+    ucode.append(Label(done))
+    ucode.append(Instruction(SET, PC, POP))
+    return ucode
+
+
 def read(register):
     """
     Get a byte from the keyboard and put it in the given register.
@@ -58,10 +180,10 @@ def read(register):
     This blocks.
     """
 
-    ucode = assemble(SET, register, [0x9010])
+    ucode = [Instruction(SET, register, [0x9010])]
     ucode = until(ucode, (IFE, register, 0x0))
-    ucode += assemble(SET, [0x9010], 0x0)
-    ucode += assemble(SET, PC, POP)
+    ucode.append(Instruction(SET, [0x9010], 0x0))
+    ucode.append(Instruction(SET, PC, POP))
     return ucode
 
 
@@ -76,34 +198,36 @@ def write(register):
     """
 
     # Save Y.
-    ucode = assemble(SET, PUSH, Y)
+    ucode = [Instruction(SET, PUSH, Y)]
     # Save Z.
-    ucode += assemble(SET, PUSH, Z)
+    ucode.append(Instruction(SET, PUSH, Z))
     # Save the data that we're supposed to push.
-    ucode = assemble(SET, PUSH, register)
+    ucode = [Instruction(SET, PUSH, register)]
     # Do some tricky PC manipulation to get a bareword into the code, and
     # sneak its address into Z.
-    ucode += assemble(SET, Z, PC)
-    ucode += assemble(IFE, 0x0, 0x0)
-    ucode += "\x80\x00"
-    ucode += assemble(ADD, Z, 0x1)
+    ucode.append(Instruction(SET, Z, PC))
+    ucode.append(Instruction(IFE, 0x0, 0x0))
+    ucode.append(Data(0x8000))
+    ucode.append(Instruction(ADD, Z, 0x1))
     # Dereference the framebuffer.
-    ucode += assemble(SET, Y, [Z])
+    ucode.append(Instruction(SET, Y, [Z]))
     # Write to the framebuffer.
-    ucode += assemble(SET, [Y], POP)
+    ucode.append(Instruction(SET, [Y], POP))
     # Advance the framebuffer.
-    ucode += assemble(ADD, [Z], 0x1)
+    ucode.append(Instruction(ADD, [Z], 0x1))
     # If the framebuffer has wrapped, wrap the pointer.
-    ucode += assemble(IFG, 0x8200, [Z])
-    ucode += assemble(SUB, [Z], 0x200)
+    ucode.append(Instruction(IFG, 0x8200, [Z]))
+    ucode.append(Instruction(SUB, [Z], 0x200))
     # Restore registers and leave.
-    ucode += assemble(SET, Z, POP)
-    ucode += assemble(SET, Y, POP)
-    ucode += assemble(SET, PC, POP)
+    ucode.append(Instruction(SET, Z, POP))
+    ucode.append(Instruction(SET, Y, POP))
+    ucode.append(Instruction(SET, PC, POP))
     return ucode
 
 
 library = {
     "memcmp": memcmp,
     "memcpy": memcpy,
+    "memmove": memmove,
+    "memset": memset,
 }
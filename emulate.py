@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+Run an image from the compiler and report how it went.
+
+The image is loaded at the bottom of memory and run from 0x0 until it halts.
+The bootloader pops the top of the stack into I and J before halting, so those
+are reported along with whatever is left on the stack. Images built with --tos
+or --jsr keep their data stack somewhere else, so they need the same flags
+here for the stack to be found.
+
+Given the symbol map which the compiler wrote alongside the image, the number
+of times each word was called can be written out as a profile, which the
+compiler can use to decide what to inline.
+"""
+
+from argparse import ArgumentParser
+
+from cauliflower.assembler import I, J
+from cauliflower.control import data_stack
+from cauliflower.emulator import run
+
+# Where the bootloader starts the data stack, when it isn't in SP.
+BOTTOM = 0xd000
+
+parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("image")
+parser.add_argument("--map", help="symbol map written by the compiler")
+parser.add_argument("--profile", help="where to write call counts")
+parser.add_argument("--tos", action="store_true",
+                    help="the image caches the top of the stack in a register")
+parser.add_argument("--jsr", action="store_true",
+                    help="the image makes calls with JSR")
+options = parser.parse_args()
+
+if options.profile and not options.map:
+    parser.error("--profile needs --map")
+
+# Words are counted as they're called, or fallen through to.
+symbols = []
+if options.profile:
+    with open(options.map, "rb") as f:
+        symbols = [line.split() for line in f]
+entries = [int(address, 16) for address, name in symbols]
+
+with open(options.image, "rb") as f:
+    cpu = run(f.read(), profile=bool(options.profile), entries=entries)
+
+print "Cycles: %d" % cpu.cycles
+print "I: 0x%04x" % cpu.register(I)
+print "J: 0x%04x" % cpu.register(J)
+if options.jsr:
+    # The data stack is in a register, and SP holds the call stack.
+    stack = cpu.memory[cpu.register(data_stack(options.tos, True)):
+                       BOTTOM].tolist()
+else:
+    stack = cpu.stack()
+print "Stack:", " ".join("0x%04x" % word for word in stack)
+
+if options.profile:
+    with open(options.profile, "wb") as f:
+        for address, name in symbols:
+            count = cpu.jumps.get(int(address, 16), 0)
+            f.write("%s %d\n" % (name, count))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""
+Compile programs from a long-running server.
+
+Starting the compiler means importing all of it and reading in the prelude,
+which takes longer than compiling most small programs does. The server does
+that once, and warms up with a compile for each calling convention. After
+that, every request is compiled in a process forked from the server, so it
+starts out warm and shares the prelude with the server, and nothing that one
+compile does can leak into another.
+
+Requests and responses are lines of JSON. A request holds the program to
+compile as "source", and can also hold a list of the compiler's options as
+"options", and the directory to compile in as "directory", which paths in the
+options are relative to. The response holds the image, or the object with
+--object, in hex as "output", the symbol map as "map", everything that the
+compiler printed as "log", and how many seconds the compile took as
+"seconds". A compile which fails has an "error" instead of an output.
+
+Requests come in over a Unix socket, where every connection can send any
+number of requests, and connections are served at once; or with --stdio,
+from stdin, with the responses written to stdout in order. With --client,
+the other arguments are sent as a compile to a server which is already
+running, as if they had been given to test.py.
+"""
+
+from argparse import ArgumentParser, REMAINDER
+from binascii import hexlify, unhexlify
+from cStringIO import StringIO
+import json
+import os
+from runpy import run_path
+from shutil import rmtree
+from signal import SIGTERM, signal
+import socket
+from SocketServer import ForkingMixIn, StreamRequestHandler, UnixStreamServer
+import sys
+from tempfile import mkdtemp
+from time import time
+
+# The compiler, run afresh for every request.
+COMPILER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "test.py")
+
+# Options for each calling convention, to warm up with.
+conventions = [], ["--tos"], ["--jsr"], ["--tos", "--jsr"]
+
+
+def compile_request(request):
+    """
+    Compile a request in this process, and return the response.
+    """
+
+    scratch = mkdtemp()
+    try:
+        return compile_in(request, scratch)
+    finally:
+        rmtree(scratch)
+
+
+def compile_in(request, scratch):
+    """
+    Compile a request in this process, keeping its files in a scratch
+    directory, and return the response.
+    """
+
+    source = os.path.join(scratch, "source.forth")
+    output = os.path.join(scratch, "output")
+    symbols = os.path.join(scratch, "map")
+    with open(source, "wb") as f:
+        f.write(request["source"].encode("utf-8"))
+
+    argv = [COMPILER, source, output, "--map", symbols]
+    argv += request.get("options", [])
+    log = StringIO()
+    saved = sys.argv, sys.stdout, sys.stderr, os.getcwd()
+    started = time()
+    try:
+        sys.argv = argv
+        sys.stdout = sys.stderr = log
+        if request.get("directory"):
+            os.chdir(request["directory"])
+        run_path(COMPILER, run_name="__main__")
+    except SystemExit as e:
+        # The options were no good.
+        if e.code:
+            return {"error": "Bad options", "log": log.getvalue()}
+    except Exception as e:
+        return {"error": "%s: %s" % (type(e).__name__, e),
+                "log": log.getvalue()}
+    finally:
+        sys.argv, sys.stdout, sys.stderr = saved[:3]
+        os.chdir(saved[3])
+
+    if not os.path.exists(output):
+        # The compiler stopped early without failing, as it does for --help.
+        return {"error": "No output", "log": log.getvalue()}
+    rv = {"log": log.getvalue(), "seconds": time() - started}
+    with open(output, "rb") as f:
+        rv["output"] = hexlify(f.read())
+    if os.path.exists(symbols):
+        with open(symbols, "rb") as f:
+            rv["map"] = f.read()
+    return rv
+
+
+def serve(rfile, wfile):
+    """
+    Answer every request that can be read from a file, in order.
+
+    Each request is compiled in a process of its own, forked from this one,
+    which always answers it with exactly one response, so that the responses
+    stay in step with the requests.
+    """
+
+    for line in iter(rfile.readline, ""):
+        if not line.strip():
+            continue
+        pid = os.fork()
+        if not pid:
+            try:
+                try:
+                    response = compile_request(json.loads(line))
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {"error": "Bad request: %s" % e}
+                except Exception as e:
+                    response = {"error": "%s: %s" % (type(e).__name__, e)}
+                wfile.write(json.dumps(response) + "\n")
+                wfile.flush()
+            finally:
+                # Never go back to serving from the child.
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+
+class Handler(StreamRequestHandler):
+
+    def handle(self):
+        serve(self.rfile, self.wfile)
+
+
+class Server(ForkingMixIn, UnixStreamServer):
+    pass
+
+
+def request(path, args):
+    """
+    Send a compile to a running server, as if its arguments had been given
+    to test.py, and write out the output and the symbol map. Returns the
+    response.
+    """
+
+    source, output = args[:2]
+    options = args[2:]
+    symbols = None
+    if "--map" in options:
+        i = options.index("--map")
+        symbols = options[i + 1]
+        del options[i:i + 2]
+
+    with open(source, "rb") as f:
+        text = f.read().decode("utf-8")
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    f = client.makefile("rwb")
+    f.write(json.dumps({"source": text, "options": options,
+                        "directory": os.getcwd()}) + "\n")
+    f.flush()
+    response = json.loads(f.readline())
+    client.close()
+
+    if "output" in response:
+        with open(output, "wb") as f:
+            f.write(unhexlify(response["output"]))
+        if symbols:
+            with open(symbols, "wb") as f:
+                f.write(response["map"])
+    return response
+
+
+parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--socket", default="cauliflower.sock",
+                    help="path of the Unix socket to serve on")
+parser.add_argument("--stdio", action="store_true",
+                    help="serve requests from stdin, instead")
+parser.add_argument("--client", nargs=REMAINDER,
+                    help="send a compile to a running server")
+options = parser.parse_args()
+
+if options.client is not None:
+    if len(options.client) < 2:
+        parser.error("--client needs a source and an output")
+    response = request(options.socket, options.client)
+    sys.stdout.write(response.get("log", ""))
+    if "error" in response:
+        print response["error"]
+        sys.exit(1)
+    sys.exit(0)
+
+for convention in conventions:
+    compile_request({"source": ": main ;", "options": convention})
+
+if options.stdio:
+    serve(sys.stdin, sys.stdout)
+else:
+    if os.path.exists(options.socket):
+        os.remove(options.socket)
+    server = Server(options.socket, Handler)
+    print "Serving on %s" % options.socket
+    sys.stdout.flush()
+    # Clean up the socket when told to stop, too.
+    signal(SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(options.socket)
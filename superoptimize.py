@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+Search for cheaper versions of the builtin templates.
+
+Each template is raced against every shorter or faster sequence of
+instructions, up to some length, on random machine states. Only templates
+which the compiler actually reaches for are searched: the stack shuffles are
+compiled from their effects instead. A winner is then compiled alone and next
+to some common neighbours, and peephole optimized, with and without JSR calls;
+the winners which are still cheaper everywhere are written out as a table of
+generated templates, which the builtins use instead of the hand-written ones.
+
+The straight-line parts of the utility routines can be checked too, but
+winners there are only reported, since they sit inside of loops.
+"""
+
+from argparse import ArgumentParser
+import re
+from textwrap import wrap
+
+from cauliflower.assembler import ADD, SET, SUB, XOR, disassemble, encode
+from cauliflower.builtins import binop, binops, builtin, prims, tos_prims
+from cauliflower.emulator import cost
+from cauliflower.shuffle import effects, shuffle
+from cauliflower.superopt import (everything, holds, opnames, search, source,
+                                  windows)
+from cauliflower.utilities import library
+
+parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("words", nargs="*",
+                    help="only search for these templates, and don't write "
+                         "any out")
+parser.add_argument("--length", type=int, default=3,
+                    help="longest sequence of instructions to try")
+parser.add_argument("--tests", type=int, default=16,
+                    help="random machine states to try each candidate on")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--arithmetic", action="store_true",
+                    help="try ADD, SUB and XOR, and not just SET")
+parser.add_argument("--utilities", action="store_true",
+                    help="check the utility routines, too")
+parser.add_argument("--output", default="cauliflower/generated.py",
+                    help="where to write the generated templates")
+options = parser.parse_args()
+
+ops = (SET, ADD, SUB, XOR) if options.arithmetic else (SET,)
+
+
+def report(name, reference, winners):
+    print "%s: %d words, %d cycles" % ((name,) + cost(reference))
+    if not winners:
+        print "    nothing better within %d instructions" % options.length
+        return
+    for winner in winners[:4]:
+        print "    %d words, %d cycles:" % cost(winner),
+        print "; ".join(source(instruction) for instruction in winner)
+
+
+def templates(table, tos):
+    """
+    Return the name of the function for each template that builtin() can
+    reach, and the template. Shuffles never get that far.
+    """
+
+    rv = {}
+    for name in table:
+        if name not in effects:
+            rv[name] = table[name].__name__, table[name]()
+    for name in binops:
+        function = "binop_%s" % opnames[binops[name]].lower()
+        rv[name] = ("tos_" if tos else "") + function, binop(name, tos)
+    return rv
+
+
+def neighbours(tos):
+    """
+    Return some code that templates are often compiled next to, as pairs of
+    code before and after them.
+    """
+
+    return [
+        ([], []),
+        (builtin("7", tos), []),
+        ([], shuffle(effects["drop"], tos)),
+        ([], shuffle(effects["dup"], tos)),
+    ]
+
+
+def generate(function, reference, tos):
+    """
+    Search for a replacement for a template, and return the best one which
+    still wins among its neighbours, or None.
+    """
+
+    winners = search(reference, length=options.length, count=options.tests,
+                     ops=ops, seed=options.seed)
+    report(function, reference, winners)
+    for winner in winners:
+        if holds(reference, winner, neighbours(tos), tos):
+            # Make sure that the winner survives being encoded and decoded.
+            return disassemble(encode(winner))
+        print "    loses once compiled:",
+        print "; ".join(source(instruction) for instruction in winner)
+
+
+found = []
+for prefix, table, tos in ("prims", prims, False), ("tos_prims", tos_prims,
+                                                    True):
+    reachable = templates(table, tos)
+    for name in sorted(reachable):
+        if options.words and name not in options.words:
+            continue
+        function, reference = reachable[name]
+        winner = generate(function, reference, tos)
+        if winner is not None:
+            found.append((prefix, name, function, winner))
+
+if options.utilities:
+    for name in sorted(library):
+        if options.words and name not in options.words:
+            continue
+        for i, run in enumerate(windows(library[name]())):
+            winners = search(run, live=everything, length=options.length,
+                             count=options.tests, ops=ops,
+                             seed=options.seed)
+            report("%s, run %d" % (name, i), run, winners)
+
+if options.words:
+    raise SystemExit
+
+lines = []
+for prefix, name, function, winner in found:
+    lines.append("")
+    lines.append("")
+    lines.append("def %s():" % function)
+    lines.append("    return [")
+    for instruction in winner:
+        lines.append("        %s," % source(instruction))
+    lines.append("    ]")
+for prefix in "prims", "tos_prims":
+    entries = ['    "%s": %s,' % (name, function)
+               for p, name, function, winner in found if p == prefix]
+    lines.append("")
+    lines.append("")
+    if entries:
+        lines.append("%s = {" % prefix)
+        lines += entries
+        lines.append("}")
+    else:
+        lines.append("%s = {}" % prefix)
+
+# Import everything that the templates mention, constants first.
+used = set(re.findall(r"\b[A-Z][A-Za-z]*\b", "\n".join(lines)))
+imports = ", ".join(sorted(used, key=lambda name: (not name.isupper(), name)))
+head = "from cauliflower.assembler import "
+if not used:
+    imports = []
+elif len(head + imports) <= 79:
+    imports = [head + imports]
+else:
+    imports = wrap(imports, 78, initial_indent=head + "(",
+                   subsequent_indent=" " * (len(head) + 1))
+    imports[-1] += ")"
+
+with open(options.output, "wb") as f:
+    f.write('"""\n')
+    f.write("Templates found by superoptimize.py, which beat the hand-written "
+            "ones in\nbuiltins.\n\n")
+    f.write("This file is generated; run superoptimize.py to remake it.\n")
+    f.write('"""\n')
+    if imports:
+        f.write("\n")
+        for line in imports:
+            f.write(line + "\n")
+    for line in lines:
+        f.write(line + "\n")
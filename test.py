@@ -9,218 +9,783 @@ methods of operating on the stack.
 The return/call stack is hacked onto Z. Explicit manipulations are done to
 modify Z.
 
-At the end of the program, the stack is popped into I and J for analysis.
-"""
+With --tos, the top of the data stack is cached in Z instead, and the
+return/call stack moves to Y.
 
-from collections import OrderedDict
-from struct import pack
-import sys
-
-from cauliflower.assembler import I, J, POP, SET, Z, assemble
-from cauliflower.builtins import builtin
-from cauliflower.control import call, if_alone, if_else, ret
+With --jsr, calls are made with JSR instead, so the return/call stack lives in
+SP, and the data stack moves into Z, or into Y with --tos.
 
+At the end of the program, the stack is popped into I and J for analysis.
 
-# The threshold of inlining. Words that are compiled to this many machine
-# words of bytecode or fewer will not be inserted as callable subroutines into
-# the executable, but instead will join a library of builtin subroutines which
-# will be added verbatim whenever called. This is largely because calls can be
-# very expensive and composite words can be very small.
-# Currently, this threshold is set to eight words, the overhead of a call()
-# plus the ret() cost at the end of a subroutine, times two, the size of a
-# word.
-INLINING_THRESHOLD = 0x8 * 2
+With --object, a relocatable object is written instead of an image, to be
+linked into programs later with --library. The prelude comes prebuilt, as one
+object in lib/ for each calling convention, and is only compiled from source
+when its object is missing or out of date.
 
+With --jobs, words are compiled on several processes, and then put together in
+order, so that the image is the same as if they had been compiled on one.
+"""
 
-def bootloader(start):
+from argparse import ArgumentParser
+from collections import OrderedDict
+from glob import glob
+from itertools import count
+from multiprocessing import Pool
+import os
+from cStringIO import StringIO
+
+from cauliflower.assembler import (I, J, JSR, PC, POP, SET, X, Z, Data,
+                                   Instruction, Symbol, relabel, size)
+from cauliflower.builtins import builtin
+from cauliflower.cache import Cache, dump, fingerprint, load
+from cauliflower.control import (begin_until, begin_while, call, call_stack,
+                                 data_stack, do_loop, if_alone, if_else,
+                                 if_then, jump, move_stack, restore_loop, ret,
+                                 save_loop)
+from cauliflower.folding import fold
+from cauliflower.inliner import (Inliner, iterations, load_profile,
+                                 static_counts)
+from cauliflower.objects import (Object, digest, link_objects, open_object,
+                                 scopes)
+from cauliflower.peephole import optimize
+from cauliflower.reader import (Do, If, Until, While, blocks, definitions,
+                                dependencies, scoped, tokenize, walk)
+from cauliflower.shuffle import (Shuffle, effects, gather, shuffle, shuffling,
+                                 simulate)
+
+
+# Words and cycles saved by each peephole rule, over the whole program.
+peephole_stats = {}
+
+parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("source")
+parser.add_argument("output")
+parser.add_argument("--tos", action="store_true",
+                    help="cache the top of the data stack in a register")
+parser.add_argument("--jsr", action="store_true",
+                    help="call with JSR, and keep the data stack out of SP")
+parser.add_argument("--budget", type=int, default=0x100,
+                    help="words the image may grow by from inlining")
+parser.add_argument("--profile",
+                    help="call counts from emulate.py, to guide inlining")
+parser.add_argument("--map", help="where to write the symbol map")
+parser.add_argument("--export", action="append", default=[],
+                    help="keep a word in the image, even if main doesn't "
+                         "call it")
+parser.add_argument("--object", action="store_true",
+                    help="write a relocatable object, instead of an image")
+parser.add_argument("--library", action="append", default=[],
+                    help="an object to link against")
+parser.add_argument("--no-prelude", action="store_true",
+                    help="don't include the prelude")
+parser.add_argument("--jobs", type=int, default=1,
+                    help="words to compile at once, on separate processes")
+parser.add_argument("--cache", help="directory to cache compiled words in")
+parser.add_argument("--cache-size", type=int, default=0x100000,
+                    help="bytes the cache may hold")
+options = parser.parse_args()
+
+# Whether the top of the stack is cached in Z.
+TOS = options.tos
+# Whether calls are made with JSR.
+JSR_CALLS = options.jsr
+# The calling convention that objects are compiled for.
+ABI = TOS, JSR_CALLS
+
+# Where the compiler lives, along with its prelude and prebuilt objects.
+HERE = os.path.dirname(os.path.abspath(__file__))
+PRELUDE = os.path.join(HERE, "prelude.forth")
+# Cache entries and prebuilt objects made by any other version of the
+# compiler are no good.
+COMPILER = fingerprint(glob(os.path.join(HERE, "cauliflower", "*.py")) +
+                       [__file__])
+
+
+def bootloader():
     """
-    Set up stacks and registers, and then jump to a starting point. After
-    things are finished, pop some of the stack to registers, and halt with an
-    illegal opcode.
+    Set up stacks and registers, and then jump to main. After things are
+    finished, pop some of the stack to registers, and halt with an illegal
+    opcode.
     """
 
-    # First things first. Set up the call stack. Currently hardcoded.
-    ucode = assemble(SET, Z, 0xd000)
-    # Hardcode the location of the tail, and call.
-    ucode += call(start)
+    # First things first. Set up the call stack, or with JSR, the data stack
+    # instead. Currently hardcoded.
+    if JSR_CALLS:
+        ucode = [Instruction(SET, data_stack(TOS, JSR_CALLS), 0xd000)]
+    else:
+        ucode = [Instruction(SET, call_stack(TOS), 0xd000)]
+    # And the >r stack, which do loops spill to, well away from the others.
+    ucode.append(Instruction(SET, X, 0xc000))
+    # The location of main is filled in at link time.
+    ucode += call(Symbol("main"), TOS, JSR_CALLS)
     # And we're off! As soon as we come back down, pop I and J so we can see
     # them easily.
-    ucode += assemble(SET, I, POP)
-    ucode += assemble(SET, J, POP)
+    ucode.append(Instruction(SET, I, Z if TOS else POP))
+    ucode.append(Instruction(SET, J, POP))
     # Finish off with an illegal opcode.
-    ucode += pack(">H", 0x0)
+    ucode.append(Data(0x0))
+    if JSR_CALLS:
+        ucode = move_stack(ucode, data_stack(TOS, JSR_CALLS))
     return ucode
 
 
-def compile_word(word, context):
+def compile_word(word, context, caller, weight):
     """
-    Compile a single word.
+    Compile a single word, called from a word which runs the given number of
+    times.
     """
 
-    if word in context:
+    if isinstance(word, Shuffle):
+        # A run of shuffles is compiled all at once.
+        return shuffle(word.effect, TOS)
+    elif word in context:
         # We've seen this word before, so either compile a call to it or
         # include it verbatim if it's inlined.
-        pc, ucode = context[word]
-        if pc is None:
-            return ucode
+        inline, ucode, body = context[word]
+        if inline or INLINER.decide(caller, word, ucode, weight):
+            # Every copy gets its own labels.
+            return relabel(ucode)
         else:
-            return call(pc)
+            called.add(word)
+            return call(Symbol(word), TOS, JSR_CALLS)
     else:
         # Haven't seen this word, maybe it's a builtin?
-        return builtin(word)
+        return builtin(word, TOS)
+
+
+def compile_block(name, words, context, weight, ifs, looping=False):
+    """
+    Compile some words in line, as part of a word which runs the given number
+    of times, and return the new count of if statements and the code.
+    """
+
+    ucode = []
+    for word in gather(fold(words), shuffles, TOS):
+        ifs, piece, tail = compile_statement(name, word, context, weight, ifs,
+                                             looping)
+        ucode += piece
+    return ifs, ucode
+
+
+def compile_if(name, count, statement, context, weight, looping=False):
+    """
+    Compile an if statement, and return the new count of if statements, the
+    code, the code to use instead if the statement ends a subroutine, and the
+    names of the words that its blocks were compiled into.
+
+    Blocks are compiled in line, and jumped over. A block which appears more
+    than once in the program is compiled into a word of its own the first
+    time, and called from each place it appears, if that's smaller than
+    copying it into all of them.
+    """
 
+    print "Compiling if", name, count, statement
 
-def compile_if(name, count, words, pc, context):
+    number = count
+    count += 1
+    parts = []
+    names = []
+    outlined = []
+    for kind, block in ("if", statement.then), ("else", statement.otherwise):
+        if block is None:
+            continue
+        if repeats[block] < 2:
+            count, ucode = compile_block(name, block, context, weight, count,
+                                         looping)
+            parts.append(ucode)
+            continue
+
+        if block not in shared:
+            shared[block] = "%s_%s_%d" % (name, kind, number)
+            subroutine(shared[block], block, context, parent=name)
+        block_name = shared[block]
+        names.append(block_name)
+
+        inline, ucode, body = context[block_name]
+        site = call(Symbol(block_name), TOS, JSR_CALLS)
+        n = repeats[block]
+        if n * size(site) + size(body) < n * size(ucode):
+            print "Calling shared block", block_name
+            called.add(block_name)
+            outlined.append(block_name)
+            parts.append(site)
+        else:
+            parts.append(relabel(ucode))
+
+    if len(outlined) == len(parts):
+        # Every block is called, so the blocks can return on our behalf.
+        if len(outlined) == 1:
+            target = Symbol(outlined[0])
+            ucode = if_alone(target, TOS, jsr=JSR_CALLS)
+            tail = if_alone(target, TOS, tail=True, jsr=JSR_CALLS)
+        else:
+            target, otherwise = Symbol(outlined[0]), Symbol(outlined[1])
+            ucode = if_else(target, otherwise, TOS, jsr=JSR_CALLS)
+            tail = if_else(target, otherwise, TOS, tail=True,
+                           jsr=JSR_CALLS)
+    else:
+        ucode = if_then(*parts, tos=TOS)
+        tail = None
+
+    return count, ucode, tail, names
+
+
+def compile_statement(name, word, context, weight, ifs, looping=False):
     """
-    Find an if statement, compile one or two blocks of it, and return the
-    pieces.
+    Compile a word, an if statement or a loop, as part of a word which runs
+    the given number of times.
+
+    Returns the new count of if statements, the code, and the code to use
+    instead if the statement ends a subroutine, which is None unless the
+    statement can end it by jumping somewhere else.
+
+    Inside of a do loop, anything which runs a do loop of its own has the
+    loop's index and limit saved around it.
     """
 
-    print "Compiling if", name, count, words, pc, context
+    if isinstance(word, If):
+        ifs, ucode, tail, names = compile_if(name, ifs, word, context,
+                                             weight, looping)
+        # Blocks compiled in line have already saved the index and limit
+        # around anything in them, but blocks compiled on their own haven't.
+        clobbers = any(n in indexed for n in names)
+    elif isinstance(word, (Until, While, Do)):
+        ifs, ucode = compile_loop(name, word, context, weight, ifs, looping)
+        tail = None
+        clobbers = False
+    else:
+        ucode = compile_word(word, context, name, weight)
+        target = Symbol(word)
+        if (Instruction(SET, PC, target) in ucode or
+                Instruction(JSR, target) in ucode):
+            # The word was called, rather than inlined.
+            tail = jump(target)
+        else:
+            tail = None
+        clobbers = word in indexed
+
+    if clobbers:
+        indexed.add(name)
+        if looping:
+            ucode = save_loop() + ucode + restore_loop()
+            tail = None
+    return ifs, ucode, tail
+
 
-    if_clause = []
-    else_clause = []
-    else_pc = None
+def compile_loop(name, loop, context, weight, ifs, looping=False):
+    """
+    Compile a loop in line, and return the new count of if statements and the
+    code.
+
+    The words in a loop are guessed to run more often than the words around
+    it.
+    """
 
-    it = iter(words)
-    word = next(it)
-    while word not in ("else", "then"):
-        if_clause.append(word)
-        word = next(it)
-    print "If clause:", if_clause
-    if_pc = pc
-    pc = subroutine("%s_if_%d" % (name, count), if_clause, pc, context)
+    print "Compiling loop", name, loop
 
-    if word == "else":
-        word = next(it)
-        while word != "then":
-            else_clause.append(word)
-            word = next(it)
-        print "Else clause:", else_clause
-        else_pc = pc
-        pc = subroutine("%s_else_%d" % (name, count), else_clause, pc,
-                        context)
+    weight *= iterations
+    parts = []
+    for part in loop:
+        ifs, ucode = compile_block(name, part, context, weight, ifs,
+                                   looping or isinstance(loop, Do))
+        parts.append(ucode)
 
-    return count, if_pc, else_pc, pc
+    if isinstance(loop, Until):
+        return ifs, begin_until(parts[0], TOS)
+    elif isinstance(loop, While):
+        return ifs, begin_while(parts[0], parts[1], TOS)
+    indexed.add(name)
+    return ifs, do_loop(parts[0], TOS, looping)
 
 
-def subroutine(name, words, pc, context):
+def subroutine(name, words, context, parent=None):
     """
     Compile a list of words into a new word.
 
-    All subroutines, including main, are called into.
+    All subroutines, including main, can be called into. Whether each call to
+    a word is actually inlined instead is up to the inliner, unless the word
+    is marked inline, in which case it is always inlined.
 
-    If None is returned, then the new word is inline.
+    Each word is kept in two forms: the plain body, for inlining, and the
+    body as a subroutine, which returns to its caller. When a subroutine ends
+    by calling another word, that call is made into a jump, and the other
+    word returns on our behalf.
     """
 
+    # Do whatever arithmetic can be done ahead of time.
+    words = fold(words)
+
+    # A redefinition only runs a do loop if its new body does, or if it uses
+    # the old definition, which did.
+    if name not in walk(words):
+        indexed.discard(name)
+
+    # A word which only shuffles the stack can be part of a shuffle in the
+    # words which use it. Until the word is done, its name still means its
+    # old definition, if it had one.
+    plain = [word for word in words if word != "inline"]
+    effect = None
+    if plain and all(shuffling(word, shuffles) for word in plain):
+        effect = simulate(plain, shuffles)
+    words = gather(words, shuffles, TOS)
+    if effect is None:
+        shuffles.pop(name, None)
+    else:
+        shuffles[name] = effect
+
     ucode = []
-    it = iter(words)
+    # The tail of the subroutine form, if the last thing in the word can be
+    # turned into a jump, and where in the plain body it starts.
+    tail = None
+    mark = 0
     ifs = 0
+    weight = weights[name] = INLINER.weight(name, parent)
 
     force_inline = False
 
-    for word in it:
+    for word in words:
         if word == "inline":
             force_inline = True
-        if word == "if":
-            ifs, ifpc, elsepc, pc = compile_if(name, ifs, it, pc, context)
-            print "Compiled if", ifs, ifpc, elsepc
-            print "PC is currently", pc
-            if elsepc is None:
-                ucode.append(if_alone(ifpc))
-            else:
-                ucode.append(if_else(ifpc, elsepc))
-        else:
-            ucode.append(compile_word(word, context))
+            continue
 
-    ucode = "".join(ucode)
-    inline = force_inline or len(ucode) <= INLINING_THRESHOLD
+        mark = len(ucode)
+        ifs, piece, tail = compile_statement(name, word, context, weight, ifs)
+        ucode += piece
 
-    if inline:
-        # Add to the dictionary with pc == None, to indicate that this word
-        # can't be found in the emitted bytecode.
-        context[name] = None, ucode
+    if tail is None:
+        body = ucode + ret(TOS, JSR_CALLS)
     else:
-        # This routine can be found in the bytecode, so it needs to return
-        # after call.
-        ucode += ret()
-        # Add the word to the dictionary.
-        context[name] = pc, ucode
-        # Add the size of the subroutine to PC.
-        pc += len(ucode) // 2
+        body = ucode[:mark] + tail
 
-    return pc
+    # Clean up the joins between templates before this word is used anywhere.
+    ucode = optimize(ucode, stats=peephole_stats)
+    if force_inline and name not in entries:
+        body = None
+    else:
+        body = optimize(body)
+        if JSR_CALLS:
+            # Only the finished word is moved; the plain body is still inlined
+            # into other words, and cleaned up along with them.
+            body = move_stack(body, data_stack(TOS, JSR_CALLS))
+    context[name] = force_inline, ucode, body
 
 
-def compile_tokens(tokens, pc, context):
+def prebuilt(filename):
+    """
+    Return the prebuilt object for a library's source, for the current calling
+    convention, or None if there isn't one or it is out of date. Objects are
+    out of date once either their source or the compiler changes.
     """
-    Compile some tokens and add any new words to the given context.
 
-    Returns the PC corresponding to the end of the context.
+    base = os.path.splitext(os.path.basename(filename))[0]
+    suffix = "".join(flag for flag, on in (("-tos", TOS), ("-jsr", JSR_CALLS))
+                     if on)
+    path = os.path.join(HERE, "lib", base + suffix + ".obj")
+    if not os.path.exists(path):
+        return None
+    try:
+        obj = open_object(path)
+    except Exception:
+        # Made for an older layout of objects, or damaged.
+        return None
+    with open(filename, "rb") as f:
+        if not obj.current(ABI, digest(f.read()), COMPILER):
+            return None
+    return obj
+
+
+libraries = []
+for path in options.library:
+    libraries.append(open_object(path))
+
+sources = [options.source]
+if not options.no_prelude:
+    prelude = prebuilt(PRELUDE)
+    if prelude is None:
+        print "Compiling prelude.forth, since its object is missing or stale"
+        sources.insert(0, PRELUDE)
+    else:
+        libraries.insert(0, prelude)
+
+words = []
+
+for filename in sources:
+    with open(filename, "rb") as f:
+        words += definitions(tokenize(f, filename))
+
+with open(options.source, "rb") as f:
+    SOURCE = digest(f.read())
+
+# Every use of a word means the definition of it which was in scope there, so
+# definitions which are replaced later get names of their own.
+names = scopes(libraries, [name for name, body in words])
+words = scoped(words, [name for obj in libraries for name in obj.order])
+
+# The words which come from objects, and not from source.
+imported = OrderedDict()
+for obj, renamed in zip(libraries, names):
+    for name in obj.order:
+        imported[renamed[name]] = obj
+
+
+# Guess at call counts, and then trust a profile over the guesses, for any
+# word that the profile saw. Words from objects are counted too, although not
+# the words that they call in turn.
+counts = static_counts([(name, ()) for name in imported] + words)
+if options.profile:
+    with open(options.profile, "rb") as f:
+        counts.update(load_profile(f))
+
+INLINER = Inliner(counts, options.budget, tos=TOS, jsr=JSR_CALLS)
+
+# Words which are called, rather than inlined, and so need to be in the image.
+# Exported words might be called by anything, so they are never only inlined.
+# An object has no main of its own.
+entries = ([] if options.object else ["main"]) + options.export
+called = set(entries)
+# How many times each word is expected to run.
+weights = {}
+# The effects of the words which only shuffle the stack.
+shuffles = dict(effects)
+# Words which run do loops, and so clobber the index and limit of any loop
+# that they're used in.
+indexed = set()
+# How many times each block of an if statement appears in the program, and the
+# words that the blocks which appear more than once were compiled into. Blocks
+# are compared by their words, which are already bound to the definitions in
+# scope, so a block which uses a word that was redefined in between is a
+# different block.
+repeats = {}
+for name, body in words:
+    for block in blocks(body):
+        repeats[block] = repeats.get(block, 0) + 1
+shared = {}
+
+def record(name, words, context):
+    """
+    Compile a word from the source, and return everything that compiling it
+    did to the state of the compiler, as an entry which replay() can do
+    again.
     """
 
-    it = iter(tokens)
-    ignore = False
-    subtokens = None
+    before = dict(context), set(called), dict(peephole_stats), set(shared)
+    decisions = len(INLINER.decisions)
+    checks = len(INLINER.checks)
+    growth = INLINER.growth
+
+    subroutine(name, words, context)
+
+    # Words are new, or were redefined.
+    new = [n for n in context if before[0].get(n) is not context[n]]
+    return {
+        "context": [(n, context[n]) for n in new],
+        "called": called - before[1],
+        "weights": [(n, weights[n]) for n in new],
+        "shuffles": [(n, shuffles[n]) for n in new if n in shuffles],
+        "indexed": [n for n in new if n in indexed],
+        "shared": [(block, shared[block]) for block in shared
+                   if block not in before[3]],
+        "decisions": INLINER.decisions[decisions:],
+        "growth": INLINER.growth - growth,
+        "checks": [(total - growth, inline)
+                   for total, inline in INLINER.checks[checks:]],
+        "peephole": dict((rule, tuple(x - y for x, y in
+                                      zip(peephole_stats[rule],
+                                          before[2].get(rule, (0, 0)))))
+                         for rule in peephole_stats),
+    }
+
+
+def replay(entry, context, placed=True):
+    """
+    Do everything to the state of the compiler that compiling a word did.
 
-    for token in it:
-        # Handle comments. Whether or not a Forth permits nested comments is
-        # pretty up-in-the-air; this Forth does not permit nesting of
-        # comments.
-        if token == "(":
-            ignore = True
-            continue
-        elif token == ")":
-            ignore = False
-            continue
+    Labels in an entry were made by some other run, so they get new names to
+    keep them apart from the labels made in this one, unless the words will
+    never be placed, and are only going to be inlined, which renames them
+    anyway.
+    """
 
-        if ignore:
-            continue
+    for n, (inline, ucode, body) in entry["context"]:
+        if placed:
+            if body is not None:
+                body = relabel(body)
+            ucode = relabel(ucode)
+        context[n] = inline, ucode, body
+    called.update(entry["called"])
+    weights.update(entry["weights"])
+    # Redefined words forget what the old definitions were.
+    for n, value in entry["context"]:
+        shuffles.pop(n, None)
+        indexed.discard(n)
+    shuffles.update(entry["shuffles"])
+    indexed.update(entry["indexed"])
+    shared.update(entry["shared"])
+    INLINER.decisions += entry["decisions"]
+    INLINER.growth += entry["growth"]
+    for decision in entry["decisions"]:
+        caller, callee, inline, reason = decision
+        if not inline:
+            INLINER.called.add(callee)
+    for rule, (saved, cycles) in entry["peephole"].items():
+        total = peephole_stats.get(rule, (0, 0))
+        peephole_stats[rule] = total[0] + saved, total[1] + cycles
+
+
+def compile_definition(name, words, context):
+    """
+    Compile a word from the source, along with the blocks of its if
+    statements, using the cache if possible, and return its entry.
 
-        # Look for subroutines.
-        if token == ":":
-            subtokens = []
-            continue
-        elif token == ";":
-            if not subtokens:
-                raise Exception("Empty word definition!")
-            name = subtokens[0]
-            pc = subroutine(name, subtokens[1:], pc, context)
-            continue
-        elif subtokens is not None:
-            subtokens.append(token)
-            continue
+    Everything that compiling the word does to the state of the compiler is
+    recorded in its cache entry, and done again when the entry is used.
+    """
+
+    if CACHE is None:
+        return record(name, words, context)
+
+    # The word depends on the words it uses, and on everything that went into
+    # compiling them, too.
+    deps = sorted((word, identities[word]) for word in set(walk(words))
+                  if word in identities)
+    heat = sorted((k, v) for k, v in counts.items()
+                  if k == name or k.startswith(name + "_"))
+    # Blocks which appear elsewhere may have been compiled already, or may be
+    # compiled here under this word's name.
+    sharing = [(repeats[block], shared.get(block)) for block in blocks(words)]
+    key = identities[name] = CACHE.key(COMPILER, TOS, JSR_CALLS,
+                                       options.budget, name in entries, name,
+                                       words, deps, heat, sharing,
+                                       INLINER.growth)
+
+    entry = CACHE.get(key)
+    if entry is None:
+        entry = record(name, words, context)
+        CACHE.put(key, entry)
+    else:
+        replay(entry, context)
+    return entry
+
+
+def snapshot():
+    """
+    Copy the state of the compiler.
+    """
 
-        raise Exception("Lone word %r in tokenizer!" % token)
+    return ([OrderedDict(context), set(called), dict(weights), dict(shuffles),
+             set(indexed), dict(shared), dict(identities),
+             dict(peephole_stats)],
+            INLINER.growth, list(INLINER.decisions), list(INLINER.checks),
+            set(INLINER.called))
 
-    return pc
 
+def restore(state):
+    """
+    Put the state of the compiler back the way that snapshot() found it.
+    """
 
-with open("prelude.forth", "rb") as f:
-    tokens = [t.strip().lower() for t in f.read().split()]
-    pc = len(bootloader(0)) // 2 + 1
-    context = OrderedDict()
-    pc = compile_tokens(tokens, pc, context)
+    saved, growth, decisions, checks, calls = state
+    for live, copy in zip([context, called, weights, shuffles, indexed,
+                           shared, identities, peephole_stats], saved):
+        live.clear()
+        live.update(copy)
+    INLINER.growth = growth
+    INLINER.decisions[:] = decisions
+    INLINER.checks[:] = checks
+    INLINER.called = set(calls)
 
 
-with open(sys.argv[1], "rb") as f:
-    tokens = [t.strip().lower() for t in f.read().split()]
-    pc = compile_tokens(tokens, pc, context)
+# What the cache counts, which workers hand back to be added up.
+tallies = "hits", "misses", "stores", "evictions"
 
 
-with open(sys.argv[2], "wb") as f:
-    start = context["main"][0]
-    boot = bootloader(start)
-    print "Bootloader: %d bytes (%d words)" % (len(boot), len(boot) // 2)
-    f.write(boot)
-    for name in context:
-        pc, u = context[name]
-        if pc is None:
-            print "Word %s: %d bytes (%d words) (inline)" % (name, len(u),
-                len(u) // 2)
-            continue
+def compile_remote(task):
+    """
+    Compile a word in a worker, which starts over from the state that the
+    compiler was in before any words were compiled, and then does again
+    everything that compiling the words the word needs did.
+
+    Returns the word's identity and entry, and what the cache counted, all
+    pickled.
+    """
+
+    index, growth = task
+    restore(BASELINE)
+    before = [getattr(CACHE, tally) for tally in tallies if CACHE]
+    for n in NEEDS[index]:
+        identity, entry = RESULTS[n]
+        replay(entry, context, placed=False)
+        if identity is not None:
+            identities[words[n][0]] = identity
+    # Guess at how much the image will have grown by, by the time the word is
+    # compiled in order.
+    INLINER.growth = growth
+
+    name, body = words[index]
+    entry = compile_definition(name, body, context)
+    f = StringIO()
+    counted = [getattr(CACHE, tally) - n for tally, n in zip(tallies, before)]
+    dump((identities.get(name), entry, counted), f)
+    return f.getvalue()
+
+
+def visible(entry):
+    """
+    Return everything in an entry that compiling other words can depend on,
+    with every label named by where it appears, so that entries can be
+    compared.
+    """
+
+    code = []
+    for n, (inline, ucode, body) in entry["context"]:
+        names = ("%d" % i for i in count())
+        code.append((n, inline, repr(relabel(ucode, names.next)),
+                     body is not None and repr(relabel(body, names.next))))
+    return code, entry["shuffles"], entry["indexed"], entry["shared"]
+
+
+def compile_parallel(words, context, jobs):
+    """
+    Compile every word from the source, on some workers.
 
-        print "Sub %s: %d bytes (%d words) @ 0x%x" % (name, len(u),
-            len(u) // 2, pc)
-        f.seek(pc * 2)
-        f.write(u)
+    Words are compiled in waves, each of which only needs the words from the
+    waves before it. Every wave gets new workers, which start out with the
+    entries of every word compiled so far.
+
+    The entries are then done again in order, just as if the words had been
+    compiled in order. The only thing that a word could get wrong by being
+    compiled early is a decision that came down to the inlining budget, so a
+    word whose decisions would go another way, or which needs a word that
+    came out differently, is compiled again here instead.
+    """
+
+    global BASELINE, NEEDS, RESULTS
+
+    BASELINE = snapshot()
+    NEEDS = dependencies(words)
+    RESULTS = {}
+
+    levels = []
+    for needed in NEEDS:
+        levels.append(max([levels[i] + 1 for i in needed] or [0]))
+
+    for level in range(max(levels or [-1]) + 1):
+        # Guess at how much the image will have grown by before each word,
+        # from the words compiled so far.
+        growth = [BASELINE[1]]
+        for i in range(len(words)):
+            growth.append(growth[-1] +
+                          (RESULTS[i][1]["growth"] if i in RESULTS else 0))
+        wave = [i for i, l in enumerate(levels) if l == level]
+        pool = Pool(jobs)
+        done = pool.map(compile_remote, [(i, growth[i]) for i in wave])
+        pool.close()
+        pool.join()
+        for i, result in zip(wave, done):
+            identity, entry, counted = load(StringIO(result))
+            RESULTS[i] = identity, entry
+            for tally, n in zip(tallies, counted):
+                setattr(CACHE, tally, getattr(CACHE, tally) + n)
+
+    redone = set()
+    for i, (name, body) in enumerate(words):
+        identity, entry = RESULTS[i]
+        if redone.intersection(NEEDS[i]) or not INLINER.agrees(
+                entry["checks"]):
+            print "Compiling %s again, in order" % name
+            # The words which need this one only have to be compiled again
+            # too if it came out differently.
+            if visible(compile_definition(name, body, context)) != visible(
+                    entry):
+                redone.add(i)
+        else:
+            replay(entry, context)
+            if identity is not None:
+                identities[name] = identity
+
+
+if options.cache:
+    CACHE = Cache(options.cache, options.cache_size)
+else:
+    CACHE = None
+
+# The cache key of each word, which words that use it include in theirs.
+identities = {}
+
+context = OrderedDict()
+# Words from objects can be inlined or called, but are never compiled again.
+for obj, renamed in zip(libraries, names):
+    for name, inline, ucode, body in obj.words(renamed):
+        context[name] = inline, ucode, None
+        identities[name] = obj.source, name
+        weights[name] = counts.get(name, 0)
+    for name, effect in obj.shuffles.items():
+        shuffles[renamed[name]] = effect
+    indexed.update(renamed[name] for name in obj.indexed)
+
+if options.jobs > 1:
+    compile_parallel(words, context, options.jobs)
+else:
+    for name, body in words:
+        if CACHE is None:
+            subroutine(name, body, context)
+        else:
+            compile_definition(name, body, context)
+
+# Everything compiled from source becomes an object of its own.
+module = Object(ABI, SOURCE, COMPILER)
+defined = set(name for name, body in words)
+for name in context:
+    if name in imported and name not in defined:
+        continue
+    inline, ucode, body = context[name]
+    module.add(name, inline, ucode, body, weights.get(name, 0),
+               shuffles.get(name), name in indexed)
+    if name not in called:
+        print "Word %s: %d words (inline)" % (name, size(ucode))
+
+if options.object:
+    for name in entries:
+        if name not in module.sections:
+            raise Exception("Can't export undefined word %r" % name)
+    with open(options.output, "wb") as f:
+        module.save(f)
+    print "Object: %d words, %d sections" % (len(module.order),
+                                             len(module.sections))
+else:
+    # Only keep the words which can be reached from an entry point, and lay
+    # them out so that the hottest ones get the shortest addresses.
+    # Everything is encoded there, and nowhere else.
+    start = bootloader()
+    image, symbols, placed, removed = link_objects(libraries + [module],
+                                                   start, entries, weights)
+
+    print "Bootloader: %d words" % size(start)
+    for name, body in placed:
+        print "Sub %s: %d words @ 0x%x" % (name, size(body), symbols[name])
+    total = 0
+    for name, n in removed:
+        # Words which were only ever inlined were never going to be kept.
+        if name in called or name not in defined:
+            print "Removed %s: %d words (unreachable)" % (name, n)
+            total += n
+    print "Removed %d words of unreachable code" % total
+
+    with open(options.output, "wb") as f:
+        f.write(image)
+
+    if options.map:
+        with open(options.map, "wb") as f:
+            for name, body in placed:
+                f.write("0x%04x %s\n" % (symbols[name], name))
+
+for line in INLINER.report():
+    print line
+
+if CACHE is not None:
+    for line in CACHE.report():
+        print line
+
+for rule in sorted(peephole_stats):
+    words, cycles = peephole_stats[rule]
+    print "Peephole %s: saved %d words, %d cycles" % (rule, words, cycles)